@@ -4,7 +4,6 @@ from urllib.parse import urlencode
 from base64 import b64decode, b64encode
 import json
 import jwt
-import requests
 from google.oauth2 import id_token
 import google.auth.transport
 from datetime import datetime, timezone, timedelta
@@ -14,11 +13,13 @@ from fastapi.security.utils import get_authorization_scheme_param
 
 from splitgraph_chatgpt_plugin.config import (
     GOOGLE_AUTH_FLOW_COMPLETE_PATH,
+    GOOGLE_OAUTH_TIMEOUT_SECONDS,
     JWT_ACCESS_TOKEN_LIFETIME_SECONDS,
     PLUGIN_DOMAIN,
     get_oauth_client_id_openai,
     get_plugin_jwt_secret,
 )
+from splitgraph_chatgpt_plugin.upstream import post
 
 
 class OAuthContext(BaseModel):
@@ -144,8 +145,10 @@ def parse_id_token(id_token_str, client_id) -> Dict[str, str]:
 def get_google_auth_result(
     code: str, client_id: str, client_secret: str
 ) -> GoogleAuthResult:
-    response: Dict[str, str] = requests.post(
+    response: Dict[str, str] = post(
+        "google_oauth",
         "https://oauth2.googleapis.com/token",
+        GOOGLE_OAUTH_TIMEOUT_SECONDS,
         data={
             "code": code,
             "client_id": client_id,
@@ -1,9 +1,14 @@
 # This is a version of the main.py file found in ../../../server/main.py for testing the plugin locally.
 # Use the command `poetry run dev` to run this.
-from typing import Optional
+import asyncio
+import json
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+import sqlalchemy
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import RedirectResponse
+from fastapi.responses import PlainTextResponse, RedirectResponse
 
 from starlette.responses import FileResponse
 
@@ -20,26 +25,83 @@ from .auth import (
     parse_openai_authorization_request,
     serialize_auth_context,
 )
+from splitgraph_chatgpt_plugin.admission import AdmissionController, AdmissionRejected
+from splitgraph_chatgpt_plugin.cache import SharedCache, cache_key, get_shared_cache
 from splitgraph_chatgpt_plugin.config import (
+    BATCH_MAX_ITEMS,
+    CACHE_VERSION_CHECK_SECONDS,
+    EMBEDDING_CACHE_TTL_SECONDS,
+    EMBEDDING_MAX_CONCURRENCY,
+    EMBEDDING_MAX_CONCURRENCY_PER_USER,
+    EMBEDDING_MAX_QUEUE,
+    EMBEDDING_MAX_QUEUE_PER_USER,
+    FIND_RELEVANT_TABLES_CACHE_TTL_SECONDS,
+    FIND_RELEVANT_TABLES_RESULT_LIMIT,
     GOOGLE_AUTH_FLOW_COMPLETE_PATH,
-    DOCUMENT_COLLECTION_NAME,
     JWT_ACCESS_TOKEN_LIFETIME_SECONDS,
     JWT_REFRESH_TOKEN_LIFETIME_SECONDS,
+    OPENAI_QUERY_MAX_RETRIES,
+    OPENAI_TIMEOUT_SECONDS,
+    REQUEST_DEADLINE_SECONDS,
+    RUN_SQL_MAX_CONCURRENCY,
+    RUN_SQL_MAX_CONCURRENCY_PER_USER,
+    RUN_SQL_MAX_QUEUE,
+    RUN_SQL_MAX_QUEUE_PER_USER,
     get_oauth_client_id_google,
     get_oauth_client_id_openai,
     get_oauth_client_secret_google,
     get_openai_api_key,
+    get_cache_backend,
     get_db_connection_string,
+    get_document_collection_name,
+    get_embedding_dimensions,
+    get_embedding_half_precision,
+    get_find_relevant_tables_max_tokens,
+    get_memory_index_dir,
+    get_profile_admin_token,
+    get_profile_sample_rate,
+    get_search_backend,
+)
+from splitgraph_chatgpt_plugin.ddn import (
+    get_fresh_schema_tables,
+    get_query_editor_url,
+    get_table_infos,
+    run_sql as _run_sql,
+)
+from splitgraph_chatgpt_plugin.models import (
+    FindRelevantTablesBatchRequest,
+    FindRelevantTablesBatchResponse,
+    FindRelevantTablesBatchResult,
+    FindRelevantTablesResponse,
+    RunSQLBatchRequest,
+    RunSQLBatchResponse,
+    RunSQLResponse,
+    TableInfo,
 )
-from splitgraph_chatgpt_plugin.ddn import get_table_infos, run_sql as _run_sql
-from splitgraph_chatgpt_plugin.models import FindRelevantTablesResponse, RunSQLResponse
 
+from splitgraph_chatgpt_plugin.memory_index import MemoryMappedVectorStore
 from splitgraph_chatgpt_plugin.persistence import (
+    SchemaSearchStore,
     connect,
-    find_repos,
+    find_repos_with_schemas,
+    get_collection_version,
     get_embedding_store_pgvector,
+    get_repository_schemas,
+)
+from splitgraph_chatgpt_plugin.profiling import (
+    ProfilingMiddleware,
+    is_admin_token,
+    profiler,
+    run_in_threadpool,
 )
-from langchain.vectorstores import VectorStore
+from splitgraph_chatgpt_plugin.relevance import (
+    fit_tables_to_budget,
+    get_table_distances,
+    rank_tables,
+)
+from splitgraph_chatgpt_plugin.upstream import UpstreamError, deadline
+
+T = TypeVar("T")
 
 app = FastAPI()
 PORT = 3333
@@ -56,8 +118,132 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Only installed when enabled, so requests aren't slowed down otherwise.
+if get_profile_sample_rate() > 0 or get_profile_admin_token():
+    app.add_middleware(
+        ProfilingMiddleware,
+        sample_rate=get_profile_sample_rate(),
+        admin_token=get_profile_admin_token(),
+    )
 
-vstore: Optional[VectorStore] = None
+vstore: Optional[SchemaSearchStore] = None
+connection: Optional[sqlalchemy.engine.Connection] = None
+# Upstream calls run in the threadpool, so uses of the (shared) database
+# connection must be serialized.
+connection_lock = threading.Lock()
+
+run_sql_admission = AdmissionController(
+    "run_sql",
+    RUN_SQL_MAX_CONCURRENCY,
+    RUN_SQL_MAX_CONCURRENCY_PER_USER,
+    RUN_SQL_MAX_QUEUE,
+    RUN_SQL_MAX_QUEUE_PER_USER,
+)
+embedding_admission = AdmissionController(
+    "embedding",
+    EMBEDDING_MAX_CONCURRENCY,
+    EMBEDDING_MAX_CONCURRENCY_PER_USER,
+    EMBEDDING_MAX_QUEUE,
+    EMBEDDING_MAX_QUEUE_PER_USER,
+)
+
+
+shared_cache: Optional[SharedCache] = None
+cache_version = 0
+cache_version_checked_at: Optional[float] = None
+
+
+def get_cache_version() -> int:
+    # The collection's version, checked at most every CACHE_VERSION_CHECK_SECONDS.
+    # Only cache entries depend on it, so it isn't checked without a cache.
+    global cache_version, cache_version_checked_at
+    now = time.monotonic()
+    if shared_cache is None:
+        return cache_version
+    if connection is not None and (
+        cache_version_checked_at is None
+        or now - cache_version_checked_at >= CACHE_VERSION_CHECK_SECONDS
+    ):
+        with connection_lock:
+            cache_version = get_collection_version(
+                connection, get_document_collection_name()
+            )
+        cache_version_checked_at = now
+    return cache_version
+
+
+def get_cached(namespace: str, key: str, version: int = 0) -> Optional[str]:
+    return shared_cache.get(namespace, key, version) if shared_cache else None
+
+
+def set_cached(
+    namespace: str, key: str, value: str, ttl_seconds: float, version: int = 0
+) -> None:
+    if shared_cache:
+        shared_cache.set(namespace, key, value, ttl_seconds, version)
+
+
+def lookup_schemas(
+    repositories: List[Tuple[str, str]],
+) -> Dict[Tuple[str, str], List[TableInfo]]:
+    if connection is None or not repositories:
+        return {}
+    with connection_lock:
+        schemas = get_repository_schemas(
+            connection, get_document_collection_name(), repositories
+        )
+    return get_fresh_schema_tables(schemas)
+
+
+def get_relevant_tables(
+    vstore: SchemaSearchStore, prompt: str, embedding: List[float]
+) -> FindRelevantTablesResponse:
+    with connection_lock:
+        matches = find_repos_with_schemas(
+            vstore,
+            prompt,
+            result_limit=FIND_RELEVANT_TABLES_RESULT_LIMIT,
+            embedding=embedding,
+        )
+    table_infos = get_table_infos(
+        matches.repositories,
+        use_fully_qualified_table_names=True,
+        schemas=matches.schemas,
+    )
+    return fit_tables_to_budget(
+        rank_tables(table_infos, get_table_distances(matches.results)),
+        get_find_relevant_tables_max_tokens(),
+    )
+
+
+async def get_prompt_embedding(
+    vstore: SchemaSearchStore, user: str, prompt: str
+) -> List[float]:
+    # embeddings depend on the collection's dimensions
+    key = cache_key(get_document_collection_name(), prompt)
+    cached = await run_in_threadpool(get_cached, "embedding", key)
+    if cached is not None:
+        return json.loads(cached)
+    async with embedding_admission.admit(user):
+        embedding = await run_in_threadpool(
+            vstore.embedding_function.embed_query, prompt
+        )
+    await run_in_threadpool(
+        set_cached,
+        "embedding",
+        key,
+        json.dumps(embedding),
+        EMBEDDING_CACHE_TTL_SECONDS,
+    )
+    return embedding
+
+
+def too_many_requests(e: AdmissionRejected) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)},
+    )
 
 
 def get_converation_id(info: Request) -> Optional[str]:
@@ -84,6 +270,80 @@ async def get_openapi(request):
     return FileResponse(file_path, media_type="text/json")
 
 
+async def get_find_relevant_tables_response(
+    user: str, prompt: str
+) -> FindRelevantTablesResponse:
+    if vstore is None:
+        raise Exception("vstore uninitialized")
+    key = cache_key(
+        get_document_collection_name(),
+        prompt,
+        get_find_relevant_tables_max_tokens(),
+    )
+    version = await run_in_threadpool(get_cache_version)
+    cached = await run_in_threadpool(get_cached, "find_relevant_tables", key, version)
+    if cached is not None:
+        return FindRelevantTablesResponse.parse_raw(cached)
+    embedding = await get_prompt_embedding(vstore, user, prompt)
+    response = await run_in_threadpool(get_relevant_tables, vstore, prompt, embedding)
+    await run_in_threadpool(
+        set_cached,
+        "find_relevant_tables",
+        key,
+        response.json(),
+        FIND_RELEVANT_TABLES_CACHE_TTL_SECONDS,
+        version,
+    )
+    return response
+
+
+async def get_run_sql_response(
+    user: str, query: str, summarize: bool = False
+) -> RunSQLResponse:
+    # Results aren't cached: queries may read live or changing data.
+    async with run_sql_admission.admit(user):
+        return await run_in_threadpool(_run_sql, query, lookup_schemas, summarize)
+
+
+def get_error_message(operation: str, e: Exception) -> str:
+    # Batch items report errors like the single item endpoints' HTTP errors.
+    if isinstance(e, AdmissionRejected):
+        return f"{e}, retry after {e.retry_after} seconds"
+    if isinstance(e, UpstreamError):
+        print(f"{operation} upstream error: {e}")
+        return "Service Temporarily Unavailable"
+    import traceback
+
+    print("".join(traceback.format_exception(e)))
+    return "Internal Service Error"
+
+
+async def run_batch(
+    items: List[str],
+    parallelism: int,
+    run: Callable[[str], Awaitable[T]],
+    on_error: Callable[[str, Exception], T],
+) -> List[T]:
+    # Runs at most `parallelism` items at a time, returning results in order.
+    # Each item gets its own deadline once it starts, so that items late in
+    # the batch aren't cut short by the time taken by the earlier ones.
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400, detail=f"At most {BATCH_MAX_ITEMS} items per batch"
+        )
+    semaphore = asyncio.Semaphore(parallelism)
+
+    async def run_item(item: str) -> T:
+        async with semaphore:
+            try:
+                with deadline(REQUEST_DEADLINE_SECONDS):
+                    return await run(item)
+            except Exception as e:
+                return on_error(item, e)
+
+    return list(await asyncio.gather(*[run_item(item) for item in items]))
+
+
 @app.get("/find_relevant_tables", response_model=FindRelevantTablesResponse)
 async def find_relevant_tables(info: Request, prompt: Optional[str] = None):
     global vstore
@@ -94,14 +354,13 @@ async def find_relevant_tables(info: Request, prompt: Optional[str] = None):
     try:
         if prompt is None:
             raise Exception("Prompt is None")
-        if vstore is not None:
-            repositories = find_repos(vstore, prompt)
-            return FindRelevantTablesResponse(
-                tables=get_table_infos(
-                    repositories, use_fully_qualified_table_names=True
-                )
-            )
-        raise Exception("vstore uninitialized")
+        with deadline(REQUEST_DEADLINE_SECONDS):
+            return await get_find_relevant_tables_response(jwt_payload.sub, prompt)
+    except AdmissionRejected as e:
+        raise too_many_requests(e)
+    except UpstreamError as e:
+        print(f"find_relevant_tables upstream error: {e}")
+        raise HTTPException(status_code=503, detail="Service Temporarily Unavailable")
     except Exception as e:
         import traceback
 
@@ -109,16 +368,47 @@ async def find_relevant_tables(info: Request, prompt: Optional[str] = None):
         raise HTTPException(status_code=500, detail="Internal Service Error")
 
 
+@app.post("/find_relevant_tables_batch", response_model=FindRelevantTablesBatchResponse)
+async def find_relevant_tables_batch(
+    info: Request, request: FindRelevantTablesBatchRequest
+):
+    jwt_payload = assert_authorized(info)
+    print(
+        f"find_relevant_tables_batch {jwt_payload.email} {get_converation_id(info)} {request.prompts}"
+    )
+
+    async def run(prompt: str) -> FindRelevantTablesBatchResult:
+        return FindRelevantTablesBatchResult(
+            response=await get_find_relevant_tables_response(jwt_payload.sub, prompt)
+        )
+
+    def on_error(prompt: str, e: Exception) -> FindRelevantTablesBatchResult:
+        return FindRelevantTablesBatchResult(
+            error=get_error_message("find_relevant_tables", e)
+        )
+
+    return FindRelevantTablesBatchResponse(
+        results=await run_batch(
+            request.prompts, EMBEDDING_MAX_CONCURRENCY_PER_USER, run, on_error
+        )
+    )
+
+
 @app.get("/run_sql", response_model=RunSQLResponse)
-async def run_sql(info: Request, query: Optional[str] = None):
+async def run_sql(info: Request, query: Optional[str] = None, summarize: bool = False):
     global vstore
     jwt_payload = assert_authorized(info)
     print(f"run_sql {jwt_payload.email} {get_converation_id(info)} {query}")
     try:
         if query is None:
             raise Exception("No sql query provided")
-        response = _run_sql(query)
-        return response
+        with deadline(REQUEST_DEADLINE_SECONDS):
+            return await get_run_sql_response(jwt_payload.sub, query, summarize)
+    except AdmissionRejected as e:
+        raise too_many_requests(e)
+    except UpstreamError as e:
+        print(f"run_sql upstream error: {e}")
+        raise HTTPException(status_code=503, detail="Service Temporarily Unavailable")
     except Exception as e:
         import traceback
 
@@ -126,6 +416,63 @@ async def run_sql(info: Request, query: Optional[str] = None):
         raise HTTPException(status_code=500, detail="Internal Service Error")
 
 
+@app.post("/run_sql_batch", response_model=RunSQLBatchResponse)
+async def run_sql_batch(info: Request, request: RunSQLBatchRequest):
+    jwt_payload = assert_authorized(info)
+    print(
+        f"run_sql_batch {jwt_payload.email} {get_converation_id(info)} {request.queries}"
+    )
+
+    def on_error(query: str, e: Exception) -> RunSQLResponse:
+        return RunSQLResponse(
+            error=get_error_message("run_sql", e),
+            query_editor_url=get_query_editor_url(query),
+        )
+
+    async def run(query: str) -> RunSQLResponse:
+        return await get_run_sql_response(jwt_payload.sub, query, request.summarize)
+
+    # Items run at most as many at a time as a user's admission share, so
+    # a batch never queues behind itself.
+    return RunSQLBatchResponse(
+        results=await run_batch(
+            request.queries, RUN_SQL_MAX_CONCURRENCY_PER_USER, run, on_error
+        )
+    )
+
+
+def assert_admin(info: Request) -> None:
+    # Admin endpoints are only available with the admin X-Profile-Token header,
+    # and don't reveal their existence otherwise.
+    if not is_admin_token(
+        info.headers.get("x-profile-token"), get_profile_admin_token()
+    ):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+@app.get("/metrics")
+async def get_metrics(info: Request):
+    assert_admin(info)
+    return {
+        "run_sql": run_sql_admission.metrics(),
+        "embedding": embedding_admission.metrics(),
+        "profiled_requests": profiler.requests(),
+    }
+
+
+@app.get("/profiles")
+async def get_profiles(
+    info: Request, endpoint: Optional[str] = None, reset: bool = False
+):
+    # Stack samples of profiled requests in the collapsed stack format, eg.
+    # for flamegraph.pl.
+    assert_admin(info)
+    stacks = profiler.collapsed(endpoint)
+    if reset:
+        profiler.reset()
+    return PlainTextResponse(stacks)
+
+
 # Step 1: Start of auth flow, initial request made by ChatGPT to authenticate user upon plugin installation
 # Request URL parameters documented at: https://platform.openai.com/docs/plugins/authentication/oauth
 @app.get("/auth/init_auth_flow")
@@ -221,10 +568,36 @@ async def oauth_exchange(info: Request):
 async def startup():
     global openai_api_key
     global vstore
+    global connection
+    global shared_cache
     openai_api_key = get_openai_api_key()
+    connection = connect(get_db_connection_string())
+    shared_cache = get_shared_cache(
+        get_cache_backend(), lambda: connect(get_db_connection_string())
+    )
     vstore = get_embedding_store_pgvector(
-        connect(get_db_connection_string()), DOCUMENT_COLLECTION_NAME, openai_api_key
+        connection,
+        get_document_collection_name(),
+        openai_api_key,
+        dimensions=get_embedding_dimensions(),
+        half_precision=get_embedding_half_precision(),
+        request_timeout=OPENAI_TIMEOUT_SECONDS,
+        max_retries=OPENAI_QUERY_MAX_RETRIES,
+        guard_queries=True,
     )
+    if get_search_backend() == "memory":
+        vstore = MemoryMappedVectorStore(
+            vstore,
+            lambda: connect(get_db_connection_string()),
+            get_memory_index_dir(),
+        )
+        vstore.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if isinstance(vstore, MemoryMappedVectorStore):
+        vstore.stop()
 
 
 def start():
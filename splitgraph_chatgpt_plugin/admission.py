@@ -0,0 +1,171 @@
+import asyncio
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from math import ceil
+import time
+from typing import AsyncIterator, Deque, Dict
+
+from .config import ADMISSION_MAX_WAIT_SECONDS
+
+# Weight of the latest call in the moving average of call durations.
+SERVICE_TIME_SMOOTHING = 0.2
+MAX_RETRY_AFTER_SECONDS = 60
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Limits the number of concurrent calls to an upstream, both in total and
+    per user. Calls which can't start straight away wait in per-user queues,
+    which are served round-robin so that a user with many queued calls can't
+    starve the others. Calls are rejected (with a suggested retry delay) when
+    the queue is full or they've waited for too long.
+
+    Must only be used from the event loop's thread.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        max_concurrency_per_user: int,
+        max_queue: int,
+        max_queue_per_user: int,
+        max_wait_seconds: float = ADMISSION_MAX_WAIT_SECONDS,
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_concurrency_per_user = max_concurrency_per_user
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.max_wait_seconds = max_wait_seconds
+        self._active: Dict[str, int] = defaultdict(int)
+        self._active_total = 0
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {}
+        # users with queued calls, the next one to be served first
+        self._rotation: Deque[str] = deque()
+        self._queued = 0
+        self._service_seconds = 1.0
+        self._admitted_total = 0
+        self._rejected_total = 0
+        self._wait_seconds_total = 0.0
+        self._wait_seconds_max = 0.0
+
+    def _can_start(self, user: str) -> bool:
+        return (
+            self._active_total < self.max_concurrency
+            and self._active[user] < self.max_concurrency_per_user
+        )
+
+    def _start(self, user: str, waited: float) -> None:
+        self._active[user] += 1
+        self._active_total += 1
+        self._admitted_total += 1
+        self._wait_seconds_total += waited
+        self._wait_seconds_max = max(self._wait_seconds_max, waited)
+
+    def _finish(self, user: str, duration: float) -> None:
+        self._active[user] -= 1
+        if not self._active[user]:
+            del self._active[user]
+        self._active_total -= 1
+        self._service_seconds += SERVICE_TIME_SMOOTHING * (
+            duration - self._service_seconds
+        )
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        skipped = 0
+        while (
+            self._rotation
+            and self._active_total < self.max_concurrency
+            and skipped < len(self._rotation)
+        ):
+            user = self._rotation[0]
+            if self._active[user] >= self.max_concurrency_per_user:
+                self._rotation.rotate(-1)
+                skipped += 1
+                continue
+            future = self._waiters[user].popleft()
+            self._queued -= 1
+            if self._waiters[user]:
+                self._rotation.rotate(-1)
+            else:
+                self._rotation.popleft()
+                del self._waiters[user]
+            # the waiting call counts its own wait time once it's woken up
+            self._start(user, 0)
+            future.set_result(None)
+            skipped = 0
+
+    def _dequeue(self, user: str, future: asyncio.Future) -> None:
+        self._waiters[user].remove(future)
+        self._queued -= 1
+        if not self._waiters[user]:
+            del self._waiters[user]
+            self._rotation.remove(user)
+
+    def _reject(self, message: str) -> AdmissionRejected:
+        self._rejected_total += 1
+        # roughly how long it takes for the current queue to drain
+        retry_after = ceil(
+            self._service_seconds * (self._queued + 1) / self.max_concurrency
+        )
+        return AdmissionRejected(
+            message, max(1, min(retry_after, MAX_RETRY_AFTER_SECONDS))
+        )
+
+    @asynccontextmanager
+    async def admit(self, user: str) -> AsyncIterator[None]:
+        start = time.monotonic()
+        # Calls still queued when there's capacity are those of users at their
+        # own limit, which mustn't hold up the other users' calls.
+        if user not in self._waiters and self._can_start(user):
+            self._start(user, 0)
+        else:
+            if (
+                self._queued >= self.max_queue
+                or len(self._waiters.get(user, ())) >= self.max_queue_per_user
+            ):
+                raise self._reject(f"Too many concurrent {self.name} requests")
+            future = asyncio.get_running_loop().create_future()
+            if user not in self._waiters:
+                self._waiters[user] = deque()
+                self._rotation.append(user)
+            self._waiters[user].append(future)
+            self._queued += 1
+            try:
+                await asyncio.wait({future}, timeout=self.max_wait_seconds)
+            except asyncio.CancelledError:
+                if future.done():
+                    self._finish(user, 0)
+                else:
+                    self._dequeue(user, future)
+                raise
+            if not future.done():
+                self._dequeue(user, future)
+                raise self._reject(f"Timed out waiting for {self.name} capacity")
+            waited = time.monotonic() - start
+            self._wait_seconds_total += waited
+            self._wait_seconds_max = max(self._wait_seconds_max, waited)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._finish(user, time.monotonic() - started)
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            "active": self._active_total,
+            "queued": self._queued,
+            "admitted_total": self._admitted_total,
+            "rejected_total": self._rejected_total,
+            "wait_seconds_total": self._wait_seconds_total,
+            "wait_seconds_max": self._wait_seconds_max,
+            "service_seconds_average": self._service_seconds,
+        }
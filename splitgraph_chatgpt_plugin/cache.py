@@ -0,0 +1,221 @@
+from abc import ABC, abstractmethod
+from contextlib import closing
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Callable, Optional
+
+import sqlalchemy
+
+# Expired entries are deleted after every this many writes.
+CACHE_CLEANUP_INTERVAL = 1000
+
+CREATE_CACHE_TABLE_QUERY = """
+    CREATE UNLOGGED TABLE IF NOT EXISTS shared_cache (
+        namespace TEXT NOT NULL,
+        key TEXT NOT NULL,
+        version BIGINT NOT NULL,
+        value TEXT NOT NULL,
+        expires_at TIMESTAMPTZ NOT NULL,
+        PRIMARY KEY (namespace, key)
+    );
+    """
+
+GET_CACHE_ENTRY_QUERY = """
+    SELECT value FROM shared_cache
+    WHERE namespace = :namespace AND key = :key AND version = :version AND expires_at > now();
+    """
+
+SET_CACHE_ENTRY_QUERY = """
+    INSERT INTO shared_cache (namespace, key, version, value, expires_at)
+    VALUES (:namespace, :key, :version, :value, now() + CAST(:ttl_seconds AS double precision) * interval '1 second')
+    ON CONFLICT (namespace, key)
+    DO UPDATE SET version = excluded.version, value = excluded.value, expires_at = excluded.expires_at;
+    """
+
+DELETE_EXPIRED_CACHE_ENTRIES_QUERY = """
+    DELETE FROM shared_cache WHERE expires_at <= now();
+    """
+
+CREATE_SQLITE_CACHE_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS shared_cache (
+        namespace TEXT NOT NULL,
+        key TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        value TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        PRIMARY KEY (namespace, key)
+    );
+    """
+
+
+def cache_key(*parts: object) -> str:
+    return hashlib.sha256("\0".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+class SharedCache(ABC):
+    """
+    A cache shared by all workers. Values are strings (eg. serialized JSON),
+    stored under a namespace and key. Every entry has a TTL and a version:
+    lookups only return entries stored with the version asked for, so bumping
+    the version (eg. when the indexer changes a collection) invalidates them
+    everywhere at once.
+
+    Errors are logged and treated as cache misses, so an unavailable cache
+    never fails a request.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get(self, namespace: str, key: str, version: int = 0) -> Optional[str]:
+        try:
+            with self._lock:
+                return self._get(namespace, key, version)
+        except Exception as e:
+            print(f"Failed to read from the {namespace} cache: {e}")
+            return None
+
+    def set(
+        self,
+        namespace: str,
+        key: str,
+        value: str,
+        ttl_seconds: float,
+        version: int = 0,
+    ) -> None:
+        try:
+            with self._lock:
+                self._set(namespace, key, value, ttl_seconds, version)
+                self._writes += 1
+                if self._writes % CACHE_CLEANUP_INTERVAL == 0:
+                    self._delete_expired()
+        except Exception as e:
+            print(f"Failed to write to the {namespace} cache: {e}")
+
+    @abstractmethod
+    def _get(self, namespace: str, key: str, version: int) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def _set(
+        self, namespace: str, key: str, value: str, ttl_seconds: float, version: int
+    ) -> None:
+        ...
+
+    @abstractmethod
+    def _delete_expired(self) -> None:
+        ...
+
+
+class PostgresCache(SharedCache):
+    """
+    Stores entries in an unlogged table of the plugin's database, shared by
+    all workers on all hosts. Uses its own connection.
+    """
+
+    def __init__(self, connect: Callable[[], sqlalchemy.engine.Connection]):
+        super().__init__()
+        self._connect = connect
+        self._connection: Optional[sqlalchemy.engine.Connection] = None
+
+    def _execute(self, query: str, **params: object) -> Optional[str]:
+        # Returns the first column of the first row, if any.
+        try:
+            if self._connection is None:
+                self._connection = self._connect()
+                self._connection.execute(sqlalchemy.text(CREATE_CACHE_TABLE_QUERY))
+                self._connection.commit()
+            result = self._connection.execute(
+                sqlalchemy.text(query).bindparams(**params)
+            )
+            value = result.scalar() if result.returns_rows else None
+            self._connection.commit()
+            return value
+        except Exception:
+            # reconnect on the next call
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+            raise
+
+    def _get(self, namespace: str, key: str, version: int) -> Optional[str]:
+        return self._execute(
+            GET_CACHE_ENTRY_QUERY, namespace=namespace, key=key, version=version
+        )
+
+    def _set(
+        self, namespace: str, key: str, value: str, ttl_seconds: float, version: int
+    ) -> None:
+        self._execute(
+            SET_CACHE_ENTRY_QUERY,
+            namespace=namespace,
+            key=key,
+            version=version,
+            value=value,
+            ttl_seconds=float(ttl_seconds),
+        )
+
+    def _delete_expired(self) -> None:
+        self._execute(DELETE_EXPIRED_CACHE_ENTRIES_QUERY)
+
+
+class LocalCache(SharedCache):
+    """
+    Stores entries in an SQLite database on a memory-backed file system
+    (/dev/shm), shared by all workers on the same host.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self._connection = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        with closing(self._connection.cursor()) as cursor:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute(CREATE_SQLITE_CACHE_TABLE_QUERY)
+        self._connection.commit()
+
+    def _get(self, namespace: str, key: str, version: int) -> Optional[str]:
+        with closing(self._connection.cursor()) as cursor:
+            cursor.execute(
+                "SELECT value FROM shared_cache "
+                "WHERE namespace = ? AND key = ? AND version = ? AND expires_at > ?",
+                (namespace, key, version, time.time()),
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def _set(
+        self, namespace: str, key: str, value: str, ttl_seconds: float, version: int
+    ) -> None:
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO shared_cache VALUES (?, ?, ?, ?, ?)",
+                (namespace, key, version, value, time.time() + ttl_seconds),
+            )
+
+    def _delete_expired(self) -> None:
+        with self._connection:
+            self._connection.execute(
+                "DELETE FROM shared_cache WHERE expires_at <= ?", (time.time(),)
+            )
+
+
+def get_local_cache_path() -> str:
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "splitgraph_chatgpt_plugin_cache.sqlite")
+
+
+def get_shared_cache(
+    backend: str, connect: Callable[[], sqlalchemy.engine.Connection]
+) -> Optional[SharedCache]:
+    if backend == "postgres":
+        return PostgresCache(connect)
+    if backend == "local":
+        return LocalCache(get_local_cache_path())
+    if backend == "none":
+        return None
+    raise ValueError(f"Unknown cache backend {backend}")
@@ -0,0 +1,164 @@
+from datetime import datetime
+from typing import Optional, Set
+import sqlalchemy
+
+CREATE_PROGRESS_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS indexer_progress (
+        collection TEXT NOT NULL,
+        namespace TEXT NOT NULL,
+        repository TEXT NOT NULL,
+        completed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (collection, namespace, repository)
+    );
+    """
+
+GET_COMPLETED_REPOSITORIES_QUERY = """
+    SELECT repository FROM indexer_progress
+    WHERE collection = :collection AND namespace = :namespace;
+    """
+
+MARK_REPOSITORY_COMPLETED_QUERY = """
+    INSERT INTO indexer_progress (collection, namespace, repository)
+    VALUES (:collection, :namespace, :repository)
+    ON CONFLICT (collection, namespace, repository)
+    DO UPDATE SET completed_at = now();
+    """
+
+CLEAR_PROGRESS_QUERY = """
+    DELETE FROM indexer_progress
+    WHERE collection = :collection AND namespace = :namespace;
+    """
+
+# Latest updatedAt of the repositories (re-)indexed by the change-driven
+# indexer, as reported by the GraphQL API, so it's never affected by clock skew.
+CREATE_WATERMARK_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS indexer_watermark (
+        collection TEXT NOT NULL,
+        namespace TEXT NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL,
+        PRIMARY KEY (collection, namespace)
+    );
+    """
+
+GET_WATERMARK_QUERY = """
+    SELECT updated_at FROM indexer_watermark
+    WHERE collection = :collection AND namespace = :namespace;
+    """
+
+SET_WATERMARK_QUERY = """
+    INSERT INTO indexer_watermark (collection, namespace, updated_at)
+    VALUES (:collection, :namespace, :updated_at)
+    ON CONFLICT (collection, namespace)
+    DO UPDATE SET updated_at = excluded.updated_at;
+    """
+
+# Session-level advisory locks are released automatically when the indexer's
+# connection goes away, so a crashed run never leaves a namespace locked.
+TRY_LOCK_NAMESPACE_QUERY = """
+    SELECT pg_try_advisory_lock(hashtext(:collection || '/' || :namespace));
+    """
+
+UNLOCK_NAMESPACE_QUERY = """
+    SELECT pg_advisory_unlock(hashtext(:collection || '/' || :namespace));
+    """
+
+UNLOCK_ALL_NAMESPACES_QUERY = """
+    SELECT pg_advisory_unlock_all();
+    """
+
+
+def create_progress_table(connection: sqlalchemy.engine.Connection) -> None:
+    connection.execute(sqlalchemy.text(CREATE_PROGRESS_TABLE_QUERY))
+    connection.commit()
+
+
+def get_completed_repositories(
+    connection: sqlalchemy.engine.Connection, collection: str, namespace: str
+) -> Set[str]:
+    stmt = sqlalchemy.text(GET_COMPLETED_REPOSITORIES_QUERY).bindparams(
+        collection=collection, namespace=namespace
+    )
+    completed = {row[0] for row in connection.execute(stmt)}
+    connection.commit()
+    return completed
+
+
+def mark_repository_completed(
+    connection: sqlalchemy.engine.Connection,
+    collection: str,
+    namespace: str,
+    repository: str,
+) -> None:
+    stmt = sqlalchemy.text(MARK_REPOSITORY_COMPLETED_QUERY).bindparams(
+        collection=collection, namespace=namespace, repository=repository
+    )
+    connection.execute(stmt)
+    connection.commit()
+
+
+def clear_progress(
+    connection: sqlalchemy.engine.Connection, collection: str, namespace: str
+) -> None:
+    stmt = sqlalchemy.text(CLEAR_PROGRESS_QUERY).bindparams(
+        collection=collection, namespace=namespace
+    )
+    connection.execute(stmt)
+    connection.commit()
+
+
+def try_lock_namespace(
+    connection: sqlalchemy.engine.Connection, collection: str, namespace: str
+) -> bool:
+    stmt = sqlalchemy.text(TRY_LOCK_NAMESPACE_QUERY).bindparams(
+        collection=collection, namespace=namespace
+    )
+    locked = bool(connection.execute(stmt).scalar())
+    connection.commit()
+    return locked
+
+
+def unlock_namespace(
+    connection: sqlalchemy.engine.Connection, collection: str, namespace: str
+) -> None:
+    stmt = sqlalchemy.text(UNLOCK_NAMESPACE_QUERY).bindparams(
+        collection=collection, namespace=namespace
+    )
+    connection.execute(stmt)
+    connection.commit()
+
+
+def unlock_all_namespaces(connection: sqlalchemy.engine.Connection) -> None:
+    # Releases every lock held by the connection, eg. after a failed unlock.
+    # Advisory locks are re-entrant, so one left behind would otherwise keep
+    # the namespace locked for as long as the connection lives.
+    connection.execute(sqlalchemy.text(UNLOCK_ALL_NAMESPACES_QUERY))
+    connection.commit()
+
+
+def create_watermark_table(connection: sqlalchemy.engine.Connection) -> None:
+    connection.execute(sqlalchemy.text(CREATE_WATERMARK_TABLE_QUERY))
+    connection.commit()
+
+
+def get_watermark(
+    connection: sqlalchemy.engine.Connection, collection: str, namespace: str
+) -> Optional[datetime]:
+    stmt = sqlalchemy.text(GET_WATERMARK_QUERY).bindparams(
+        collection=collection, namespace=namespace
+    )
+    watermark = connection.execute(stmt).scalar()
+    connection.commit()
+    return watermark
+
+
+def set_watermark(
+    connection: sqlalchemy.engine.Connection,
+    collection: str,
+    namespace: str,
+    updated_at: datetime,
+) -> None:
+    stmt = sqlalchemy.text(SET_WATERMARK_QUERY).bindparams(
+        collection=collection, namespace=namespace, updated_at=updated_at
+    )
+    connection.execute(stmt)
+    connection.commit()
@@ -0,0 +1,188 @@
+from functools import lru_cache
+import re
+from typing import List, Optional, Protocol, Sequence
+
+from langchain.docstore.document import Document
+import tiktoken
+
+from .markdown import (
+    README_HEADER,
+    REPOSITORY_HEADER,
+    TABLE_COLUMNS_INTRO,
+    TABLE_HEADER,
+    column_info_to_markdown,
+)
+from .models import RepositoryInfo, TableInfo
+
+# Encoding used by OpenAI's text-embedding-ada-002 model.
+EMBEDDING_ENCODING = "cl100k_base"
+DOCUMENT_CHUNK_TOKENS = 500
+
+MARKDOWN_HEADING_RE = re.compile(r"^#{1,6}\s")
+# Opening or closing line of a fenced code block
+MARKDOWN_FENCE_RE = re.compile(r"^ {0,3}(`{3,}|~{3,})(.*)$")
+
+
+class Encoding(Protocol):
+    def encode(self, text: str, disallowed_special=...) -> List[int]:
+        ...
+
+    def decode(self, tokens: List[int]) -> str:
+        ...
+
+
+@lru_cache(maxsize=None)
+def get_encoding() -> Encoding:
+    return tiktoken.get_encoding(EMBEDDING_ENCODING)
+
+
+def count_tokens(text: str, encoding: Encoding) -> int:
+    # Embedded documents are arbitrary text, so special tokens such as
+    # <|endoftext|> must be counted as plain text rather than rejected.
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def split_lines_by_tokens(
+    lines: Sequence[str], max_tokens: int, encoding: Encoding
+) -> List[str]:
+    """
+    Greedily packs lines into pieces of at most max_tokens tokens. Lines which
+    don't fit in a piece on their own are split on token boundaries.
+    """
+    pieces: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+    for line in lines:
+        # +1 for the newline joining this line to the previous one
+        line_tokens = count_tokens(line, encoding) + 1
+        if line_tokens > max_tokens:
+            if current:
+                pieces.append("\n".join(current))
+                current, current_tokens = [], 0
+            tokens = encoding.encode(line, disallowed_special=())
+            for start in range(0, len(tokens), max_tokens):
+                pieces.append(encoding.decode(tokens[start : start + max_tokens]))
+            continue
+        if current and current_tokens + line_tokens > max_tokens:
+            pieces.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += line_tokens
+    if current:
+        pieces.append("\n".join(current))
+    return pieces
+
+
+def split_readme_sections(readme: str) -> List[List[str]]:
+    sections: List[List[str]] = []
+    # the opening fence of the code block the current line is in, if any.
+    # Lines starting with "#" in code blocks (eg. shell comments) aren't
+    # headings.
+    fence: Optional[str] = None
+    for line in readme.splitlines():
+        match = MARKDOWN_FENCE_RE.match(line)
+        if fence is None:
+            if match and not (match.group(1)[0] == "`" and "`" in match.group(2)):
+                fence = match.group(1)
+            elif MARKDOWN_HEADING_RE.match(line):
+                sections.append([])
+        elif match and match.group(1).startswith(fence) and not match.group(2).strip():
+            # closed by a fence of the same character that's at least as long
+            fence = None
+        if not sections:
+            sections.append([])
+        sections[-1].append(line)
+    # trim surrounding blank lines and drop sections without any content,
+    # eg. blank lines before the first heading
+    result: List[List[str]] = []
+    for section in sections:
+        content = [i for i, line in enumerate(section) if line.strip()]
+        if content:
+            result.append(section[content[0] : content[-1] + 1])
+    return result
+
+
+def _make_chunks(
+    prefix: str,
+    lines: Sequence[str],
+    metadata: dict,
+    max_tokens: int,
+    encoding: Encoding,
+) -> List[Document]:
+    # Every chunk repeats the prefix, so the repository (and table) name is
+    # always part of the embedded text.
+    budget = max(max_tokens - count_tokens(prefix, encoding), 1)
+    return [
+        Document(page_content=prefix + piece, metadata=dict(metadata))
+        for piece in split_lines_by_tokens(lines, budget, encoding)
+    ]
+
+
+def readme_to_chunks(
+    repository_info: RepositoryInfo, max_tokens: int, encoding: Encoding
+) -> List[Document]:
+    prefix = (
+        REPOSITORY_HEADER.format(
+            namespace=repository_info.namespace,
+            repository=repository_info.repository,
+        )
+        + README_HEADER
+    )
+    metadata = {
+        "namespace": repository_info.namespace,
+        "repository": repository_info.repository,
+    }
+    chunks: List[Document] = []
+    for section in split_readme_sections(repository_info.readme or ""):
+        chunks.extend(_make_chunks(prefix, section, metadata, max_tokens, encoding))
+    return chunks
+
+
+def table_to_chunks(
+    repository_info: RepositoryInfo,
+    table_info: TableInfo,
+    max_tokens: int,
+    encoding: Encoding,
+) -> List[Document]:
+    prefix = (
+        REPOSITORY_HEADER.format(
+            namespace=repository_info.namespace,
+            repository=repository_info.repository,
+        )
+        + TABLE_HEADER.format(tablename=table_info.name)
+        + TABLE_COLUMNS_INTRO.format(
+            namespace=repository_info.namespace,
+            repository=repository_info.repository,
+            tablename=table_info.name,
+        )
+    )
+    metadata = {
+        "namespace": repository_info.namespace,
+        "repository": repository_info.repository,
+        "table": table_info.name,
+    }
+    return _make_chunks(
+        prefix,
+        [column_info_to_markdown(c) for c in table_info.columns],
+        metadata,
+        max_tokens,
+        encoding,
+    )
+
+
+def repository_info_to_chunks(
+    repository_info: RepositoryInfo,
+    max_tokens: int = DOCUMENT_CHUNK_TOKENS,
+    encoding: Optional[Encoding] = None,
+) -> List[Document]:
+    """
+    Splits a repository into documents for embedding: one per README section
+    and one per table, further split by token count where needed.
+    """
+    encoding = encoding or get_encoding()
+    chunks = readme_to_chunks(repository_info, max_tokens, encoding)
+    for table_info in repository_info.tables:
+        chunks.extend(
+            table_to_chunks(repository_info, table_info, max_tokens, encoding)
+        )
+    return chunks
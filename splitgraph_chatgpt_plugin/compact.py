@@ -0,0 +1,60 @@
+from functools import lru_cache
+from typing import List
+
+from langchain.embeddings.base import Embeddings
+import numpy as np
+
+# Output size of OpenAI's text-embedding-ada-002 model.
+OPENAI_EMBEDDING_DIMENSIONS = 1536
+# The projection must be identical at index and query time (and across
+# processes), so it's generated from a fixed seed rather than stored.
+PROJECTION_SEED = 0
+
+
+@lru_cache(maxsize=None)
+def get_projection_matrix(source_dimensions: int, dimensions: int) -> np.ndarray:
+    """
+    Returns a (source_dimensions, dimensions) matrix with orthonormal columns.
+    Random orthogonal projections approximately preserve cosine similarity
+    (Johnson-Lindenstrauss) without having to be trained on the corpus.
+    """
+    if not 0 < dimensions <= source_dimensions:
+        raise ValueError(
+            f"Can't reduce {source_dimensions} dimensions to {dimensions} dimensions"
+        )
+    # RandomState (unlike Generator) guarantees a stable stream across numpy versions.
+    gaussian = np.random.RandomState(PROJECTION_SEED).standard_normal(
+        (source_dimensions, dimensions)
+    )
+    q, _ = np.linalg.qr(gaussian)
+    return q.astype(np.float32)
+
+
+def project_embeddings(embeddings: np.ndarray, dimensions: int) -> np.ndarray:
+    embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+    if embeddings.shape[1] != dimensions:
+        embeddings = embeddings @ get_projection_matrix(embeddings.shape[1], dimensions)
+    # re-normalize, as the stored vectors are compared using cosine distance
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.where(norms == 0, 1, norms)
+
+
+class ProjectedEmbeddings(Embeddings):
+    """
+    Wraps an embedding function, reducing its output to a fixed number of
+    dimensions. Used for both documents and queries so they stay comparable.
+    """
+
+    def __init__(self, embeddings: Embeddings, dimensions: int):
+        self.embeddings = embeddings
+        self.dimensions = dimensions
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        embeddings = self.embeddings.embed_documents(texts)
+        if not embeddings:
+            return []
+        return project_embeddings(np.array(embeddings), self.dimensions).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        embedding = self.embeddings.embed_query(text)
+        return project_embeddings(np.array(embedding), self.dimensions)[0].tolist()
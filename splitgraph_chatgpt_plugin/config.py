@@ -1,4 +1,6 @@
 import os
+import tempfile
+from typing import Optional
 
 
 def get_db_connection_string():
@@ -29,9 +31,126 @@ def get_plugin_jwt_secret():
     return os.getenv("OAUTH_PLUGIN_JWT_SECRET")
 
 
+def get_embedding_dimensions() -> Optional[int]:
+    # Reduce embeddings to this many dimensions (unset: keep the model's output).
+    dimensions = os.getenv("EMBEDDING_DIMENSIONS")
+    return int(dimensions) if dimensions else None
+
+
+def get_embedding_half_precision() -> bool:
+    # Index and search embeddings as pgvector halfvec (requires pgvector >= 0.7).
+    return os.getenv("EMBEDDING_HALF_PRECISION") == "1"
+
+
+def get_document_collection_name() -> str:
+    # Compact embeddings live in their own collection, so they are never
+    # compared against full precision ones.
+    collection = DOCUMENT_COLLECTION_NAME
+    dimensions = get_embedding_dimensions()
+    if dimensions:
+        collection = f"{collection}_d{dimensions}"
+    if get_embedding_half_precision():
+        collection = f"{collection}_half"
+    return collection
+
+
+def get_find_relevant_tables_max_tokens() -> int:
+    # Token budget for the tables returned by find_relevant_tables, to keep
+    # responses well within ChatGPT's context window.
+    return int(os.getenv("FIND_RELEVANT_TABLES_MAX_TOKENS", "4000"))
+
+
+def get_search_backend() -> str:
+    # "pgvector" searches the database directly, "memory" searches an in-process
+    # memory-mapped snapshot of the embeddings (see memory_index.py)
+    return os.getenv("SEARCH_BACKEND", "pgvector")
+
+
+def get_cache_backend() -> str:
+    # Shared cache of embeddings and find_relevant_tables responses:
+    # "postgres" (all workers on all hosts), "local" (workers on the same host,
+    # see cache.py) or "none"
+    return os.getenv("CACHE_BACKEND", "none")
+
+
+def get_graphql_api_url() -> str:
+    # Can point the indexer (and server) at a stand-in GraphQL API, eg. in tests.
+    return os.getenv("GRAPHQL_API_URL", GRAPHQL_API_URL)
+
+
+def get_profile_sample_rate() -> float:
+    # Fraction of requests profiled (see profiling.py), 0 to only profile
+    # requests with an admin X-Profile-Token header.
+    return float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+
+
+def get_profile_admin_token() -> Optional[str]:
+    # Enables the X-Profile-Token header, GET /profiles and GET /metrics.
+    return os.getenv("PROFILE_ADMIN_TOKEN") or None
+
+
+def get_memory_index_dir() -> str:
+    # Should be shared by all workers on a host, so they map the same files.
+    return os.getenv("MEMORY_INDEX_DIR") or os.path.join(
+        tempfile.gettempdir(), "splitgraph_chatgpt_plugin_index"
+    )
+
+
 DOCUMENT_COLLECTION_NAME = "repository_embeddings"
 SPLITGRAPH_WWW_URL_PREFIX = "https://www.splitgraph.com/"
+GRAPHQL_API_URL = "https://api.splitgraph.com/gql/cloud/unified/graphql"
 PLUGIN_DOMAIN = "chatgpt.splitgraph.io"
 GOOGLE_AUTH_FLOW_COMPLETE_PATH = "/auth/oauth/complete/google"
 JWT_ACCESS_TOKEN_LIFETIME_SECONDS = 60 * 60 * 24 * 7  # 1 week
 JWT_REFRESH_TOKEN_LIFETIME_SECONDS = 60 * 60 * 24 * 365  # 1 year
+# Schema snapshots stored by the indexer which are older than this are
+# ignored in favor of fetching the schema from the GraphQL API.
+SCHEMA_SNAPSHOT_MAX_AGE_SECONDS = 60 * 60 * 24 * 2  # 2 days
+# Number of chunks find_relevant_tables uses to rank tables by relevance. Only
+# the repositories of the top 4 chunks are returned.
+FIND_RELEVANT_TABLES_RESULT_LIMIT = 20
+# Time allowed for answering a plugin API request, including all upstream calls.
+REQUEST_DEADLINE_SECONDS = 30
+# Timeouts of individual upstream calls (also capped by the request deadline).
+UPSTREAM_CONNECT_TIMEOUT_SECONDS = 3.05
+GRAPHQL_TIMEOUT_SECONDS = 10
+# Timeout of the indexer's GraphQL requests, which fetch whole pages of
+# repositories with their READMEs and tables.
+GRAPHQL_PAGE_TIMEOUT_SECONDS = 120
+DDN_TIMEOUT_SECONDS = 25
+GOOGLE_OAUTH_TIMEOUT_SECONDS = 10
+OPENAI_TIMEOUT_SECONDS = 10
+# Retries of the embedding request made for each find_relevant_tables prompt
+# (the indexer keeps langchain's default).
+OPENAI_QUERY_MAX_RETRIES = 1
+# Timeout of the indexer's embedding requests, which embed batches of up to
+# 1000 documents and 290k tokens.
+OPENAI_BATCH_TIMEOUT_SECONDS = 300
+# A second GraphQL request is sent if the first hasn't completed by then.
+GRAPHQL_HEDGE_AFTER_SECONDS = 1.5
+# Consecutive failures after which calls to an upstream fail immediately, and
+# for how long.
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_RESET_SECONDS = 30
+# Admission control (per worker) of the DDN queries made by run_sql and of the
+# OpenAI embedding requests made by find_relevant_tables, keyed by user.
+RUN_SQL_MAX_CONCURRENCY = 8
+RUN_SQL_MAX_CONCURRENCY_PER_USER = 2
+RUN_SQL_MAX_QUEUE = 32
+RUN_SQL_MAX_QUEUE_PER_USER = 4
+EMBEDDING_MAX_CONCURRENCY = 16
+EMBEDDING_MAX_CONCURRENCY_PER_USER = 4
+EMBEDDING_MAX_QUEUE = 64
+EMBEDDING_MAX_QUEUE_PER_USER = 8
+# Requests waiting longer than this for a slot get a 429 response.
+ADMISSION_MAX_WAIT_SECONDS = 10
+# Shared cache TTLs. Cached find_relevant_tables responses are also
+# invalidated when the indexer bumps the collection's version, which is
+# checked at most every CACHE_VERSION_CHECK_SECONDS.
+EMBEDDING_CACHE_TTL_SECONDS = 60 * 60 * 24 * 7  # 1 week
+FIND_RELEVANT_TABLES_CACHE_TTL_SECONDS = 60 * 60  # 1 hour
+CACHE_VERSION_CHECK_SECONDS = 10
+# Maximum number of prompts or queries in a single batch request.
+BATCH_MAX_ITEMS = 10
+# Interval between stack samples of profiled requests.
+PROFILE_SAMPLE_INTERVAL_SECONDS = 0.005
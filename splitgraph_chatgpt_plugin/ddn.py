@@ -1,20 +1,31 @@
 # based on: https://python.langchain.com/en/latest/modules/chains/examples/sqlite.html
 import json
-from typing import Any, Dict, List, Tuple
-import requests
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from pydantic import parse_obj_as
 
-from .config import SPLITGRAPH_WWW_URL_PREFIX
+from .config import (
+    DDN_TIMEOUT_SECONDS,
+    GRAPHQL_HEDGE_AFTER_SECONDS,
+    GRAPHQL_PAGE_TIMEOUT_SECONDS,
+    GRAPHQL_TIMEOUT_SECONDS,
+    SCHEMA_SNAPSHOT_MAX_AGE_SECONDS,
+    SPLITGRAPH_WWW_URL_PREFIX,
+    get_graphql_api_url,
+)
 
 from .models import (
     DDNResponse,
     DDNResponseFailure,
     RepositoryInfo,
+    RepositorySchema,
     RunSQLResponse,
     TableColumn,
     TableInfo,
 )
-import itertools
+from .sql_validation import SchemaLookup, validate_sql
+from .summary import summarize_result
+from .upstream import UpstreamError, has_deadline, hedged, post
 import urllib.parse
 
 
@@ -27,15 +38,22 @@ import urllib.parse
 # The currents solution is to mock out the inspect() function to return a
 # SplitgraphInspector instance
 
-GRAPHQL_API_URL = "https://api.splitgraph.com/gql/cloud/unified/graphql"
+# Number of repositories (with READMEs and table schemas) fetched per
+# GetNamespaceRepos request.
+REPOSITORY_PAGE_SIZE = 20
+
 SPLITGRAPH_DDN_URL = "https://data.splitgraph.com/sql/query/ddn"
 
 GRAPHQL_QUERIES = {
     "GetNamespaceRepos": """
-query GetNamespaceRepos($namespace: String!) {
+query GetNamespaceRepos($namespace: String!, $first: Int!, $after: Cursor) {
   namespace(namespace: $namespace) {
     namespace
-    repositoriesByNamespace {
+    repositoriesByNamespace(first: $first, after: $after) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
       nodes {
         repository
         namespace
@@ -54,6 +72,41 @@ query GetNamespaceRepos($namespace: String!) {
     }
   }
 }
+""",
+    # Oldest changes first, so the indexer's watermark only moves forward.
+    "GetNamespaceReposUpdatedSince": """
+query GetNamespaceReposUpdatedSince($namespace: String!, $since: Datetime!, $first: Int!, $after: Cursor) {
+  namespace(namespace: $namespace) {
+    namespace
+    repositoriesByNamespace(
+      first: $first
+      after: $after
+      filter: {updatedAt: {greaterThanOrEqualTo: $since}}
+      orderBy: [UPDATED_AT_ASC, REPOSITORY_ASC]
+    ) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {
+        repository
+        namespace
+        updatedAt
+        externalMetadata
+        repoProfileByNamespaceAndRepository {
+          readme
+          metadata
+        }
+        latestTables {
+          nodes {
+            tableName
+            tableSchema
+          }
+        }
+      }
+    }
+  }
+}
 """,
     "GetRepoTables": """
 query GetRepoTables($namespace: String!, $repository: String!) {
@@ -70,23 +123,43 @@ query GetRepoTables($namespace: String!, $repository: String!) {
 }
 
 
+# Queries made while answering plugin API requests. The others page through
+# namespaces for the indexer.
+REQUEST_PATH_QUERIES = {"GetRepoTables"}
+
+
 def graphql_request(operation: str, variables: Dict[Any, Any]) -> Any:
-    return requests.post(
-        GRAPHQL_API_URL,
-        headers={
-            "Accept-Encoding": "gzip, deflate, br",
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Origin": "https://api.splitgraph.com",
-        },
-        data=json.dumps(
-            {
-                "operationName": operation,
-                "query": GRAPHQL_QUERIES[operation],
-                "variables": variables,
-            }
-        ),
-    ).json()
+    def request(timeout: float) -> Any:
+        response = post(
+            "graphql",
+            get_graphql_api_url(),
+            timeout,
+            headers={
+                "Accept-Encoding": "gzip, deflate, br",
+                "Content-Type": "application/json",
+                "Accept": "application/json",
+                "Origin": "https://api.splitgraph.com",
+            },
+            data=json.dumps(
+                {
+                    "operationName": operation,
+                    "query": GRAPHQL_QUERIES[operation],
+                    "variables": variables,
+                }
+            ),
+        )
+        if response.status_code >= 500:
+            raise UpstreamError(f"graphql returned HTTP {response.status_code}")
+        return response.json()
+
+    # All GRAPHQL_QUERIES are reads, so slow or failed requests made while
+    # answering a plugin request can safely be sent again. The indexer's large
+    # pages get a longer timeout instead, and aren't duplicated.
+    if operation in REQUEST_PATH_QUERIES or has_deadline():
+        return hedged(
+            lambda: request(GRAPHQL_TIMEOUT_SECONDS), GRAPHQL_HEDGE_AFTER_SECONDS
+        )
+    return request(GRAPHQL_PAGE_TIMEOUT_SECONDS)
 
 
 def parse_table_column(graphql_table_column: Any) -> TableColumn:
@@ -98,28 +171,66 @@ def parse_table_column(graphql_table_column: Any) -> TableColumn:
     )
 
 
-def get_repo_list(namespace: str) -> List[RepositoryInfo]:
-    response = graphql_request("GetNamespaceRepos", {"namespace": namespace})
-    if response["data"]["namespace"] is None:
-        # the namespace has been removed
-        return []
-    return [
-        RepositoryInfo(
-            namespace=namespace,
-            repository=repo["repository"],
-            readme=repo["repoProfileByNamespaceAndRepository"]["readme"],
-            tables=[
-                TableInfo(
-                    name=table["tableName"],
-                    columns=[
-                        parse_table_column(column) for column in table["tableSchema"]
-                    ],
-                )
-                for table in repo["latestTables"]["nodes"]
-            ],
+def parse_repository_info(namespace: str, repo: Any) -> RepositoryInfo:
+    return RepositoryInfo(
+        namespace=namespace,
+        repository=repo["repository"],
+        readme=repo["repoProfileByNamespaceAndRepository"]["readme"],
+        tables=[
+            TableInfo(
+                name=table["tableName"],
+                columns=[parse_table_column(column) for column in table["tableSchema"]],
+            )
+            for table in repo["latestTables"]["nodes"]
+        ],
+        updated_at=repo.get("updatedAt"),
+    )
+
+
+def _get_namespace_repos(
+    operation: str, namespace: str, variables: Dict[str, Any], page_size: int
+) -> Iterator[RepositoryInfo]:
+    # Pages through the namespace's repositories, yielding them as each page
+    # arrives so callers never hold the whole namespace in memory.
+    cursor = None
+    while True:
+        response = graphql_request(
+            operation,
+            {
+                **variables,
+                "namespace": namespace,
+                "first": page_size,
+                "after": cursor,
+            },
         )
-        for repo in response["data"]["namespace"]["repositoriesByNamespace"]["nodes"]
-    ]
+        if response["data"]["namespace"] is None:
+            # the namespace has been removed
+            return
+        repositories = response["data"]["namespace"]["repositoriesByNamespace"]
+        for repo in repositories["nodes"]:
+            yield parse_repository_info(namespace, repo)
+        if not repositories["pageInfo"]["hasNextPage"]:
+            return
+        cursor = repositories["pageInfo"]["endCursor"]
+
+
+def get_repo_list(
+    namespace: str, page_size: int = REPOSITORY_PAGE_SIZE
+) -> Iterator[RepositoryInfo]:
+    return _get_namespace_repos("GetNamespaceRepos", namespace, {}, page_size)
+
+
+def get_updated_repo_list(
+    namespace: str, since: datetime, page_size: int = REPOSITORY_PAGE_SIZE
+) -> Iterator[RepositoryInfo]:
+    # Repositories changed at or after `since`, least recently updated first,
+    # with updated_at set.
+    return _get_namespace_repos(
+        "GetNamespaceReposUpdatedSince",
+        namespace,
+        {"since": since.isoformat()},
+        page_size,
+    )
 
 
 def get_repo_tables(
@@ -134,7 +245,9 @@ def get_repo_tables(
         return []
     return [
         TableInfo(
-            name=f'"{namespace}/{repository}"."{table["tableName"]}"'
+            name=get_fully_qualified_table_name(
+                namespace, repository, table["tableName"]
+            )
             if use_fully_qualified_table_names
             else table["tableName"],
             columns=[parse_table_column(column) for column in table["tableSchema"]],
@@ -143,14 +256,27 @@ def get_repo_tables(
     ]
 
 
+def get_fully_qualified_table_name(namespace: str, repository: str, table: str) -> str:
+    return f'"{namespace}/{repository}"."{table}"'
+
+
+def is_schema_snapshot_fresh(
+    schema: RepositorySchema, now: Optional[datetime] = None
+) -> bool:
+    now = now or datetime.now(tz=timezone.utc)
+    return now - schema.updated_at < timedelta(seconds=SCHEMA_SNAPSHOT_MAX_AGE_SECONDS)
+
+
 DDN_ERROR_PREFIX = "error: "
 
 
 def ddn_query(sql) -> DDNResponse:
     parsed_response: DDNResponse = parse_obj_as(
         DDNResponse,  # type: ignore
-        requests.post(
+        post(
+            "ddn",
             SPLITGRAPH_DDN_URL,
+            DDN_TIMEOUT_SECONDS,
             headers={
                 "Accept-Encoding": "gzip, deflate, br",
                 "Content-Type": "application/json",
@@ -167,29 +293,101 @@ def ddn_query(sql) -> DDNResponse:
     return parsed_response
 
 
+def get_snapshot_repo_tables(
+    namespace: str,
+    repository: str,
+    schema: RepositorySchema,
+    use_fully_qualified_table_names=False,
+) -> List[TableInfo]:
+    return [
+        TableInfo(
+            name=get_fully_qualified_table_name(namespace, repository, table.name)
+            if use_fully_qualified_table_names
+            else table.name,
+            columns=table.columns,
+        )
+        for table in schema.tables
+    ]
+
+
 def get_table_infos(
-    repositories: List[Tuple[str, str]], use_fully_qualified_table_names=False
+    repositories: List[Tuple[str, str]],
+    use_fully_qualified_table_names=False,
+    schemas: Optional[Dict[Tuple[str, str], RepositorySchema]] = None,
 ) -> List[TableInfo]:
-    return list(
-        itertools.chain(
-            *[
+    # Schema snapshots stored by the indexer are used when available and
+    # fresh, otherwise the tables are fetched from the GraphQL API.
+    schemas = schemas or {}
+    table_infos: List[TableInfo] = []
+    for namespace, repository in repositories:
+        schema = schemas.get((namespace, repository))
+        if schema is not None and is_schema_snapshot_fresh(schema):
+            table_infos.extend(
+                get_snapshot_repo_tables(
+                    namespace, repository, schema, use_fully_qualified_table_names
+                )
+            )
+        else:
+            table_infos.extend(
                 get_repo_tables(namespace, repository, use_fully_qualified_table_names)
-                for namespace, repository in repositories
-            ]
-        )
-    )
+            )
+    return table_infos
+
+
+def get_fresh_schema_tables(
+    schemas: Dict[Tuple[str, str], RepositorySchema],
+) -> Dict[Tuple[str, str], List[TableInfo]]:
+    # Only fresh snapshots are trusted for rejecting queries.
+    return {
+        key: schema.tables
+        for key, schema in schemas.items()
+        if is_schema_snapshot_fresh(schema)
+    }
+
+
+def get_live_schema_tables(
+    repositories: List[Tuple[str, str]],
+) -> Dict[Tuple[str, str], List[TableInfo]]:
+    # Current tables from the GraphQL API, for repositories whose snapshot may
+    # predate the tables or columns a query uses. Those which can't be fetched
+    # are left out, so that their queries are let through.
+    tables: Dict[Tuple[str, str], List[TableInfo]] = {}
+    for namespace, repository in repositories:
+        try:
+            tables[(namespace, repository)] = get_repo_tables(namespace, repository)
+        except UpstreamError as e:
+            print(f"Failed to fetch tables of {namespace}/{repository}: {e}")
+    return tables
 
 
 def get_query_editor_url(sql: str) -> str:
     return f"{SPLITGRAPH_WWW_URL_PREFIX}query?sqlQuery={urllib.parse.quote_plus(sql)}"
 
 
-def run_sql(query: str) -> RunSQLResponse:
+def run_sql(
+    query: str,
+    lookup_schemas: Optional[SchemaLookup] = None,
+    summarize: bool = False,
+) -> RunSQLResponse:
+    # Queries referencing tables or columns which certainly don't exist are
+    # rejected without a round trip to the DDN.
+    error = (
+        validate_sql(query, lookup_schemas, get_live_schema_tables)
+        if lookup_schemas
+        else None
+    )
+    if error is not None:
+        return RunSQLResponse(error=error, query_editor_url=get_query_editor_url(query))
     ddn_response = ddn_query(query)
     if isinstance(ddn_response, DDNResponseFailure):
         return RunSQLResponse(
             error=ddn_response.error, query_editor_url=get_query_editor_url(query)
         )
+    if summarize:
+        return RunSQLResponse(
+            summary=summarize_result(ddn_response.rows, ddn_response.fields),
+            query_editor_url=get_query_editor_url(query),
+        )
     return RunSQLResponse(
         rows=ddn_response.rows, query_editor_url=get_query_editor_url(query)
     )
@@ -1,28 +1,75 @@
 # from: https://python.langchain.com/en/latest/modules/indexes/vectorstores/examples/pgvector.html
-import sys
-from io import StringIO
-from typing import List
-from langchain.text_splitter import CharacterTextSplitter
+import argparse
+import os
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from itertools import islice
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 from langchain.docstore.document import Document
-from more_itertools import chunked
-
-
-# from: https://python.langchain.com/en/latest/modules/indexes/document_loaders/examples/markdown.html
-from langchain.document_loaders import UnstructuredFileIOLoader
+from langchain.vectorstores import VectorStore
 import sqlalchemy
 
-from unstructured.__version__ import __version__ as __unstructured_version__  # type: ignore
-from unstructured.partition.md import partition_md  # type: ignore
-from splitgraph_chatgpt_plugin.config import DOCUMENT_COLLECTION_NAME
+from splitgraph_chatgpt_plugin.config import (
+    get_document_collection_name,
+    get_embedding_dimensions,
+    get_embedding_half_precision,
+)
 
-from .persistence import connect, get_embedding_store_pgvector
-from .ddn import get_repo_list, RepositoryInfo
-from .markdown import repository_info_to_markdown
+from .checkpoint import (
+    clear_progress,
+    create_progress_table,
+    create_watermark_table,
+    get_completed_repositories,
+    get_watermark,
+    mark_repository_completed,
+    set_watermark,
+    try_lock_namespace,
+    unlock_all_namespaces,
+    unlock_namespace,
+)
+from .persistence import (
+    bump_collection_version,
+    connect,
+    get_embedding_store_pgvector,
+    save_repository_schema,
+)
+from .ddn import get_repo_list, get_updated_repo_list, RepositoryInfo
+from .models import TableInfo
+from .chunking import count_tokens, get_encoding, repository_info_to_chunks
 from .config import get_db_connection_string, get_openai_api_key
 from contextlib import closing
 
-EMBEDDING_CHUNK_SIZE = 50
-DOCUMENT_CHUNK_BYTES = 1000
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Per-request limits of OpenAI's embeddings endpoint are 2048 inputs and
+# 300k tokens summed over all inputs. langchain's OpenAIEmbeddings sends at
+# most 1000 inputs per request, so a batch within both limits is one API call.
+EMBEDDING_BATCH_MAX_DOCUMENTS = 1000
+EMBEDDING_BATCH_MAX_TOKENS = 290_000
+# text-embedding-ada-002 pricing, in USD
+EMBEDDING_PRICE_PER_1K_TOKENS = 0.0001
+# How often --watch polls the GraphQL API for updated repositories.
+WATCH_INTERVAL_SECONDS = 300
+# Watermark of namespaces the change-driven indexer hasn't seen yet, so their
+# first poll indexes every repository.
+INITIAL_WATERMARK = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# Repositories updated this long before the watermark are fetched again, in
+# case their update was committed after a later one had been seen.
+WATERMARK_OVERLAP = timedelta(minutes=5)
 
 DELETE_OLD_EMBEDDINGS_QUERY = """
     DELETE FROM langchain_pg_embedding
@@ -33,75 +80,469 @@ DELETE_OLD_EMBEDDINGS_QUERY = """
     """
 
 
-# Based on UnstructuredMarkdownLoader
-class UnstructuredMarkdownIOLoader(UnstructuredFileIOLoader):
-    """Loader that uses unstructured to load markdown files."""
+def remove_old_embeddings(
+    connection: sqlalchemy.engine.Connection,
+    collection: str,
+    namespace: str,
+    repository: str,
+) -> None:
+    stmt = sqlalchemy.text(DELETE_OLD_EMBEDDINGS_QUERY)
+    stmt = stmt.bindparams(
+        collection=collection,
+        namespace=namespace,
+        repository=repository,
+    )
+    connection.execute(stmt)
+    connection.commit()
 
-    def _get_elements(self) -> List:
-        _unstructured_version = __unstructured_version__.split("-")[0]
-        unstructured_version = tuple([int(x) for x in _unstructured_version.split(".")])
 
-        if unstructured_version < (0, 4, 16):
-            raise ValueError(
-                f"You are on unstructured version {__unstructured_version__}. "
-                "Partitioning markdown files is only supported in unstructured>=0.4.16."
+def prepare_repository_info_documents(
+    repository_info: RepositoryInfo,
+) -> List[Document]:
+    return repository_info_to_chunks(repository_info)
+
+
+def read_namespaces(namespaces: List[str], namespaces_file: Optional[str]) -> List[str]:
+    result = list(namespaces)
+    if namespaces_file:
+        with open(namespaces_file) as f:
+            result.extend(
+                line.strip() for line in f if line.strip() and not line.startswith("#")
             )
+    return result
 
-        return partition_md(file=self.file, **self.unstructured_kwargs)
 
+def imap_bounded(
+    executor: Executor,
+    fn: Callable[[T], R],
+    iterable: Iterable[T],
+    max_pending: int,
+) -> Iterator[R]:
+    # Like executor.map(), but only keeps max_pending tasks in flight instead of
+    # consuming the whole input up front. Results are yielded in input order.
+    pending: Deque[Future[R]] = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
-def remove_old_embeddings(
-    connection: sqlalchemy.engine.Connection, collection: str, docs: List[Document]
+
+class PreparedRepository(NamedTuple):
+    repository: str
+    tables: List[TableInfo]
+    documents: List[Document]
+    token_counts: List[int]
+
+
+class EmbeddingBatch(NamedTuple):
+    documents: List[Document]
+    tokens: int
+    # repositories with no documents left to embed once this batch is written
+    completed_repositories: List[str]
+
+
+class IndexingEstimate(NamedTuple):
+    repositories: int
+    documents: int
+    tokens: int
+    api_calls: int
+
+
+def _prepare_repository(repository_info: RepositoryInfo) -> PreparedRepository:
+    documents = prepare_repository_info_documents(repository_info)
+    encoding = get_encoding()
+    return PreparedRepository(
+        repository_info.repository,
+        repository_info.tables,
+        documents,
+        [count_tokens(d.page_content, encoding) for d in documents],
+    )
+
+
+def prepare_namespace_documents(
+    executor: Executor,
+    repo_list: Iterable[RepositoryInfo],
+    namespace: str,
+    max_pending: int,
+) -> Iterator[PreparedRepository]:
+    # Chunking (and the tokenization it involves) is CPU-bound, so it's fanned out
+    # across the process pool while repositories are still being fetched.
+    document_count = 0
+    for index, prepared in enumerate(
+        imap_bounded(executor, _prepare_repository, repo_list, max_pending), 1
+    ):
+        document_count += len(prepared.documents)
+        print(f"{namespace}: prepared {index} repositories, {document_count} documents")
+        yield prepared
+
+
+def pack_batches(
+    prepared_repositories: Iterable[PreparedRepository],
+    max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+    max_documents: int = EMBEDDING_BATCH_MAX_DOCUMENTS,
+) -> Iterator[EmbeddingBatch]:
+    """
+    Packs documents into batches of at most max_tokens tokens and max_documents
+    documents, regardless of repository boundaries.
+    """
+    documents: List[Document] = []
+    token_counts: List[int] = []
+    buffered_tokens = 0
+    # (repository, number of buffered documents up to and including its own)
+    buffered_repositories: Deque[Tuple[str, int]] = deque()
+
+    def take_batch() -> EmbeddingBatch:
+        nonlocal documents, token_counts, buffered_tokens
+        count, tokens = 0, 0
+        for token_count in token_counts[:max_documents]:
+            # a batch always takes at least one document
+            if count and tokens + token_count > max_tokens:
+                break
+            tokens += token_count
+            count += 1
+        batch = EmbeddingBatch(documents[:count], tokens, [])
+        documents, token_counts = documents[count:], token_counts[count:]
+        buffered_tokens -= tokens
+        while buffered_repositories and buffered_repositories[0][1] <= count:
+            batch.completed_repositories.append(buffered_repositories.popleft()[0])
+        for i, (repository, end) in enumerate(buffered_repositories):
+            buffered_repositories[i] = (repository, end - count)
+        return batch
+
+    for prepared in prepared_repositories:
+        documents.extend(prepared.documents)
+        token_counts.extend(prepared.token_counts)
+        buffered_tokens += sum(prepared.token_counts)
+        buffered_repositories.append((prepared.repository, len(documents)))
+        while buffered_tokens > max_tokens or len(documents) >= max_documents:
+            yield take_batch()
+    while documents or buffered_repositories:
+        yield take_batch()
+
+
+def index_namespace(
+    connection: sqlalchemy.engine.Connection,
+    vstore: VectorStore,
+    executor: Executor,
+    jobs: int,
+    collection: str,
+    namespace: str,
+    resume: bool = False,
+    repo_index_limit: Optional[int] = None,
 ) -> None:
-    for doc in docs:
-        stmt = sqlalchemy.text(DELETE_OLD_EMBEDDINGS_QUERY)
-        stmt = stmt.bindparams(
-            collection=collection,
-            namespace=doc.metadata["namespace"],
-            repository=doc.metadata["repository"],
+    if not try_lock_namespace(connection, collection, namespace):
+        print(f"Skipping namespace {namespace}: another indexer is working on it")
+        return
+    try:
+        if resume:
+            completed = get_completed_repositories(connection, collection, namespace)
+            print(
+                f"Resuming namespace {namespace}, skipping {len(completed)} completed repositories"
+            )
+        else:
+            clear_progress(connection, collection, namespace)
+            completed = set()
+            print(f"Indexing repositories in namespace {namespace}")
+        repo_list = (
+            repo_info
+            for repo_info in islice(get_repo_list(namespace), repo_index_limit)
+            if repo_info.repository not in completed
         )
-        connection.execute(stmt)
-    connection.commit()
+        embed_namespace_documents(
+            connection,
+            vstore,
+            collection,
+            namespace,
+            prepare_namespace_documents(
+                executor, repo_list, namespace, max_pending=2 * jobs
+            ),
+        )
+        bump_collection_version(connection, collection)
+    finally:
+        unlock_namespace(connection, collection, namespace)
 
 
-def prepare_repository_info_documents(
-    repository_info: RepositoryInfo,
-) -> List[Document]:
-    repository_info_markdown = repository_info_to_markdown(repository_info)
-    loader = UnstructuredMarkdownIOLoader(StringIO(repository_info_markdown))
-    documents = loader.load()
-    # add metadata to documents
-    for d in documents:
-        d.metadata["namespace"] = repository_info.namespace
-        d.metadata["repository"] = repository_info.repository
-    text_splitter = CharacterTextSplitter(
-        chunk_size=DOCUMENT_CHUNK_BYTES, chunk_overlap=0
+def reindex_updated_repositories(
+    connection: sqlalchemy.engine.Connection,
+    vstore: VectorStore,
+    executor: Executor,
+    jobs: int,
+    collection: str,
+    namespace: str,
+    indexed: Optional[Dict[str, datetime]] = None,
+) -> int:
+    """
+    Re-indexes the namespace's repositories updated since its watermark (less
+    WATERMARK_OVERLAP) and moves the watermark up to them. Returns the number
+    of repositories re-indexed.
+
+    `indexed` maps repositories to the updated_at they were last re-indexed
+    at. It's kept up to date, so that the repositories in the overlap are
+    only re-indexed again if they have changed.
+    """
+    if indexed is None:
+        indexed = {}
+    if not try_lock_namespace(connection, collection, namespace):
+        print(f"Skipping namespace {namespace}: another indexer is working on it")
+        return 0
+    count = 0
+    try:
+        since = get_watermark(connection, collection, namespace) or INITIAL_WATERMARK
+        watermark = since
+        updated: Dict[str, datetime] = {}
+
+        def track_updates(
+            repo_list: Iterable[RepositoryInfo],
+        ) -> Iterator[RepositoryInfo]:
+            nonlocal count, watermark
+            for repo_info in repo_list:
+                if repo_info.updated_at is not None:
+                    if indexed.get(repo_info.repository) == repo_info.updated_at:
+                        continue
+                    updated[repo_info.repository] = repo_info.updated_at
+                    watermark = max(watermark, repo_info.updated_at)
+                count += 1
+                yield repo_info
+
+        embed_namespace_documents(
+            connection,
+            vstore,
+            collection,
+            namespace,
+            prepare_namespace_documents(
+                executor,
+                track_updates(
+                    get_updated_repo_list(namespace, since - WATERMARK_OVERLAP)
+                ),
+                namespace,
+                max_pending=2 * jobs,
+            ),
+        )
+        # Only advanced once everything up to it has been written, so an
+        # interrupted run picks the same repositories up again.
+        if watermark > since:
+            set_watermark(connection, collection, namespace, watermark)
+        # Re-indexing is idempotent (old embeddings are replaced), this only
+        # saves embedding the same repositories on every poll.
+        indexed.update(updated)
+        for repository, updated_at in list(indexed.items()):
+            if updated_at < watermark - WATERMARK_OVERLAP:
+                del indexed[repository]
+        print(f"{namespace}: re-indexed {count} repositories updated since {since}")
+        return count
+    finally:
+        # A failed statement aborts the transaction, which would make the
+        # statements below fail too.
+        connection.rollback()
+        try:
+            # Also after a failure, since some repositories may have been replaced.
+            if count:
+                bump_collection_version(connection, collection)
+        finally:
+            unlock_namespace(connection, collection, namespace)
+
+
+def watch_namespaces(
+    connection: sqlalchemy.engine.Connection,
+    vstore: VectorStore,
+    executor: Executor,
+    jobs: int,
+    collection: str,
+    namespaces: List[str],
+    interval: float = WATCH_INTERVAL_SECONDS,
+    max_polls: Optional[int] = None,
+) -> None:
+    # Polls forever (or max_polls times). A failing namespace is retried on the
+    # next poll, from its last watermark.
+    indexed: Dict[str, Dict[str, datetime]] = {
+        namespace: {} for namespace in namespaces
+    }
+    polls = 0
+    while True:
+        for namespace in namespaces:
+            try:
+                reindex_updated_repositories(
+                    connection,
+                    vstore,
+                    executor,
+                    jobs,
+                    collection,
+                    namespace,
+                    indexed[namespace],
+                )
+            except Exception as e:
+                print(f"Failed to re-index namespace {namespace}: {e}")
+                # The connection is kept, so it mustn't keep holding the lock.
+                try:
+                    connection.rollback()
+                    unlock_all_namespaces(connection)
+                except Exception as e:
+                    print(f"Failed to release the lock of namespace {namespace}: {e}")
+        polls += 1
+        if max_polls is not None and polls >= max_polls:
+            return
+        time.sleep(interval)
+
+
+def embed_namespace_documents(
+    connection: sqlalchemy.engine.Connection,
+    vstore: VectorStore,
+    collection: str,
+    namespace: str,
+    prepared_repositories: Iterable[PreparedRepository],
+) -> None:
+    def replace_old(
+        prepared_repositories: Iterable[PreparedRepository],
+    ) -> Iterator[PreparedRepository]:
+        for prepared in prepared_repositories:
+            remove_old_embeddings(
+                connection, collection, namespace, prepared.repository
+            )
+            save_repository_schema(
+                connection, collection, namespace, prepared.repository, prepared.tables
+            )
+            yield prepared
+
+    # A repository is only checkpointed as completed once every one of its
+    # documents has been written.
+    for batch in pack_batches(replace_old(prepared_repositories)):
+        if batch.documents:
+            print(
+                f"Calculating embeddings for {len(batch.documents)} documents, {batch.tokens} tokens"
+            )
+            vstore.add_documents(batch.documents)
+        for repository in batch.completed_repositories:
+            mark_repository_completed(connection, collection, namespace, repository)
+
+
+def estimate_namespace(
+    executor: Executor,
+    jobs: int,
+    namespace: str,
+    repo_index_limit: Optional[int] = None,
+) -> IndexingEstimate:
+    repositories, documents, tokens, api_calls = 0, 0, 0, 0
+    prepared_repositories = prepare_namespace_documents(
+        executor,
+        islice(get_repo_list(namespace), repo_index_limit),
+        namespace,
+        max_pending=2 * jobs,
+    )
+    for batch in pack_batches(prepared_repositories):
+        repositories += len(batch.completed_repositories)
+        documents += len(batch.documents)
+        tokens += batch.tokens
+        api_calls += 1 if batch.documents else 0
+    return IndexingEstimate(repositories, documents, tokens, api_calls)
+
+
+def print_estimate(label: str, estimate: IndexingEstimate) -> None:
+    cost = estimate.tokens / 1000 * EMBEDDING_PRICE_PER_1K_TOKENS
+    print(
+        f"{label}: {estimate.repositories} repositories, {estimate.documents} chunks, "
+        f"{estimate.tokens} tokens, {estimate.api_calls} embedding API calls, "
+        f"estimated cost ${cost:.4f}"
     )
-    return text_splitter.split_documents(documents)
 
 
 def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Index Splitgraph namespaces into the embedding store."
+    )
+    parser.add_argument("namespaces", nargs="*", help="namespaces to index")
+    parser.add_argument(
+        "-f",
+        "--namespaces-file",
+        help="file with one namespace per line (lines starting with # are ignored)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of processes used to prepare documents (default: CPU count)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip repositories completed by a previous (interrupted) run",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only report chunk and token counts and the expected number of "
+        "embedding API calls, without embedding anything",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running, re-indexing repositories as they are updated",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=WATCH_INTERVAL_SECONDS,
+        help="seconds between polls for updated repositories with --watch "
+        f"(default: {WATCH_INTERVAL_SECONDS})",
+    )
+    args = parser.parse_args()
+    namespaces = read_namespaces(args.namespaces, args.namespaces_file)
+    if not namespaces:
+        parser.error("no namespaces given")
+    if args.watch and (args.resume or args.dry_run):
+        parser.error("--watch can't be combined with --resume or --dry-run")
+
     # set repo_index_limit to an integer to only index the first N repos.
     repo_index_limit = None
-    collection = DOCUMENT_COLLECTION_NAME
-    namespace = sys.argv[1]
+    collection = get_document_collection_name()
+    if args.dry_run:
+        totals = IndexingEstimate(0, 0, 0, 0)
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            for namespace in namespaces:
+                estimate = estimate_namespace(
+                    executor, args.jobs, namespace, repo_index_limit
+                )
+                print_estimate(namespace, estimate)
+                totals = IndexingEstimate(*map(sum, zip(totals, estimate)))
+        print_estimate("total", totals)
+        return
     with closing(connect(get_db_connection_string())) as connection:
         vstore = get_embedding_store_pgvector(
-            connection, collection, get_openai_api_key()
-        )
-        print(f"Indexing repositories in namespace {namespace}")
-        repo_list = get_repo_list(namespace)
-        repository_info_documents: List[Document] = []
-        for repo_info in repo_list[0:repo_index_limit]:
-            repository_info_documents.extend(
-                prepare_repository_info_documents(repo_info)
-            )
-        print(
-            f"Calculating embeddings for {len(repository_info_documents)} documents, {EMBEDDING_CHUNK_SIZE} at a time"
+            connection,
+            collection,
+            get_openai_api_key(),
+            dimensions=get_embedding_dimensions(),
+            half_precision=get_embedding_half_precision(),
         )
-        for chunk in chunked(repository_info_documents, EMBEDDING_CHUNK_SIZE):
-            remove_old_embeddings(connection, collection, chunk)
-            vstore.add_documents(chunk)
+        create_progress_table(connection)
+        create_watermark_table(connection)
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            if args.watch:
+                watch_namespaces(
+                    connection,
+                    vstore,
+                    executor,
+                    args.jobs,
+                    collection,
+                    namespaces,
+                    args.interval,
+                )
+                return
+            for index, namespace in enumerate(namespaces, 1):
+                print(f"[{index}/{len(namespaces)}] ", end="")
+                index_namespace(
+                    connection,
+                    vstore,
+                    executor,
+                    args.jobs,
+                    collection,
+                    namespace,
+                    args.resume,
+                    repo_index_limit,
+                )
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -5,24 +5,40 @@ from .models import (
 )
 
 
-REPOSITORY_DESCRIPTION = """
+REPOSITORY_HEADER = """
 # Repository: {namespace}/{repository}
 
+""".lstrip()
+
+README_HEADER = """
 ## description
+""".lstrip()
+
+REPOSITORY_DESCRIPTION = (
+    REPOSITORY_HEADER
+    + README_HEADER
+    + """
 {readme}
 
 ## tables
 {tables}
 """.lstrip()
+)
 
 TABLE_HEADER = """
 ### {tablename}
 """.lstrip()
 
-TABLE_DESCRIPTION = """
+TABLE_COLUMNS_INTRO = """
 The table with the full name "{namespace}/{repository}"."{tablename}" includes the following columns:
+""".lstrip()
+
+TABLE_DESCRIPTION = (
+    TABLE_COLUMNS_INTRO
+    + """
 {columns}
 """.lstrip()
+)
 
 
 def column_info_to_markdown(column_info: TableColumn) -> str:
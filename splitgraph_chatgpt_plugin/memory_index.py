@@ -0,0 +1,283 @@
+import fcntl
+import glob
+import json
+import os
+import threading
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+import numpy as np
+from pgvector.utils import from_db
+import sqlalchemy
+
+from .models import RepositorySchema
+from .persistence import (
+    PGVectorReuseConnection,
+    get_collection_version,
+    get_matching_repositories,
+    get_repository_schemas,
+)
+
+MEMORY_INDEX_REFRESH_SECONDS = 60
+# Rows fetched per query while building a snapshot.
+SNAPSHOT_PAGE_SIZE = 1000
+
+GET_EMBEDDINGS_PAGE_QUERY = """
+    SELECT uuid, embedding::text, cmetadata FROM langchain_pg_embedding
+    WHERE
+        collection_id = (select uuid from langchain_pg_collection where name = :collection) AND
+        (CAST(:after AS uuid) IS NULL OR uuid > CAST(:after AS uuid))
+    ORDER BY uuid
+    LIMIT :limit;
+    """
+
+
+class Snapshot(NamedTuple):
+    version: int
+    # (number of embeddings, dimensions), unit length, memory-mapped
+    embeddings: np.ndarray
+    metadatas: List[dict]
+
+
+def iter_embeddings(
+    connection: sqlalchemy.engine.Connection, collection: str
+) -> Iterator[Tuple[np.ndarray, dict]]:
+    # Keyset pagination rather than one big query, since not all drivers
+    # (eg. pg8000) support server side cursors.
+    after = None
+    while True:
+        stmt = sqlalchemy.text(GET_EMBEDDINGS_PAGE_QUERY).bindparams(
+            collection=collection,
+            after=str(after) if after else None,
+            limit=SNAPSHOT_PAGE_SIZE,
+        )
+        rows = connection.execute(stmt).fetchall()
+        connection.commit()
+        for _, embedding, cmetadata in rows:
+            yield from_db(embedding), cmetadata
+        if len(rows) < SNAPSHOT_PAGE_SIZE:
+            return
+        after = rows[-1][0]
+
+
+def snapshot_paths(directory: str, collection: str, version: int) -> Tuple[str, str]:
+    prefix = os.path.join(directory, f"{collection}-{version}")
+    return f"{prefix}.npy", f"{prefix}.json"
+
+
+def write_snapshot(
+    rows: Iterable[Tuple[np.ndarray, dict]],
+    directory: str,
+    collection: str,
+    version: int,
+) -> None:
+    """
+    Writes embeddings (normalized to unit length) to an .npy file and their
+    metadata to a .json file next to it. Both are written to temporary files
+    first and renamed into place, the .npy file last.
+    """
+    embeddings_path, metadata_path = snapshot_paths(directory, collection, version)
+    raw_path = f"{embeddings_path}.raw"
+    metadatas: List[dict] = []
+    dimensions = 0
+    # The number of rows isn't known up front, so vectors are streamed to a raw
+    # file and only then copied into an .npy file with the right header.
+    with open(raw_path, "wb") as f:
+        for embedding, metadata in rows:
+            embedding = np.asarray(embedding, dtype=np.float32)
+            dimensions = len(embedding)
+            norm = np.linalg.norm(embedding)
+            f.write((embedding / (norm or 1)).tobytes())
+            metadatas.append(metadata)
+    try:
+        embeddings = (
+            np.memmap(
+                raw_path, dtype=np.float32, mode="r", shape=(len(metadatas), dimensions)
+            )
+            if metadatas
+            else np.zeros((0, 0), dtype=np.float32)
+        )
+        with open(f"{metadata_path}.tmp", "w") as f:
+            json.dump(metadatas, f)
+        with open(f"{embeddings_path}.tmp", "wb") as f:
+            np.save(f, embeddings)
+        del embeddings
+        os.replace(f"{metadata_path}.tmp", metadata_path)
+        os.replace(f"{embeddings_path}.tmp", embeddings_path)
+    finally:
+        os.remove(raw_path)
+
+
+def remove_old_snapshots(directory: str, collection: str, version: int) -> None:
+    # Workers still using an old snapshot keep their mapping after removal.
+    current = snapshot_paths(directory, collection, version)
+    for path in glob.glob(os.path.join(glob.escape(directory), f"{collection}-*")):
+        if path not in current and not path.endswith(".raw"):
+            os.remove(path)
+
+
+def build_snapshot(
+    connection: sqlalchemy.engine.Connection,
+    collection: str,
+    version: int,
+    directory: str,
+) -> None:
+    os.makedirs(directory, exist_ok=True)
+    # Workers on the same host share the snapshot directory; the lock makes
+    # sure only the first one to notice a new version builds it, while the
+    # others wait and then load the result.
+    with open(os.path.join(directory, f"{collection}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(snapshot_paths(directory, collection, version)[0]):
+            return
+        write_snapshot(
+            iter_embeddings(connection, collection), directory, collection, version
+        )
+        remove_old_snapshots(directory, collection, version)
+
+
+def load_snapshot(directory: str, collection: str, version: int) -> Snapshot:
+    embeddings_path, metadata_path = snapshot_paths(directory, collection, version)
+    with open(metadata_path) as f:
+        metadatas = json.load(f)
+    # mmap_mode shares the pages between all processes mapping the file
+    return Snapshot(version, np.load(embeddings_path, mmap_mode="r"), metadatas)
+
+
+def search_snapshot(
+    snapshot: Snapshot, embedding: List[float], k: int
+) -> List[Tuple[Document, float]]:
+    k = min(k, len(snapshot.embeddings))
+    if k == 0:
+        return []
+    query = np.asarray(embedding, dtype=np.float32)
+    query = query / (np.linalg.norm(query) or 1)
+    scores = snapshot.embeddings @ query
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    # Returns cosine distances, like PGVector. Chunk texts aren't part of the
+    # snapshot, only their metadata.
+    return [
+        (
+            Document(page_content="", metadata=snapshot.metadatas[i]),
+            1 - float(scores[i]),
+        )
+        for i in top
+    ]
+
+
+class MemoryMappedVectorStore:
+    """
+    Read-only vector store answering similarity searches from an in-process,
+    memory-mapped snapshot of a PGVector collection. The snapshot is refreshed
+    in a background thread whenever the collection's version changes. Searches
+    fall back to the PGVector store until the first snapshot is loaded.
+
+    It wraps the PGVector store rather than being a VectorStore itself, since
+    embeddings can only be added by the indexer.
+    """
+
+    def __init__(
+        self,
+        fallback: PGVectorReuseConnection,
+        connect: Callable[[], sqlalchemy.engine.Connection],
+        directory: str,
+        refresh_seconds: float = MEMORY_INDEX_REFRESH_SECONDS,
+    ):
+        self.fallback = fallback
+        self.embedding_function: Embeddings = fallback.embedding_function
+        self.collection = fallback.collection_name
+        self.directory = directory
+        self.refresh_seconds = refresh_seconds
+        self._connect = connect
+        # Only used by the refresh thread, so it's never shared across threads.
+        self._connection: Optional[sqlalchemy.engine.Connection] = None
+        self._snapshot: Optional[Snapshot] = None
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def refresh(self) -> None:
+        if self._connection is None:
+            self._connection = self._connect()
+        try:
+            version = get_collection_version(self._connection, self.collection)
+            if self._snapshot is not None and self._snapshot.version == version:
+                return
+            build_snapshot(self._connection, self.collection, version, self.directory)
+        except Exception:
+            self._connection.close()
+            self._connection = None
+            raise
+        self._snapshot = load_snapshot(self.directory, self.collection, version)
+        print(
+            f"Loaded {len(self._snapshot.metadatas)} embeddings of {self.collection} version {version}"
+        )
+
+    def _refresh_loop(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                import traceback
+
+                print(traceback.format_exc())
+            self._stopped.wait(self.refresh_seconds)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._refresh_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Optional[dict] = None
+    ) -> List[Tuple[Document, float]]:
+        snapshot = self._snapshot
+        if snapshot is None or filter is not None:
+            return self.fallback.similarity_search_with_score(query, k, filter)
+        return search_snapshot(snapshot, self.embedding_function.embed_query(query), k)
+
+    def similarity_search_with_schemas(
+        self,
+        query: str,
+        k: int = 4,
+        embedding: Optional[List[float]] = None,
+        schema_limit: Optional[int] = None,
+    ) -> Tuple[List[Tuple[Document, float]], Dict[Tuple[str, str], RepositorySchema]]:
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self.fallback.similarity_search_with_schemas(
+                query, k, embedding, schema_limit
+            )
+        if embedding is None:
+            embedding = self.embedding_function.embed_query(query)
+        results = search_snapshot(snapshot, embedding, k)
+        # Schemas aren't part of the snapshot; they're fetched in one query
+        # for the repositories of the top schema_limit matches.
+        return results, get_repository_schemas(
+            self.fallback._conn,
+            self.collection,
+            get_matching_repositories(results[:schema_limit]),
+        )
+
+    def similarity_search(
+        self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any
+    ) -> List[Document]:
+        return [d for d, _ in self.similarity_search_with_score(query, k, filter)]
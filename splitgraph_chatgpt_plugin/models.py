@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import Annotated, Any, Dict, List, Literal, Optional, Union
 from pydantic import BaseModel, Field
 
@@ -19,6 +20,14 @@ class RepositoryInfo(BaseModel):
     repository: str
     tables: List[TableInfo]
     readme: str
+    # when the repository was last changed, if requested from the GraphQL API
+    updated_at: Optional[datetime] = None
+
+
+class RepositorySchema(BaseModel):
+    # snapshot of a repository's tables, as stored by the indexer
+    tables: List[TableInfo]
+    updated_at: datetime
 
 
 class DDNResponseField(BaseModel):
@@ -53,10 +62,66 @@ DDNResponse = Annotated[
 
 
 class FindRelevantTablesResponse(BaseModel):
+    # most relevant first
     tables: List[TableInfo]
+    # names of less relevant tables whose columns didn't fit in the response
+    other_tables: List[str] = []
+    # whether tables were left out or listed without their columns
+    truncated: bool = False
+
+
+class ValueCount(BaseModel):
+    value: Any
+    count: int
+
+
+class ColumnSummary(BaseModel):
+    name: str
+    type: str
+    # number of non-null values
+    count: int
+    nulls: int
+    # only set for the types they apply to
+    min: Optional[Any] = None
+    max: Optional[Any] = None
+    mean: Optional[float] = None
+    top_values: Optional[List[ValueCount]] = None
+
+
+class ResultSummary(BaseModel):
+    row_count: int
+    columns: List[ColumnSummary]
+    sample_rows: List[Dict[str, Any]]
 
 
 class RunSQLResponse(BaseModel):
     error: Optional[str] = None
     rows: Optional[List[Any]] = None
+    # returned instead of rows in summary mode
+    summary: Optional[ResultSummary] = None
     query_editor_url: str
+
+
+class FindRelevantTablesBatchRequest(BaseModel):
+    prompts: List[str]
+
+
+class FindRelevantTablesBatchResult(BaseModel):
+    # either a response or an error
+    response: Optional[FindRelevantTablesResponse] = None
+    error: Optional[str] = None
+
+
+class FindRelevantTablesBatchResponse(BaseModel):
+    # in the order of the request's prompts
+    results: List[FindRelevantTablesBatchResult]
+
+
+class RunSQLBatchRequest(BaseModel):
+    queries: List[str]
+    summarize: bool = False
+
+
+class RunSQLBatchResponse(BaseModel):
+    # in the order of the request's queries
+    results: List[RunSQLResponse]
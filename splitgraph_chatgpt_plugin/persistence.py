@@ -1,21 +1,339 @@
+from io import BytesIO
+import json
 from math import ceil, sqrt
-from typing import List, Optional, Tuple
+import struct
+from functools import partial
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Protocol, Tuple
+import uuid
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
 from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.vectorstores import VectorStore
 from langchain.vectorstores import PGVector
 from langchain.vectorstores.pgvector import DistanceStrategy
+from pgvector.utils import to_db
 import sqlalchemy
 from sqlalchemy.orm import Session
 
+from .compact import OPENAI_EMBEDDING_DIMENSIONS, ProjectedEmbeddings
+from .config import OPENAI_BATCH_TIMEOUT_SECONDS
+from .models import RepositorySchema, TableInfo
+from .upstream import guarded_call
+
 CLOUDSQL_PG_CONN_STR = "postgresql+pg8000://"
 
+# Column order used by both bulk write paths. Matches the langchain_pg_embedding
+# table created by langchain's PGVector, so the search side is unaffected.
+EMBEDDING_COLUMNS = (
+    "uuid",
+    "collection_id",
+    "embedding",
+    "document",
+    "cmetadata",
+    "custom_id",
+)
+
+COPY_EMBEDDINGS_QUERY = (
+    "COPY langchain_pg_embedding ({}) FROM STDIN WITH (FORMAT binary)".format(
+        ", ".join(EMBEDDING_COLUMNS)
+    )
+)
+
+CREATE_HALFVEC_INDEX_QUERY = """
+    CREATE INDEX IF NOT EXISTS {index_name}
+    ON langchain_pg_embedding
+    USING ivfflat ((embedding::halfvec({dimensions})) halfvec_cosine_ops)
+    WITH (lists = {lists})
+    WHERE collection_id = '{collection_id}';
+    """
+
+# The ORDER BY expression must match the index expression for the index to be used.
+HALFVEC_DISTANCE = (
+    "embedding::halfvec({dimensions}) <=> CAST(:embedding AS halfvec({dimensions}))"
+)
+VECTOR_DISTANCE = "embedding <=> CAST(:embedding AS vector)"
+
+# The collection id is a literal rather than a parameter, so that the planner
+# can match it to the predicate of the (partial) halfvec index even with a
+# generic plan.
+SEARCH_QUERY = """
+    SELECT document, cmetadata, {distance} AS distance
+    FROM langchain_pg_embedding
+    WHERE collection_id = '{collection_id}'
+    ORDER BY distance
+    LIMIT :k;
+    """
+
+# Vector search and schema snapshot lookup in a single round trip. The matches
+# come first, followed by one row per distinct repository with a snapshot among
+# the top :schema_limit matches (with a NULL cmetadata), so that each snapshot
+# is only sent once however many of its chunks match.
+SEARCH_WITH_SCHEMAS_QUERY = """
+    WITH matches AS (
+        SELECT cmetadata, {distance} AS distance
+        FROM langchain_pg_embedding
+        WHERE collection_id = '{collection_id}'
+        ORDER BY distance
+        LIMIT :k
+    )
+    SELECT
+        cmetadata,
+        distance,
+        NULL::text AS namespace,
+        NULL::text AS repository,
+        NULL::json AS tables,
+        NULL::timestamptz AS updated_at
+    FROM matches
+    UNION ALL
+    SELECT NULL, NULL, namespace, repository, tables, updated_at
+    FROM repository_schema
+    WHERE collection = :collection AND (namespace, repository) IN (
+        SELECT DISTINCT cmetadata->>'namespace', cmetadata->>'repository'
+        FROM (SELECT cmetadata FROM matches ORDER BY distance LIMIT :schema_limit) AS top
+    )
+    ORDER BY distance NULLS LAST;
+    """
+
+CREATE_REPOSITORY_SCHEMA_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS repository_schema (
+        collection TEXT NOT NULL,
+        namespace TEXT NOT NULL,
+        repository TEXT NOT NULL,
+        tables JSON NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (collection, namespace, repository)
+    );
+    """
+
+SAVE_REPOSITORY_SCHEMA_QUERY = """
+    INSERT INTO repository_schema (collection, namespace, repository, tables)
+    VALUES (:collection, :namespace, :repository, CAST(:tables AS json))
+    ON CONFLICT (collection, namespace, repository)
+    DO UPDATE SET tables = excluded.tables, updated_at = now();
+    """
+
+GET_REPOSITORY_SCHEMAS_QUERY = """
+    SELECT namespace, repository, tables, updated_at FROM repository_schema
+    WHERE collection = :collection AND namespace || '/' || repository = ANY(:repositories);
+    """
+
+CREATE_COLLECTION_VERSION_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS collection_version (
+        collection TEXT PRIMARY KEY,
+        version BIGINT NOT NULL
+    );
+    """
+
+GET_COLLECTION_VERSION_QUERY = """
+    SELECT version FROM collection_version WHERE collection = :collection;
+    """
+
+BUMP_COLLECTION_VERSION_QUERY = """
+    INSERT INTO collection_version (collection, version) VALUES (:collection, 1)
+    ON CONFLICT (collection)
+    DO UPDATE SET version = collection_version.version + 1
+    RETURNING version;
+    """
+
+GET_COLLECTION_UUID_QUERY = """
+    SELECT uuid FROM langchain_pg_collection WHERE name = :collection;
+    """
+
+# see: https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+PGCOPY_TRAILER = struct.pack("!h", -1)
+
+
+def encode_vector_binary(embedding: List[float]) -> bytes:
+    # pgvector's binary format (vector_recv): int16 dimensions, int16 unused,
+    # followed by big-endian float4 values.
+    return struct.pack(f"!hh{len(embedding)}f", len(embedding), 0, *embedding)
+
+
+def _encode_copy_field(value: bytes) -> bytes:
+    return struct.pack("!i", len(value)) + value
+
+
+def encode_embeddings_copy_binary(
+    collection_id: uuid.UUID,
+    texts: Iterable[str],
+    metadatas: List[dict],
+    embeddings: List[List[float]],
+    ids: List[str],
+) -> BytesIO:
+    buffer = BytesIO()
+    buffer.write(PGCOPY_HEADER)
+    field_count = struct.pack("!h", len(EMBEDDING_COLUMNS))
+    for text, metadata, embedding, custom_id in zip(texts, metadatas, embeddings, ids):
+        buffer.write(field_count)
+        buffer.write(_encode_copy_field(uuid.uuid4().bytes))
+        buffer.write(_encode_copy_field(collection_id.bytes))
+        buffer.write(_encode_copy_field(encode_vector_binary(embedding)))
+        buffer.write(_encode_copy_field(text.encode("utf-8")))
+        buffer.write(_encode_copy_field(json.dumps(metadata).encode("utf-8")))
+        buffer.write(_encode_copy_field(custom_id.encode("utf-8")))
+    buffer.write(PGCOPY_TRAILER)
+    buffer.seek(0)
+    return buffer
+
+
+def get_collection_uuid(
+    connection: sqlalchemy.engine.Connection, collection: str
+) -> uuid.UUID:
+    stmt = sqlalchemy.text(GET_COLLECTION_UUID_QUERY).bindparams(collection=collection)
+    collection_id = connection.execute(stmt).scalar()
+    if collection_id is None:
+        raise ValueError("Collection not found")
+    return (
+        collection_id
+        if isinstance(collection_id, uuid.UUID)
+        else uuid.UUID(str(collection_id))
+    )
+
+
+def create_collection_version_table(connection: sqlalchemy.engine.Connection) -> None:
+    connection.execute(sqlalchemy.text(CREATE_COLLECTION_VERSION_TABLE_QUERY))
+    connection.commit()
+
+
+def get_collection_version(
+    connection: sqlalchemy.engine.Connection, collection: str
+) -> int:
+    # Collections which have never been versioned are at version 0.
+    stmt = sqlalchemy.text(GET_COLLECTION_VERSION_QUERY).bindparams(
+        collection=collection
+    )
+    version = connection.execute(stmt).scalar()
+    connection.commit()
+    return version or 0
+
+
+def bump_collection_version(
+    connection: sqlalchemy.engine.Connection, collection: str
+) -> int:
+    # Called by the indexer after changing a collection's embeddings, so that
+    # anything derived from them (eg. in-memory indexes) can be refreshed.
+    stmt = sqlalchemy.text(BUMP_COLLECTION_VERSION_QUERY).bindparams(
+        collection=collection
+    )
+    version = connection.execute(stmt).scalar()
+    connection.commit()
+    return version
+
+
+def create_repository_schema_table(
+    connection: sqlalchemy.engine.Connection,
+) -> None:
+    connection.execute(sqlalchemy.text(CREATE_REPOSITORY_SCHEMA_TABLE_QUERY))
+    connection.commit()
+
+
+def save_repository_schema(
+    connection: sqlalchemy.engine.Connection,
+    collection: str,
+    namespace: str,
+    repository: str,
+    tables: List[TableInfo],
+) -> None:
+    stmt = sqlalchemy.text(SAVE_REPOSITORY_SCHEMA_QUERY).bindparams(
+        collection=collection,
+        namespace=namespace,
+        repository=repository,
+        tables=json.dumps([t.dict() for t in tables]),
+    )
+    connection.execute(stmt)
+    connection.commit()
+
+
+def get_repository_schemas(
+    connection: sqlalchemy.engine.Connection,
+    collection: str,
+    repositories: List[Tuple[str, str]],
+) -> Dict[Tuple[str, str], RepositorySchema]:
+    if not repositories:
+        return {}
+    stmt = sqlalchemy.text(GET_REPOSITORY_SCHEMAS_QUERY).bindparams(
+        collection=collection,
+        repositories=[
+            f"{namespace}/{repository}" for namespace, repository in repositories
+        ],
+    )
+    rows = connection.execute(stmt).fetchall()
+    connection.commit()
+    return {
+        (namespace, repository): RepositorySchema(tables=tables, updated_at=updated_at)
+        for namespace, repository, tables, updated_at in rows
+    }
+
+
+def bulk_insert_embeddings(
+    connection: sqlalchemy.engine.Connection,
+    collection: str,
+    texts: List[str],
+    metadatas: List[dict],
+    embeddings: List[List[float]],
+    ids: List[str],
+) -> None:
+    """
+    Writes embeddings to langchain_pg_embedding in a single round trip.
+
+    Uses binary COPY when the driver supports it (psycopg2, pg8000), falling
+    back to a single multi-row INSERT otherwise.
+    """
+    # Also opens the transaction the raw DBAPI cursor below takes part in.
+    collection_id = get_collection_uuid(connection, collection)
+    driver = connection.dialect.driver
+    if driver in ("psycopg2", "pg8000"):
+        payload = encode_embeddings_copy_binary(
+            collection_id, texts, metadatas, embeddings, ids
+        )
+        cursor = connection.connection.cursor()
+        try:
+            if driver == "psycopg2":
+                cursor.copy_expert(COPY_EMBEDDINGS_QUERY, payload)
+            else:
+                cursor.execute(COPY_EMBEDDINGS_QUERY, stream=payload)
+        finally:
+            cursor.close()
+    else:
+        from langchain.vectorstores._pgvector_data_models import EmbeddingStore
+
+        connection.execute(
+            sqlalchemy.insert(EmbeddingStore.__table__).values(
+                [
+                    {
+                        "uuid": uuid.uuid4(),
+                        "collection_id": collection_id,
+                        "embedding": embedding,
+                        "document": text,
+                        "cmetadata": metadata,
+                        "custom_id": custom_id,
+                    }
+                    for text, metadata, embedding, custom_id in zip(
+                        texts, metadatas, embeddings, ids
+                    )
+                ]
+            )
+        )
+    connection.commit()
+
 
 class PGVectorReuseConnection(PGVector):
 
     _conn: Optional[sqlalchemy.engine.Connection] = None
+    # When set, similarity search compares embeddings cast to halfvec of this
+    # many dimensions, matching the index created by create_halfvec_index().
+    halfvec_dimensions: Optional[int] = None
 
-    def __init__(self, connection: sqlalchemy.engine.Connection, *args, **kwargs):
+    def __init__(
+        self,
+        connection: sqlalchemy.engine.Connection,
+        *args,
+        halfvec_dimensions: Optional[int] = None,
+        **kwargs,
+    ):
         self._conn = connection
+        self.halfvec_dimensions = halfvec_dimensions
         super().__init__(*args, connection_string="thisisignored", **kwargs)
 
     def connect(self) -> sqlalchemy.engine.Connection:
@@ -23,6 +341,93 @@ class PGVectorReuseConnection(PGVector):
             return self._conn
         return super().connect()
 
+    def add_embeddings(
+        self,
+        texts: Iterable[str],
+        embeddings: List[List[float]],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        # Replaces the ORM path (one EmbeddingStore object per row) with a
+        # bulk write. add_texts() and add_documents() both end up here.
+        texts = list(texts)
+        if ids is None:
+            ids = [str(uuid.uuid1()) for _ in texts]
+        if not metadatas:
+            metadatas = [{} for _ in texts]
+        bulk_insert_embeddings(
+            self._conn, self.collection_name, texts, metadatas, embeddings, ids
+        )
+        return ids
+
+    def similarity_search_with_score_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[dict] = None,
+    ) -> List[Tuple[Document, float]]:
+        if self.halfvec_dimensions is None or filter is not None:
+            return super().similarity_search_with_score_by_vector(embedding, k, filter)
+        results = self._search(SEARCH_QUERY, embedding, k)
+        return [
+            (Document(page_content=document, metadata=cmetadata), distance)
+            for document, cmetadata, distance in results
+        ]
+
+    def similarity_search_with_schemas(
+        self,
+        query: str,
+        k: int = 4,
+        embedding: Optional[List[float]] = None,
+        schema_limit: Optional[int] = None,
+    ) -> Tuple[List[Tuple[Document, float]], Dict[Tuple[str, str], RepositorySchema]]:
+        """
+        Like similarity_search_with_score(), also returning the stored schema
+        snapshots of the repositories of the top `schema_limit` (by default,
+        all) matches. Repositories without a snapshot are missing from the
+        returned dict. Document texts aren't fetched. The query's embedding is
+        computed unless it's passed in.
+        """
+        if embedding is None:
+            embedding = self.embedding_function.embed_query(query)
+        results = self._search(
+            SEARCH_WITH_SCHEMAS_QUERY,
+            embedding,
+            k,
+            collection=self.collection_name,
+            schema_limit=schema_limit,
+        )
+        matches: List[Tuple[Document, float]] = []
+        schemas: Dict[Tuple[str, str], RepositorySchema] = {}
+        for cmetadata, distance, namespace, repository, tables, updated_at in results:
+            if cmetadata is not None:
+                matches.append(
+                    (Document(page_content="", metadata=cmetadata), distance)
+                )
+            else:
+                schemas[(namespace, repository)] = RepositorySchema(
+                    tables=tables, updated_at=updated_at
+                )
+        return matches, schemas
+
+    def _search(
+        self, query: str, embedding: List[float], k: int, **params: Any
+    ) -> List[Any]:
+        distance = (
+            HALFVEC_DISTANCE.format(dimensions=self.halfvec_dimensions)
+            if self.halfvec_dimensions
+            else VECTOR_DISTANCE
+        )
+        # a UUID, so safe to format into the query
+        collection_id = get_collection_uuid(self._conn, self.collection_name)
+        stmt = sqlalchemy.text(
+            query.format(distance=distance, collection_id=collection_id)
+        ).bindparams(embedding=to_db(embedding), k=k, **params)
+        results = self._conn.execute(stmt).fetchall()
+        self._conn.commit()
+        return results
+
 
 def create_pgvector_index(db: PGVector, max_elements: int):
     create_index_query = sqlalchemy.text(
@@ -44,38 +449,161 @@ def create_pgvector_index(db: PGVector, max_elements: int):
         print(f"Failed to create PGVector extension or index: {e}")
 
 
+def create_halfvec_index(db: PGVector, dimensions: int, max_elements: int):
+    # A halfvec expression index takes half the memory of the full precision
+    # one (the table itself still stores full precision vectors). It's partial
+    # on the collection, since collections may hold vectors of different
+    # dimensions, which can't be cast to the same halfvec type.
+    collection_id = get_collection_uuid(db._conn, db.collection_name)
+    create_index_query = sqlalchemy.text(
+        CREATE_HALFVEC_INDEX_QUERY.format(
+            index_name=f"langchain_pg_embedding_{collection_id.hex}_halfvec_idx",
+            dimensions=dimensions,
+            lists=ceil(4 * sqrt(max_elements)),
+            collection_id=collection_id,
+        )
+    )
+    try:
+        with Session(db._conn) as session:
+            session.execute(create_index_query)
+            session.commit()
+        print("PGVector halfvec index created successfully.")
+    except Exception as e:
+        print(f"Failed to create PGVector halfvec index: {e}")
+
+
+class GuardedEmbeddings(Embeddings):
+    """
+    Wraps the embedding function used on the request path, so that queries
+    are embedded within the request's deadline and behind the OpenAI circuit
+    breaker, failing with UpstreamError.
+    """
+
+    def __init__(self, embeddings: Embeddings, timeout: float):
+        self.embeddings = embeddings
+        self.timeout = timeout
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return guarded_call(
+            "openai", partial(self.embeddings.embed_query, text), self.timeout
+        )
+
+
 def get_embedding_store_pgvector(
     connection: sqlalchemy.engine.Connection,
     collection: str,
     openai_api_key: str,
     max_elements: int = 100000,
-) -> VectorStore:
+    dimensions: Optional[int] = None,
+    half_precision: bool = False,
+    request_timeout: float = OPENAI_BATCH_TIMEOUT_SECONDS,
+    max_retries: int = 6,
+    guard_queries: bool = False,
+) -> PGVectorReuseConnection:
     # description: https://supabase.com/blog/openai-embeddings-postgres-vector
 
+    # The defaults suit the indexer's large batches. The server embeds prompts
+    # with a short timeout and few retries, guarded by guard_queries.
+    # MyPy chokes on this, see: https://github.com/langchain-ai/langchain/issues/2925
+    embedding_function: Embeddings = OpenAIEmbeddings(  # type: ignore
+        openai_api_key=openai_api_key,
+        request_timeout=request_timeout,
+        max_retries=max_retries,
+    )
+    if guard_queries:
+        embedding_function = GuardedEmbeddings(
+            embedding_function, request_timeout * (max_retries + 1)
+        )
+    if dimensions:
+        embedding_function = ProjectedEmbeddings(embedding_function, dimensions)
+    halfvec_dimensions = (
+        (dimensions or OPENAI_EMBEDDING_DIMENSIONS) if half_precision else None
+    )
     db = PGVectorReuseConnection(
         connection,
-        # MyPy chokes on this, see: https://github.com/langchain-ai/langchain/issues/2925
-        embedding_function=OpenAIEmbeddings(openai_api_key=openai_api_key),  # type: ignore
+        embedding_function=embedding_function,
         collection_name=collection,
         distance_strategy=DistanceStrategy.COSINE,
+        halfvec_dimensions=halfvec_dimensions,
     )
+    create_repository_schema_table(connection)
+    create_collection_version_table(connection)
     # create index
-    create_pgvector_index(db, max_elements)
+    if halfvec_dimensions:
+        create_halfvec_index(db, halfvec_dimensions, max_elements)
+    else:
+        create_pgvector_index(db, max_elements)
     return db
 
 
-def find_repos(vstore: VectorStore, query: str, limit=4) -> List[Tuple[str, str]]:
-    results = vstore.similarity_search_with_score(query, limit)
-    # sort by relevance, returning most relevant repository first
-    results.sort(key=lambda a: a[1], reverse=True)
-    # deduplicate results
+def get_matching_repositories(
+    results: List[Tuple[Document, float]],
+) -> List[Tuple[str, str]]:
+    # Scores are cosine distances, so the most relevant repository has the
+    # lowest one. dict.fromkeys() deduplicates while keeping that order.
+    results = sorted(results, key=lambda a: a[1])
     return list(
-        set(
-            [(r[0].metadata["namespace"], r[0].metadata["repository"]) for r in results]
+        dict.fromkeys(
+            (r[0].metadata["namespace"], r[0].metadata["repository"]) for r in results
         )
     )
 
 
+def find_repos(vstore: VectorStore, query: str, limit=4) -> List[Tuple[str, str]]:
+    return get_matching_repositories(vstore.similarity_search_with_score(query, limit))
+
+
+class SchemaSearchStore(Protocol):
+    # The searches made by the server, answered by PGVectorReuseConnection or
+    # by a MemoryMappedVectorStore wrapping it.
+    embedding_function: Embeddings
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Optional[dict] = None
+    ) -> List[Tuple[Document, float]]:
+        ...
+
+    def similarity_search_with_schemas(
+        self,
+        query: str,
+        k: int = 4,
+        embedding: Optional[List[float]] = None,
+        schema_limit: Optional[int] = None,
+    ) -> Tuple[List[Tuple[Document, float]], Dict[Tuple[str, str], RepositorySchema]]:
+        ...
+
+
+class RepositoryMatches(NamedTuple):
+    repositories: List[Tuple[str, str]]
+    schemas: Dict[Tuple[str, str], RepositorySchema]
+    # all matching chunks, most relevant first
+    results: List[Tuple[Document, float]]
+
+
+def find_repos_with_schemas(
+    vstore: SchemaSearchStore,
+    query: str,
+    limit=4,
+    result_limit: Optional[int] = None,
+    embedding: Optional[List[float]] = None,
+) -> RepositoryMatches:
+    """
+    Returns the repositories of the top `limit` chunks matching the query.
+    Up to `result_limit` chunks are returned, eg. to rank the repositories'
+    tables with.
+    """
+    k = max(limit, result_limit or 0)
+    # Schemas are only fetched for the repositories which are returned.
+    results, schemas = vstore.similarity_search_with_schemas(query, k, embedding, limit)
+    results = sorted(results, key=lambda a: a[1])
+    return RepositoryMatches(
+        get_matching_repositories(results[:limit]), schemas, results
+    )
+
+
 def connect(connection_string: str) -> sqlalchemy.engine.Connection:
     if connection_string == CLOUDSQL_PG_CONN_STR:
         from .db_cloudsql import connect_with_connector
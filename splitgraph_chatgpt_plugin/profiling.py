@@ -0,0 +1,217 @@
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+import hmac
+import random
+import sys
+import threading
+import time
+from types import FrameType
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, TypeVar
+
+from starlette.concurrency import run_in_threadpool as _run_in_threadpool
+
+from .config import PROFILE_SAMPLE_INTERVAL_SECONDS
+
+T = TypeVar("T")
+
+PROFILE_TOKEN_HEADER = b"x-profile-token"
+# Stacks are truncated to their outermost frames beyond this depth.
+MAX_STACK_DEPTH = 128
+
+
+def get_frame_name(frame: FrameType) -> str:
+    # ";" separates frames in the collapsed stack format
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}:{frame.f_code.co_qualname}".replace(";", ",")
+
+
+def get_stack(frame: FrameType) -> List[str]:
+    # outermost frame first
+    stack: List[str] = []
+    current: Optional[FrameType] = frame
+    while current is not None:
+        stack.append(get_frame_name(current))
+        current = current.f_back
+    stack.reverse()
+    return stack[:MAX_STACK_DEPTH]
+
+
+def is_idle(frame: FrameType) -> bool:
+    # an event loop waiting for I/O, which isn't attributable to any request
+    return (
+        frame.f_globals.get("__name__") == "selectors"
+        and frame.f_code.co_name == "select"
+    )
+
+
+class ProfileSession:
+    """
+    A profiled request: its endpoint and the threads currently working on it
+    (the event loop's, for the whole request, and threadpool threads while
+    they run its calls).
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        # thread id -> number of the session's calls it's running
+        self.threads: Dict[int, int] = {}
+
+    @contextmanager
+    def thread(self) -> Iterator[None]:
+        # Attributes the current thread's samples to the session. Each thread
+        # only updates its own entry, so no lock is needed.
+        thread_id = threading.get_ident()
+        self.threads[thread_id] = self.threads.get(thread_id, 0) + 1
+        try:
+            yield
+        finally:
+            self.threads[thread_id] -= 1
+            if not self.threads[thread_id]:
+                del self.threads[thread_id]
+
+
+class SamplingProfiler:
+    """
+    A wall-clock sampling profiler for individual requests. While any
+    profiled request is in progress, a background thread samples the stacks
+    of the threads working on them every `interval` seconds, aggregating them
+    per endpoint. Nothing runs while no request is profiled.
+
+    The event loop's thread is shared by all requests, so its samples include
+    the work of any requests running concurrently with a profiled one, except
+    for when it waits for I/O.
+    """
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL_SECONDS):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._sessions: Set[ProfileSession] = set()
+        self._stacks: Counter = Counter()
+        self._requests: Counter = Counter()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, endpoint: str) -> ProfileSession:
+        session = ProfileSession(endpoint)
+        with self._lock:
+            self._sessions.add(session)
+            self._requests[endpoint] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="profiler", daemon=True
+                )
+                self._thread.start()
+        return session
+
+    def stop(self, session: ProfileSession) -> None:
+        with self._lock:
+            self._sessions.discard(session)
+
+    def sample(self) -> None:
+        frames = sys._current_frames()
+        with self._lock:
+            for session in self._sessions:
+                for thread_id in list(session.threads):
+                    frame = frames.get(thread_id)
+                    if frame is None or is_idle(frame):
+                        continue
+                    stack = ";".join([session.endpoint] + get_stack(frame))
+                    self._stacks[stack] += 1
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                if not self._sessions:
+                    self._thread = None
+                    return
+            self.sample()
+            time.sleep(self.interval)
+
+    def collapsed(self, endpoint: Optional[str] = None) -> str:
+        """
+        Returns the samples in the collapsed stack format read by flamegraph.pl
+        and speedscope: one "frame;frame;... count" line per distinct stack,
+        with the endpoint as the outermost frame.
+        """
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+        return "".join(
+            f"{stack} {count}\n"
+            for stack, count in stacks
+            if endpoint is None or stack.split(";", 1)[0] == endpoint
+        )
+
+    def requests(self) -> Dict[str, int]:
+        # number of requests profiled per endpoint
+        with self._lock:
+            return dict(self._requests)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stacks.clear()
+            self._requests.clear()
+
+
+profiler = SamplingProfiler()
+_session: ContextVar[Optional[ProfileSession]] = ContextVar(
+    "profile_session", default=None
+)
+
+
+def is_admin_token(token: Optional[str], admin_token: Optional[str]) -> bool:
+    return bool(token and admin_token) and hmac.compare_digest(
+        token.encode("utf-8"), admin_token.encode("utf-8")
+    )
+
+
+async def run_in_threadpool(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    # starlette's run_in_threadpool, attributing the worker thread's samples to
+    # the current request while it's profiled
+    session = _session.get()
+    if session is None:
+        return await _run_in_threadpool(func, *args, **kwargs)
+
+    def run() -> T:
+        with session.thread():
+            return func(*args, **kwargs)
+
+    return await _run_in_threadpool(run)
+
+
+class ProfilingMiddleware:
+    """
+    Profiles a `sample_rate` fraction of requests, and requests with an
+    X-Profile-Token header matching `admin_token`. Only installed when either
+    is configured.
+    """
+
+    def __init__(
+        self,
+        app: Any,
+        sample_rate: float,
+        admin_token: Optional[str],
+        profiler: SamplingProfiler = profiler,
+    ):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.admin_token = admin_token
+        self.profiler = profiler
+
+    def should_profile(self, scope: Dict[str, Any]) -> bool:
+        if self.admin_token:
+            for name, value in scope["headers"]:
+                if name == PROFILE_TOKEN_HEADER:
+                    return is_admin_token(value.decode("latin-1"), self.admin_token)
+        return random.random() < self.sample_rate
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or not self.should_profile(scope):
+            return await self.app(scope, receive, send)
+        session = self.profiler.start(scope["path"])
+        token = _session.set(session)
+        try:
+            with session.thread():
+                await self.app(scope, receive, send)
+        finally:
+            _session.reset(token)
+            self.profiler.stop(session)
@@ -0,0 +1,72 @@
+import json
+from typing import Dict, List, Optional, Tuple
+
+from langchain.docstore.document import Document
+
+from .chunking import Encoding, count_tokens, get_encoding
+from .ddn import get_fully_qualified_table_name
+from .models import FindRelevantTablesResponse, TableInfo
+
+
+def get_table_distances(results: List[Tuple[Document, float]]) -> Dict[str, float]:
+    """
+    Returns the distance of the closest chunk of each table found by a
+    similarity search, keyed by fully qualified table name. README chunks
+    (and chunks indexed before tables had their own chunks) aren't counted.
+    """
+    distances: Dict[str, float] = {}
+    for document, distance in results:
+        table = document.metadata.get("table")
+        if table is None:
+            continue
+        name = get_fully_qualified_table_name(
+            document.metadata["namespace"], document.metadata["repository"], table
+        )
+        distances[name] = min(distance, distances.get(name, distance))
+    return distances
+
+
+def rank_tables(
+    table_infos: List[TableInfo], table_distances: Dict[str, float]
+) -> List[TableInfo]:
+    # Tables with a matching chunk come first, closest first. The rest keep
+    # their original order, which follows the relevance of their repository.
+    order = sorted(
+        range(len(table_infos)),
+        key=lambda i: (table_distances.get(table_infos[i].name, float("inf")), i),
+    )
+    return [table_infos[i] for i in order]
+
+
+def fit_tables_to_budget(
+    table_infos: List[TableInfo],
+    max_tokens: int,
+    encoding: Optional[Encoding] = None,
+) -> FindRelevantTablesResponse:
+    """
+    Includes tables (in the given order) with all their columns while they fit
+    in max_tokens, counted on their JSON serialization. Once a table doesn't
+    fit, it and all the tables after it are only listed by name, for as long as
+    the names fit.
+    """
+    encoding = encoding or get_encoding()
+    remaining = max_tokens
+    tables: List[TableInfo] = []
+    other_tables: List[str] = []
+    truncated = False
+    for table_info in table_infos:
+        if not truncated:
+            tokens = count_tokens(table_info.json(), encoding)
+            if tokens <= remaining:
+                tables.append(table_info)
+                remaining -= tokens
+                continue
+            truncated = True
+        tokens = count_tokens(json.dumps(table_info.name), encoding)
+        if tokens > remaining:
+            break
+        other_tables.append(table_info.name)
+        remaining -= tokens
+    return FindRelevantTablesResponse(
+        tables=tables, other_tables=other_tables, truncated=truncated
+    )
@@ -0,0 +1,379 @@
+import difflib
+import re
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from .models import TableInfo
+
+# Returns the tables of those of the given repositories whose schema is known
+# (eg. from the indexer's snapshots). Unknown repositories aren't validated.
+SchemaLookup = Callable[[List[Tuple[str, str]]], Dict[Tuple[str, str], List[TableInfo]]]
+
+TOKEN_RE = re.compile(
+    r"""
+    (?P<space>\s+)
+    | (?P<comment>--[^\n]*|/\*.*?\*/)
+    | (?P<string>[eE]?'(?:[^']|'')*'|\$(?P<tag>[A-Za-z_]*)\$.*?\$(?P=tag)\$)
+    | (?P<quoted>"(?:[^"]|"")*")
+    | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+    | (?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?)
+    | (?P<other>.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+# Keywords which can follow a table reference, and so can't be its alias.
+NON_ALIAS_KEYWORDS = {
+    "cross",
+    "except",
+    "fetch",
+    "for",
+    "full",
+    "group",
+    "having",
+    "inner",
+    "intersect",
+    "join",
+    "left",
+    "limit",
+    "natural",
+    "offset",
+    "on",
+    "order",
+    "outer",
+    "returning",
+    "right",
+    "tablesample",
+    "union",
+    "using",
+    "where",
+    "window",
+}
+
+# Postgres system columns, which every table has without them being part of
+# its schema.
+SYSTEM_COLUMNS = {"tableoid", "xmin", "cmin", "xmax", "cmax", "ctid"}
+
+SIMPLE_IDENTIFIER_RE = re.compile(r"^[a-z_][a-z0-9_$]*$")
+
+
+class Token(NamedTuple):
+    kind: str
+    # identifiers are case folded (unquoted) or unescaped (quoted), like
+    # Postgres does
+    value: str
+    start: int
+    end: int
+
+
+class TableReference(NamedTuple):
+    # None for tables which aren't in a repository (eg. CTEs)
+    namespace: Optional[str]
+    repository: Optional[str]
+    table: str
+    alias: Optional[str]
+    # whether the alias renames the table's columns, eg. t(a, b)
+    column_aliases: bool = False
+
+
+def tokenize(sql: str) -> List[Token]:
+    tokens: List[Token] = []
+    for match in TOKEN_RE.finditer(sql):
+        kind = match.lastgroup
+        if kind == "tag":
+            kind = "string"
+        text = match.group()
+        if kind in ("space", "comment"):
+            continue
+        if kind == "quoted":
+            tokens.append(
+                Token("identifier", text[1:-1].replace('""', '"'), *match.span())
+            )
+        elif kind == "word":
+            tokens.append(Token("word", text.lower(), *match.span()))
+        else:
+            tokens.append(Token(kind or "other", text, *match.span()))
+    return tokens
+
+
+def quote_identifier(name: str) -> str:
+    if SIMPLE_IDENTIFIER_RE.match(name):
+        return name
+    return '"' + name.replace('"', '""') + '"'
+
+
+def format_table_name(namespace: str, repository: str, table: str) -> str:
+    return f"{quote_identifier(namespace + '/' + repository)}.{quote_identifier(table)}"
+
+
+def suggest(name: str, candidates: Iterable[str]) -> List[str]:
+    candidates = list(candidates)
+    # a name which only differs in case needs quoting, eg. "Name" for name
+    same = [c for c in candidates if c.lower() == name.lower() and c != name]
+    return same or difflib.get_close_matches(name, candidates, n=3, cutoff=0.6)
+
+
+def did_you_mean(suggestions: List[str]) -> str:
+    if not suggestions:
+        return ""
+    return " Did you mean " + " or ".join(suggestions) + "?"
+
+
+def _is_identifier(token: Optional[Token]) -> bool:
+    return token is not None and token.kind in ("word", "identifier")
+
+
+def _raw_name(sql: str, tokens: List[Token], i: int) -> Tuple[str, int]:
+    # The text of a name made of adjacent tokens (no whitespace between them),
+    # eg. ns/repo.table, and the index of the token after it.
+    j = i + 1
+    while (
+        j < len(tokens)
+        and tokens[j].start == tokens[j - 1].end
+        and tokens[j].value not in (",", "(", ")", ";")
+    ):
+        j += 1
+    return sql[tokens[i].start : tokens[j - 1].end], j
+
+
+def _quoting_suggestion(raw: str) -> str:
+    name = raw.replace('"', "")
+    schema, _, table = name.rpartition(".")
+    if "/" not in schema:
+        return ""
+    namespace, _, repository = schema.partition("/")
+    return did_you_mean([format_table_name(namespace, repository, table)])
+
+
+def parse_table_references(
+    sql: str, tokens: List[Token], errors: List[str]
+) -> List[TableReference]:
+    """
+    Finds table references following FROM and JOIN (including comma separated
+    FROM lists), along with their aliases. Only "namespace/repository"."table"
+    references have a namespace and repository. Names which contain a "/" but
+    aren't quoted correctly are reported in errors.
+    """
+    references: List[TableReference] = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        i += 1
+        if token.kind != "word" or token.value not in ("from", "join"):
+            continue
+        while i < len(tokens) and _is_identifier(tokens[i]):
+            raw, after = _raw_name(sql, tokens, i)
+            parts: List[Token] = [tokens[i]]
+            j = i + 1
+            while (
+                j + 1 < after
+                and tokens[j].value == "."
+                and _is_identifier(tokens[j + 1])
+            ):
+                parts.append(tokens[j + 1])
+                j += 2
+            if j != after or (
+                len(parts) == 1 and "/" in parts[0].value and "." in parts[0].value
+            ):
+                if "/" in raw:
+                    errors.append(
+                        f"table names containing a slash must be quoted: {raw} "
+                        f"isn't a valid table name.{_quoting_suggestion(raw)}"
+                    )
+                break
+            if after < len(tokens) and tokens[after].value == "(":
+                # a function call, eg. generate_series(...)
+                break
+            i = after
+            alias: Optional[str] = None
+            if i < len(tokens) and tokens[i].value == "as" and tokens[i].kind == "word":
+                i += 1
+            if (
+                i < len(tokens)
+                and _is_identifier(tokens[i])
+                and not (
+                    tokens[i].kind == "word" and tokens[i].value in NON_ALIAS_KEYWORDS
+                )
+            ):
+                alias = tokens[i].value
+                i += 1
+            column_aliases = False
+            if alias is not None and i < len(tokens) and tokens[i].value == "(":
+                column_aliases = True
+                depth = 0
+                while i < len(tokens):
+                    depth += {"(": 1, ")": -1}.get(tokens[i].value, 0)
+                    i += 1
+                    if not depth:
+                        break
+            namespace: Optional[str] = None
+            repository: Optional[str] = None
+            if len(parts) == 2 and "/" in parts[0].value:
+                namespace, _, repository = parts[0].value.partition("/")
+            references.append(
+                TableReference(
+                    namespace, repository, parts[-1].value, alias, column_aliases
+                )
+            )
+            if token.value == "join" or i >= len(tokens) or tokens[i].value != ",":
+                break
+            i += 1
+    return references
+
+
+def get_derived_table_names(tokens: List[Token]) -> List[str]:
+    """
+    Returns the names of CTEs and the aliases of subqueries, which can't be
+    told apart from repository tables when qualifying columns.
+    """
+    names = []
+    for i, token in enumerate(tokens):
+        if not _is_identifier(token):
+            continue
+        previous = tokens[i - 1] if i > 0 else None
+        before_previous = tokens[i - 2] if i > 1 else None
+        following = tokens[i + 1 : i + 3]
+        if (
+            # WITH name AS (...), name AS (...)
+            [t.value for t in following] == ["as", "("]
+            # WITH [RECURSIVE] name(columns) AS (...)
+            or (previous is not None and previous.value in ("with", "recursive"))
+            # (...) [AS] alias
+            or (previous is not None and previous.value == ")")
+            or (
+                previous is not None
+                and previous.value == "as"
+                and before_previous is not None
+                and before_previous.value == ")"
+            )
+        ):
+            names.append(token.value)
+    return names
+
+
+def _check_references(
+    tokens: List[Token],
+    references: List[TableReference],
+    schemas: Dict[Tuple[str, str], List[TableInfo]],
+) -> Tuple[List[str], List[Tuple[str, str]]]:
+    # Returns the errors and the repositories they're about.
+    errors: List[str] = []
+    repositories: List[Tuple[str, str]] = []
+
+    # Columns are only checked for qualifiers bound to a single known table.
+    # Those used for tables without a schema, for several tables (eg. in
+    # subqueries or UNIONs) or with renamed columns are ambiguous (None).
+    qualifiers: Dict[str, Optional[Tuple[Tuple[str, str], TableInfo]]] = {}
+    for reference in references:
+        bound: Optional[Tuple[Tuple[str, str], TableInfo]] = None
+        if reference.namespace is not None and reference.repository is not None:
+            key = (reference.namespace, reference.repository)
+            tables = schemas.get(key)
+            table_info = (
+                next((t for t in tables if t.name == reference.table), None)
+                if tables is not None
+                else None
+            )
+            if table_info is not None:
+                bound = (key, table_info)
+            elif tables is not None:
+                repositories.append(key)
+                errors.append(
+                    f"relation {format_table_name(reference.namespace, reference.repository, reference.table)} does not exist."
+                    + did_you_mean(
+                        [
+                            format_table_name(
+                                reference.namespace, reference.repository, t
+                            )
+                            for t in suggest(reference.table, [t.name for t in tables])
+                        ]
+                    )
+                )
+        if reference.column_aliases:
+            bound = None
+        qualifier = reference.alias or reference.table
+        if qualifier in qualifiers and qualifiers[qualifier] != bound:
+            bound = None
+        qualifiers[qualifier] = bound
+    for name in get_derived_table_names(tokens):
+        qualifiers[name] = None
+
+    reported = set()
+    for i in range(len(tokens) - 2):
+        qualifier, dot, column = tokens[i], tokens[i + 1], tokens[i + 2]
+        if not (
+            _is_identifier(qualifier)
+            and dot.value == "."
+            and _is_identifier(column)
+            and qualifiers.get(qualifier.value)
+        ):
+            continue
+        if i > 0 and tokens[i - 1].value == ".":
+            # "namespace/repository"."table".column
+            if i < 2 or "/" not in tokens[i - 2].value:
+                continue
+        if i + 3 < len(tokens) and tokens[i + 3].value in (".", "("):
+            continue
+        bound = qualifiers[qualifier.value]
+        assert bound is not None
+        key, table_info = bound
+        column_names = [c.name for c in table_info.columns]
+        if (
+            column.value in column_names
+            or column.value in SYSTEM_COLUMNS
+            or (qualifier.value, column.value) in reported
+        ):
+            continue
+        reported.add((qualifier.value, column.value))
+        repositories.append(key)
+        errors.append(
+            f"column {quote_identifier(qualifier.value)}.{quote_identifier(column.value)} does not exist."
+            + did_you_mean(
+                [
+                    f"{quote_identifier(qualifier.value)}.{quote_identifier(c)}"
+                    for c in suggest(column.value, column_names)
+                ]
+            )
+        )
+    return errors, list(dict.fromkeys(repositories))
+
+
+def validate_sql(
+    sql: str,
+    lookup_schemas: SchemaLookup,
+    lookup_live_schemas: Optional[SchemaLookup] = None,
+) -> Optional[str]:
+    """
+    Checks the tables and columns a query references against the known schemas
+    of their repositories. Returns an error message (with suggestions for the
+    closest valid names) if the query is certain to fail, otherwise None.
+
+    This isn't a full SQL parser: only tables referenced as
+    "namespace/repository"."table" and columns qualified with such a table
+    (or its alias) are checked, which is enough to catch most made up names
+    without rejecting any valid query.
+
+    A snapshot may predate tables and columns added since it was taken, so
+    repositories with errors are checked again against the schemas returned by
+    `lookup_live_schemas`, if given. Those missing from its result aren't
+    checked.
+    """
+    tokens = tokenize(sql)
+    errors: List[str] = []
+    references = parse_table_references(sql, tokens, errors)
+    schemas = lookup_schemas(
+        list(
+            dict.fromkeys(
+                (r.namespace, r.repository)
+                for r in references
+                if r.namespace is not None and r.repository is not None
+            )
+        )
+    )
+    schema_errors, repositories = _check_references(tokens, references, schemas)
+    if repositories and lookup_live_schemas is not None:
+        live_schemas = lookup_live_schemas(repositories)
+        for key in repositories:
+            schemas.pop(key, None)
+        schemas.update(live_schemas)
+        schema_errors, _ = _check_references(tokens, references, schemas)
+    return "\n".join(errors + schema_errors) or None
@@ -0,0 +1,143 @@
+# Compares compact embedding storage options against the full precision
+# collection, to help decide on EMBEDDING_DIMENSIONS / EMBEDDING_HALF_PRECISION.
+#
+# Usage: python -m splitgraph_chatgpt_plugin.storage_report [--queries N] [--k K]
+#
+# Stored chunk embeddings are reused as queries, so no OpenAI API calls are made.
+import argparse
+from contextlib import closing
+from typing import Iterable, List, NamedTuple
+
+import numpy as np
+from pgvector.utils import from_db
+import sqlalchemy
+
+from .compact import project_embeddings
+from .config import DOCUMENT_COLLECTION_NAME, get_db_connection_string
+from .persistence import connect
+
+REPORT_DIMENSIONS = [1536, 1024, 768, 512, 384, 256, 128]
+
+GET_EMBEDDINGS_QUERY = """
+    SELECT embedding::text FROM langchain_pg_embedding
+    WHERE collection_id = (select uuid from langchain_pg_collection where name = :collection);
+    """
+
+
+class StorageReportRow(NamedTuple):
+    dimensions: int
+    half_precision: bool
+    # size of a vector in the index: the table stores full precision vectors
+    # even when they're indexed and searched as halfvec
+    bytes_per_vector: int
+    recall: float
+
+
+def vector_size(dimensions: int, half_precision: bool) -> int:
+    # pgvector's vector and halfvec both have an 8 byte header (varlena length,
+    # dimensions and an unused field) followed by 4 or 2 bytes per dimension.
+    return 8 + dimensions * (2 if half_precision else 4)
+
+
+def top_k(corpus: np.ndarray, queries: np.ndarray, query_ids: np.ndarray, k: int):
+    # at most all the other chunks can be found
+    k = min(k, len(corpus) - 1)
+    scores = queries @ corpus.T
+    # a query never matches the chunk it was taken from
+    scores[np.arange(len(query_ids)), query_ids] = -np.inf
+    return np.argpartition(-scores, k, axis=1)[:, :k]
+
+
+def storage_report(
+    embeddings: np.ndarray,
+    dimensions: Iterable[int],
+    k: int = 4,
+    query_count: int = 200,
+    seed: int = 0,
+) -> List[StorageReportRow]:
+    """
+    Measures recall@k of the top-k cosine neighbours found with compact
+    embeddings, relative to the neighbours found with full precision ones.
+    """
+    full = project_embeddings(embeddings, embeddings.shape[1])
+    query_ids = np.random.RandomState(seed).choice(
+        len(full), min(query_count, len(full)), replace=False
+    )
+    expected = top_k(full, full[query_ids], query_ids, k)
+    rows = []
+    for d in dimensions:
+        if d > full.shape[1]:
+            continue
+        reduced = project_embeddings(full, d)
+        for half_precision in (False, True):
+            corpus = (
+                reduced.astype(np.float16).astype(np.float32)
+                if half_precision
+                else reduced
+            )
+            found = top_k(corpus, corpus[query_ids], query_ids, k)
+            hits = sum(
+                len(np.intersect1d(e, f, assume_unique=True))
+                for e, f in zip(expected, found)
+            )
+            # with a single chunk, there are no neighbours to miss
+            recall = hits / expected.size if expected.size else 1.0
+            rows.append(
+                StorageReportRow(
+                    dimensions=d,
+                    half_precision=half_precision,
+                    bytes_per_vector=vector_size(d, half_precision),
+                    recall=recall,
+                )
+            )
+    return rows
+
+
+def print_storage_report(
+    rows: List[StorageReportRow], vector_count: int, full_dimensions: int
+) -> None:
+    full_size = vector_size(full_dimensions, False)
+    print(
+        f"{'dimensions':>10} {'precision':>9} {'bytes/vec':>9} {'total MB':>9} {'size':>6} {'recall':>6}"
+    )
+    for row in rows:
+        print(
+            f"{row.dimensions:>10} {'half' if row.half_precision else 'full':>9} "
+            f"{row.bytes_per_vector:>9} {row.bytes_per_vector * vector_count / 1e6:>9.1f} "
+            f"{row.bytes_per_vector / full_size:>6.0%} {row.recall:>6.3f}"
+        )
+    print(
+        "Sizes are of the index. Half precision only shrinks the index: the table "
+        "still stores full precision vectors of the given dimensions."
+    )
+
+
+def load_embeddings(
+    connection: sqlalchemy.engine.Connection, collection: str
+) -> np.ndarray:
+    stmt = sqlalchemy.text(GET_EMBEDDINGS_QUERY).bindparams(collection=collection)
+    return np.vstack([from_db(row[0]) for row in connection.execute(stmt)])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Report recall versus size of compact embedding storage options."
+    )
+    parser.add_argument("--collection", default=DOCUMENT_COLLECTION_NAME)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    args = parser.parse_args()
+    with closing(connect(get_db_connection_string())) as connection:
+        embeddings = load_embeddings(connection, args.collection)
+    print(
+        f"{len(embeddings)} embeddings in {args.collection}, recall@{args.k} over {args.queries} queries"
+    )
+    print_storage_report(
+        storage_report(embeddings, REPORT_DIMENSIONS, args.k, args.queries),
+        len(embeddings),
+        embeddings.shape[1],
+    )
+
+
+if __name__ == "__main__":
+    main()
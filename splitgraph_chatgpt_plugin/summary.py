@@ -0,0 +1,134 @@
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from .models import ColumnSummary, DDNResponseField, ResultSummary, ValueCount
+
+SUMMARY_TOP_VALUES = 5
+SUMMARY_SAMPLE_ROWS = 5
+
+# PostgreSQL type OIDs (see pg_type), grouped by the statistics which apply
+NUMERIC_TYPE_IDS = {
+    20,  # int8
+    21,  # int2
+    23,  # int4
+    26,  # oid
+    700,  # float4
+    701,  # float8
+    1700,  # numeric
+}
+# compared as points in time (in UTC)
+DATETIME_TYPE_IDS = {
+    1082,  # date
+    1114,  # timestamp
+    1184,  # timestamptz
+}
+# without a time zone, these sort correctly as strings
+TIME_TYPE_IDS = {
+    1083,  # time
+}
+CATEGORICAL_TYPE_IDS = {
+    16,  # bool
+    18,  # char
+    19,  # name
+    25,  # text
+    1042,  # bpchar
+    1043,  # varchar
+    2950,  # uuid
+}
+
+
+def _python_value(value: Any) -> Any:
+    # numpy scalars aren't JSON serializable
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def parse_datetimes(values: np.ndarray) -> Optional[np.ndarray]:
+    # None if any of the values isn't an ISO 8601 date or time (eg. BC dates
+    # or infinity)
+    try:
+        parsed = [datetime.fromisoformat(str(value)) for value in values]
+    except ValueError:
+        return None
+    return np.array(
+        [
+            d.astimezone(timezone.utc).replace(tzinfo=None) if d.tzinfo else d
+            for d in parsed
+        ],
+        dtype="datetime64[us]",
+    )
+
+
+def top_values(values: np.ndarray, k: int) -> List[ValueCount]:
+    # values may mix types (eg. JSON numbers and strings), which can't be
+    # sorted together, so they're counted by their string representation
+    keys = values.astype(str)
+    unique, first_index, counts = np.unique(keys, return_index=True, return_counts=True)
+    # most common first, ties in order of first appearance
+    order = np.lexsort((first_index, -counts))[:k]
+    return [
+        ValueCount(value=_python_value(values[first_index[i]]), count=int(counts[i]))
+        for i in order
+    ]
+
+
+def summarize_column(
+    field: DDNResponseField, column: np.ndarray, top_k: int
+) -> ColumnSummary:
+    nulls = np.equal(column, None)
+    values = column[~nulls]
+    summary = ColumnSummary(
+        name=field.name,
+        type=field.formattedType,
+        count=len(values),
+        nulls=int(nulls.sum()),
+    )
+    if not len(values):
+        return summary
+    if field.dataTypeID in NUMERIC_TYPE_IDS:
+        # numeric and int8 values may be returned as strings
+        numbers = values.astype(np.float64)
+        # NaN and infinity aren't valid JSON, and would make the stats meaningless
+        finite = np.isfinite(numbers)
+        values, numbers = values[finite], numbers[finite]
+        if len(numbers):
+            # min and max are returned as they were, so they don't lose precision
+            summary.min = _python_value(values[np.argmin(numbers)])
+            summary.max = _python_value(values[np.argmax(numbers)])
+            summary.mean = float(numbers.mean())
+    elif field.dataTypeID in DATETIME_TYPE_IDS:
+        datetimes = parse_datetimes(values)
+        if datetimes is not None:
+            summary.min = _python_value(values[np.argmin(datetimes)])
+            summary.max = _python_value(values[np.argmax(datetimes)])
+    elif field.dataTypeID in TIME_TYPE_IDS:
+        strings = values.astype(str)
+        summary.min = _python_value(values[np.argmin(strings)])
+        summary.max = _python_value(values[np.argmax(strings)])
+    elif field.dataTypeID in CATEGORICAL_TYPE_IDS:
+        summary.top_values = top_values(values, top_k)
+    return summary
+
+
+def summarize_result(
+    rows: List[Dict[str, Any]],
+    fields: List[DDNResponseField],
+    top_k: int = SUMMARY_TOP_VALUES,
+    sample_size: int = SUMMARY_SAMPLE_ROWS,
+) -> ResultSummary:
+    """
+    Summarizes a DDN result with per-column statistics: counts of values and
+    nulls, plus min, max and mean of numbers, min and max of dates and times
+    and the most common values of text, booleans and UUIDs. Other types (eg.
+    JSON or arrays) only get counts.
+    """
+    columns: List[ColumnSummary] = []
+    for field in fields:
+        column = np.fromiter(
+            (row.get(field.name) for row in rows), dtype=object, count=len(rows)
+        )
+        columns.append(summarize_column(field, column, top_k))
+    return ResultSummary(
+        row_count=len(rows), columns=columns, sample_rows=rows[:sample_size]
+    )
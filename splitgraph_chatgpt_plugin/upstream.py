@@ -0,0 +1,223 @@
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeoutError,
+    wait,
+)
+from contextlib import contextmanager
+import contextvars
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional, Set, TypeVar
+
+import requests
+
+from .config import (
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+    CIRCUIT_BREAKER_RESET_SECONDS,
+    UPSTREAM_CONNECT_TIMEOUT_SECONDS,
+)
+
+T = TypeVar("T")
+
+# time.monotonic() by which the current request must be answered
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "deadline", default=None
+)
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class DeadlineExceeded(UpstreamError):
+    pass
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+@contextmanager
+def deadline(seconds: float) -> Iterator[None]:
+    """
+    Sets a deadline for all upstream calls made in this context (including
+    threads started with copy_context()). Nested deadlines can only shorten it.
+    """
+    current = _deadline.get()
+    new = time.monotonic() + seconds
+    token = _deadline.set(new if current is None else min(current, new))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def has_deadline() -> bool:
+    # whether a plugin API request is being answered
+    return _deadline.get() is not None
+
+
+def get_timeout(default: float) -> float:
+    # The time an upstream call may take: its own timeout, capped by the
+    # time left until the deadline.
+    current = _deadline.get()
+    if current is None:
+        return default
+    remaining = current - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("Deadline exceeded")
+    return min(default, remaining)
+
+
+class CircuitBreaker:
+    """
+    Fails calls to an upstream immediately after failure_threshold consecutive
+    failures. After reset_seconds, one trial call is let through: the circuit
+    closes again if it succeeds, and stays open for another reset_seconds if
+    it fails.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+        reset_seconds: float = CIRCUIT_BREAKER_RESET_SECONDS,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_running = False
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if (
+                self._trial_running
+                or time.monotonic() - self._opened_at < self.reset_seconds
+            ):
+                raise CircuitOpenError(f"{self.name} is unavailable")
+            self._trial_running = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    print(f"Opening circuit breaker of {self.name}")
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(upstream: str) -> CircuitBreaker:
+    with _circuit_breakers_lock:
+        if upstream not in _circuit_breakers:
+            _circuit_breakers[upstream] = CircuitBreaker(upstream)
+        return _circuit_breakers[upstream]
+
+
+def post(upstream: str, url: str, timeout: float, **kwargs: Any) -> requests.Response:
+    """
+    requests.post() with a timeout (capped by the current deadline), guarded
+    by the upstream's circuit breaker. Connection errors, timeouts and 5xx
+    responses count as failures; the response is returned in the latter case,
+    the others raise UpstreamError.
+    """
+    breaker = get_circuit_breaker(upstream)
+    read_timeout = get_timeout(timeout)
+    breaker.before_call()
+    try:
+        response = requests.post(
+            url,
+            timeout=(min(UPSTREAM_CONNECT_TIMEOUT_SECONDS, read_timeout), read_timeout),
+            **kwargs,
+        )
+    except requests.RequestException as e:
+        breaker.record_failure()
+        raise UpstreamError(f"{upstream} request failed: {e}") from e
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
+
+
+_call_executor = ThreadPoolExecutor(thread_name_prefix="upstream")
+
+
+def guarded_call(upstream: str, call: Callable[[], T], timeout: float) -> T:
+    """
+    Runs a call to an upstream made by a client library (which can't be given
+    the deadline), guarded by the upstream's circuit breaker. The call is given
+    up on after `timeout` seconds (capped by the current deadline), although
+    it keeps running in the background. Any failure raises UpstreamError.
+    """
+    breaker = get_circuit_breaker(upstream)
+    wait_timeout = get_timeout(timeout)
+    breaker.before_call()
+    future = _call_executor.submit(call)
+    try:
+        result = future.result(timeout=wait_timeout)
+    except FutureTimeoutError as e:
+        breaker.record_failure()
+        raise UpstreamError(f"{upstream} request timed out") from e
+    except Exception as e:
+        breaker.record_failure()
+        raise UpstreamError(f"{upstream} request failed: {e}") from e
+    breaker.record_success()
+    return result
+
+
+_hedge_executor = ThreadPoolExecutor(thread_name_prefix="hedge")
+
+
+def hedged(call: Callable[[], T], hedge_after: float, attempts: int = 2) -> T:
+    """
+    Runs an idempotent call, starting another attempt if it fails or hasn't
+    completed after hedge_after seconds, up to `attempts` attempts in total.
+    Returns the first successful result. Only UpstreamErrors are retried.
+    """
+    pending: Set[Future] = set()
+    started = 0
+    error: Optional[UpstreamError] = None
+
+    def start() -> None:
+        nonlocal started
+        get_timeout(hedge_after)  # no point in starting after the deadline
+        context = contextvars.copy_context()
+        pending.add(_hedge_executor.submit(context.run, call))
+        started += 1
+
+    start()
+    while True:
+        done, pending = wait(
+            pending,
+            timeout=hedge_after if started < attempts else None,
+            return_when=FIRST_COMPLETED,
+        )
+        for future in done:
+            try:
+                return future.result()
+            except UpstreamError as e:
+                error = e
+        # all finished attempts failed, or none finished within hedge_after
+        if started < attempts:
+            start()
+        elif not pending:
+            assert error is not None
+            raise error
@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+
+from splitgraph_chatgpt_plugin.admission import AdmissionController, AdmissionRejected
+
+
+def _controller(**kwargs):
+    options = dict(
+        max_concurrency=1,
+        max_concurrency_per_user=1,
+        max_queue=10,
+        max_queue_per_user=10,
+        max_wait_seconds=5,
+    )
+    options.update(kwargs)
+    return AdmissionController("test", **options)
+
+
+def test_round_robin():
+    async def run():
+        controller = _controller()
+        order = []
+        release = asyncio.Event()
+
+        async def call(user, name):
+            async with controller.admit(user):
+                order.append(name)
+                if name == "first":
+                    await release.wait()
+
+        tasks = [asyncio.create_task(call("a", "first"))]
+        await asyncio.sleep(0)
+        for user, name in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1")]:
+            tasks.append(asyncio.create_task(call(user, name)))
+        await asyncio.sleep(0)
+        assert controller.metrics()["queued"] == 4
+        release.set()
+        await asyncio.gather(*tasks)
+        return order, controller.metrics()
+
+    order, metrics = asyncio.run(run())
+    # b doesn't have to wait for all of a's queued calls
+    assert order == ["first", "a1", "b1", "a2", "a3"]
+    assert metrics["active"] == 0
+    assert metrics["queued"] == 0
+    assert metrics["admitted_total"] == 5
+
+
+def test_per_user_concurrency():
+    async def run():
+        controller = _controller(max_concurrency=3, max_concurrency_per_user=2)
+        running = {"a": 0, "b": 0}
+        peak = {"a": 0, "b": 0}
+
+        async def call(user):
+            async with controller.admit(user):
+                running[user] += 1
+                peak[user] = max(peak[user], running[user])
+                await asyncio.sleep(0.01)
+                running[user] -= 1
+
+        await asyncio.gather(*[call("a") for _ in range(5)], call("b"))
+        return peak
+
+    assert asyncio.run(run()) == {"a": 2, "b": 1}
+
+
+def test_saturated_user_doesnt_block_others():
+    async def run():
+        controller = _controller(max_concurrency=3, max_concurrency_per_user=1)
+        release = asyncio.Event()
+
+        async def call(user):
+            async with controller.admit(user):
+                await release.wait()
+
+        tasks = [asyncio.create_task(call("a")) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert controller.metrics()["queued"] == 1
+        # b is admitted straight away, without waiting for a's calls
+        async with controller.admit("b"):
+            assert controller.metrics()["active"] == 2
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+
+
+def test_queue_full():
+    async def run():
+        controller = _controller(max_queue=2, max_queue_per_user=1)
+        release = asyncio.Event()
+
+        async def call(user):
+            async with controller.admit(user):
+                await release.wait()
+
+        tasks = [asyncio.create_task(call(user)) for user in ("a", "a", "b")]
+        await asyncio.sleep(0)
+        # a already has a call queued
+        with pytest.raises(AdmissionRejected):
+            await call("a")
+        # the queue is full
+        with pytest.raises(AdmissionRejected) as e:
+            await call("c")
+        assert e.value.retry_after >= 1
+        release.set()
+        await asyncio.gather(*tasks)
+        return controller.metrics()
+
+    metrics = asyncio.run(run())
+    assert metrics["rejected_total"] == 2
+    assert metrics["admitted_total"] == 3
+
+
+def test_wait_timeout():
+    async def run():
+        controller = _controller(max_wait_seconds=0.01)
+        release = asyncio.Event()
+
+        async def call(user):
+            async with controller.admit(user):
+                await release.wait()
+
+        task = asyncio.create_task(call("a"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected):
+            await call("b")
+        assert controller.metrics()["queued"] == 0
+        release.set()
+        await task
+        # the slot is free again
+        async with controller.admit("b"):
+            pass
+
+    asyncio.run(run())
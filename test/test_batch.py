@@ -0,0 +1,74 @@
+import asyncio
+
+from fastapi import HTTPException
+import pytest
+
+from server import main
+from server.main import get_error_message, run_batch
+from splitgraph_chatgpt_plugin.admission import AdmissionRejected
+from splitgraph_chatgpt_plugin.config import BATCH_MAX_ITEMS
+from splitgraph_chatgpt_plugin.upstream import UpstreamError, get_timeout
+
+
+def test_run_batch():
+    running = 0
+    peak = 0
+
+    async def run(item):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        # later items finish first
+        await asyncio.sleep(0.01 * (5 - int(item)))
+        running -= 1
+        if item == "3":
+            raise UpstreamError("upstream failed")
+        return f"result {item}"
+
+    def on_error(item, e):
+        return f"error {item}: {get_error_message('test', e)}"
+
+    results = asyncio.run(run_batch(["1", "2", "3", "4"], 2, run, on_error))
+    assert results == [
+        "result 1",
+        "result 2",
+        "error 3: Service Temporarily Unavailable",
+        "result 4",
+    ]
+    assert peak == 2
+
+
+def test_run_batch_deadline_per_item(monkeypatch):
+    monkeypatch.setattr(main, "REQUEST_DEADLINE_SECONDS", 0.1)
+
+    async def run(item):
+        # each round takes most of the deadline
+        await asyncio.sleep(0.06)
+        return get_timeout(1)
+
+    def on_error(item, e):
+        return get_error_message("test", e)
+
+    results = asyncio.run(run_batch(["x"] * BATCH_MAX_ITEMS, 2, run, on_error))
+    # every item runs under a deadline, and the last ones still complete
+    # within their own time budget
+    assert all(isinstance(r, float) and 0 < r <= 0.1 for r in results)
+
+
+def test_run_batch_too_many_items():
+    async def run(item):
+        return item
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(
+            run_batch(["x"] * (BATCH_MAX_ITEMS + 1), 2, run, lambda item, e: None)
+        )
+    assert e.value.status_code == 400
+
+
+def test_get_error_message():
+    assert (
+        get_error_message("test", AdmissionRejected("Too many requests", 3))
+        == "Too many requests, retry after 3 seconds"
+    )
+    assert get_error_message("test", ValueError("oops")) == "Internal Service Error"
@@ -0,0 +1,51 @@
+from splitgraph_chatgpt_plugin import cache
+from splitgraph_chatgpt_plugin.cache import LocalCache, cache_key
+
+
+def test_cache_key():
+    assert cache_key("a", 1) == cache_key("a", 1)
+    assert cache_key("a", 1) != cache_key("a", 2)
+    # parts are separated, so they can't run into each other
+    assert cache_key("ab", "c") != cache_key("a", "bc")
+
+
+def test_local_cache(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+    path = str(tmp_path / "cache.sqlite")
+    # two instances stand in for two workers sharing the cache
+    worker1, worker2 = LocalCache(path), LocalCache(path)
+
+    assert worker2.get("ns", "key") is None
+    worker1.set("ns", "key", "value", ttl_seconds=60)
+    assert worker2.get("ns", "key") == "value"
+    assert worker2.get("other", "key") is None
+
+    worker1.set("ns", "versioned", "v1", ttl_seconds=60, version=1)
+    assert worker2.get("ns", "versioned", version=1) == "v1"
+    # entries of older versions are ignored once the version has been bumped
+    assert worker2.get("ns", "versioned", version=2) is None
+    worker2.set("ns", "versioned", "v2", ttl_seconds=60, version=2)
+    assert worker1.get("ns", "versioned", version=2) == "v2"
+
+    now[0] += 61
+    assert worker1.get("ns", "key") is None
+
+
+def test_local_cache_cleanup(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+    monkeypatch.setattr(cache, "CACHE_CLEANUP_INTERVAL", 2)
+    local_cache = LocalCache(str(tmp_path / "cache.sqlite"))
+    local_cache.set("ns", "a", "1", ttl_seconds=10)
+    now[0] += 20
+    local_cache.set("ns", "b", "2", ttl_seconds=10)
+    rows = local_cache._connection.execute("SELECT key FROM shared_cache").fetchall()
+    assert rows == [("b",)]
+
+
+def test_cache_errors_are_misses(tmp_path):
+    local_cache = LocalCache(str(tmp_path / "cache.sqlite"))
+    local_cache._connection.execute("DROP TABLE shared_cache")
+    local_cache.set("ns", "key", "value", ttl_seconds=60)
+    assert local_cache.get("ns", "key") is None
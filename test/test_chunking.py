@@ -0,0 +1,108 @@
+from splitgraph_chatgpt_plugin.chunking import (
+    count_tokens,
+    repository_info_to_chunks,
+    split_lines_by_tokens,
+    split_readme_sections,
+)
+from splitgraph_chatgpt_plugin.models import RepositoryInfo, TableColumn, TableInfo
+
+
+class WordEncoding:
+    # Stands in for a tiktoken encoding: one token per whitespace-separated word.
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+def _repository_info(column_count=3):
+    return RepositoryInfo(
+        namespace="ns",
+        repository="repo",
+        readme="Intro text\n\n## Usage\nHow to use it\n\n## License\nPublic domain",
+        tables=[
+            TableInfo(
+                name="t1",
+                columns=[
+                    TableColumn(
+                        name=f"col{i}",
+                        postgresql_type="integer",
+                        is_primary_key=False,
+                        comment="a column",
+                    )
+                    for i in range(column_count)
+                ],
+            )
+        ],
+    )
+
+
+def test_split_lines_by_tokens():
+    encoding = WordEncoding()
+    pieces = split_lines_by_tokens(["a b", "c d", "e f g h i j k"], 6, encoding)
+    assert pieces == ["a b\nc d", "e f g h i j", "k"]
+    assert all(count_tokens(p, encoding) <= 6 for p in pieces)
+
+
+def test_split_readme_sections_skips_code_blocks():
+    readme = "\n".join(
+        [
+            "intro",
+            "# Usage",
+            "```sh",
+            "# not a heading",
+            "~~~",
+            "# still not a heading",
+            "```",
+            "",
+            "## Data",
+            "~~~~",
+            "# nor this",
+            "~~~~~",
+            "# Notes",
+        ]
+    )
+    assert split_readme_sections(readme) == [
+        ["intro"],
+        ["# Usage", "```sh", "# not a heading", "~~~", "# still not a heading", "```"],
+        ["## Data", "~~~~", "# nor this", "~~~~~"],
+        ["# Notes"],
+    ]
+
+
+def test_repository_info_to_chunks():
+    chunks = repository_info_to_chunks(_repository_info(), encoding=WordEncoding())
+    readme_chunks = [c for c in chunks if "table" not in c.metadata]
+    table_chunks = [c for c in chunks if "table" in c.metadata]
+    # one chunk per README section
+    assert len(readme_chunks) == 3
+    assert readme_chunks[1].page_content.endswith("## Usage\nHow to use it")
+    assert len(table_chunks) == 1
+    assert table_chunks[0].metadata == {
+        "namespace": "ns",
+        "repository": "repo",
+        "table": "t1",
+    }
+    for chunk in chunks:
+        assert chunk.page_content.startswith("# Repository: ns/repo\n")
+
+
+def test_large_table_split_keeps_context():
+    encoding = WordEncoding()
+    chunks = repository_info_to_chunks(
+        _repository_info(column_count=50), max_tokens=60, encoding=encoding
+    )
+    table_chunks = [c for c in chunks if "table" in c.metadata]
+    assert len(table_chunks) > 1
+    for chunk in table_chunks:
+        assert count_tokens(chunk.page_content, encoding) <= 60
+        assert '"ns/repo"."t1"' in chunk.page_content
+    # no column is lost or cut in half
+    columns = [
+        line
+        for c in table_chunks
+        for line in c.page_content.splitlines()
+        if line.startswith("* ")
+    ]
+    assert len(columns) == 50
@@ -0,0 +1,62 @@
+import numpy as np
+
+from splitgraph_chatgpt_plugin.compact import (
+    ProjectedEmbeddings,
+    get_projection_matrix,
+    project_embeddings,
+)
+from splitgraph_chatgpt_plugin.storage_report import storage_report
+
+
+class FakeEmbeddings:
+    def embed_documents(self, texts):
+        return [self.embed_query(t) for t in texts]
+
+    def embed_query(self, text):
+        return np.random.RandomState(len(text)).standard_normal(64).tolist()
+
+
+def test_projection_matrix_is_orthonormal_and_deterministic():
+    m = get_projection_matrix(64, 16)
+    assert m.shape == (64, 16)
+    assert np.allclose(m.T @ m, np.eye(16), atol=1e-5)
+    get_projection_matrix.cache_clear()
+    assert np.array_equal(m, get_projection_matrix(64, 16))
+
+
+def test_projected_embeddings_consistent_for_documents_and_queries():
+    embeddings = ProjectedEmbeddings(FakeEmbeddings(), 16)
+    [document] = embeddings.embed_documents(["some text"])
+    query = embeddings.embed_query("some text")
+    assert len(query) == 16
+    assert np.allclose(document, query)
+    assert np.isclose(np.linalg.norm(query), 1)
+
+
+def test_storage_report():
+    rng = np.random.RandomState(1)
+    # clustered data, so that nearest neighbours are meaningful
+    centers = rng.standard_normal((20, 128))
+    embeddings = centers[rng.randint(0, 20, 500)] + 0.1 * rng.standard_normal(
+        (500, 128)
+    )
+    rows = storage_report(embeddings, [1536, 128, 32], k=4, query_count=50)
+    # dimensions larger than the source are skipped
+    assert [(r.dimensions, r.half_precision) for r in rows] == [
+        (128, False),
+        (128, True),
+        (32, False),
+        (32, True),
+    ]
+    assert rows[0].recall == 1.0
+    assert rows[1].recall > 0.9
+    assert rows[1].bytes_per_vector < rows[0].bytes_per_vector
+    assert all(0 <= r.recall <= 1 for r in rows)
+    # k is capped by the number of other chunks
+    rows = storage_report(embeddings[:3], [32], k=4)
+    assert [r.recall for r in rows] == [1.0, 1.0]
+    assert np.allclose(
+        project_embeddings(embeddings[:1], 128)[0],
+        embeddings[0] / np.linalg.norm(embeddings[0]),
+        atol=1e-6,
+    )
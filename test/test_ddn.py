@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta, timezone
+
+from splitgraph_chatgpt_plugin import ddn
+from splitgraph_chatgpt_plugin.models import RepositorySchema, TableColumn, TableInfo
+from splitgraph_chatgpt_plugin.upstream import deadline
+
+
+def _repo(name):
+    return {
+        "repository": name,
+        "namespace": "ns",
+        "externalMetadata": None,
+        "repoProfileByNamespaceAndRepository": {"readme": f"# {name}", "metadata": {}},
+        "latestTables": {
+            "nodes": [
+                {
+                    "tableName": "t",
+                    "tableSchema": [[0, "id", "integer", True, "identifier"]],
+                }
+            ]
+        },
+    }
+
+
+def test_get_repo_list_pagination(monkeypatch):
+    pages = {
+        None: (["a", "b"], True, "cursor1"),
+        "cursor1": (["c"], False, None),
+    }
+    requests = []
+
+    def fake_graphql_request(operation, variables):
+        requests.append(variables)
+        names, has_next_page, end_cursor = pages[variables["after"]]
+        return {
+            "data": {
+                "namespace": {
+                    "namespace": "ns",
+                    "repositoriesByNamespace": {
+                        "pageInfo": {
+                            "hasNextPage": has_next_page,
+                            "endCursor": end_cursor,
+                        },
+                        "nodes": [_repo(name) for name in names],
+                    },
+                }
+            }
+        }
+
+    monkeypatch.setattr(ddn, "graphql_request", fake_graphql_request)
+    repos = ddn.get_repo_list("ns", page_size=2)
+    # nothing is fetched until the generator is consumed
+    assert requests == []
+    assert [r.repository for r in repos] == ["a", "b", "c"]
+    assert [r["after"] for r in requests] == [None, "cursor1"]
+    assert all(r["first"] == 2 for r in requests)
+
+
+def test_get_repo_list_removed_namespace(monkeypatch):
+    monkeypatch.setattr(
+        ddn,
+        "graphql_request",
+        lambda operation, variables: {"data": {"namespace": None}},
+    )
+    assert list(ddn.get_repo_list("ns")) == []
+
+
+def test_get_table_infos_schema_snapshots(monkeypatch):
+    live_requests = []
+
+    def fake_get_repo_tables(namespace, repository, use_fully_qualified_table_names):
+        live_requests.append((namespace, repository))
+        return [TableInfo(name=f"{repository}_live", columns=[])]
+
+    monkeypatch.setattr(ddn, "get_repo_tables", fake_get_repo_tables)
+    columns = [TableColumn(name="id", postgresql_type="integer", is_primary_key=True)]
+    now = datetime.now(tz=timezone.utc)
+    schemas = {
+        ("ns", "fresh"): RepositorySchema(
+            tables=[TableInfo(name="t", columns=columns)], updated_at=now
+        ),
+        ("ns", "stale"): RepositorySchema(
+            tables=[TableInfo(name="t", columns=columns)],
+            updated_at=now - timedelta(days=30),
+        ),
+    }
+    table_infos = ddn.get_table_infos(
+        [("ns", "fresh"), ("ns", "stale"), ("ns", "missing")],
+        use_fully_qualified_table_names=True,
+        schemas=schemas,
+    )
+    assert [t.name for t in table_infos] == [
+        '"ns/fresh"."t"',
+        "stale_live",
+        "missing_live",
+    ]
+    assert table_infos[0].columns == columns
+    assert live_requests == [("ns", "stale"), ("ns", "missing")]
+
+
+def test_graphql_request_hedging(monkeypatch):
+    timeouts = []
+    hedged = []
+
+    class FakeResponse:
+        status_code = 200
+
+        def json(self):
+            return {"data": {}}
+
+    def fake_post(upstream, url, timeout, **kwargs):
+        timeouts.append(timeout)
+        return FakeResponse()
+
+    def fake_hedged(call, hedge_after):
+        hedged.append(hedge_after)
+        return call()
+
+    monkeypatch.setattr(ddn, "post", fake_post)
+    monkeypatch.setattr(ddn, "hedged", fake_hedged)
+    # the indexer's pages are neither hedged nor given the short timeout
+    ddn.graphql_request("GetNamespaceRepos", {})
+    assert (timeouts, hedged) == ([ddn.GRAPHQL_PAGE_TIMEOUT_SECONDS], [])
+
+    timeouts.clear()
+    ddn.graphql_request("GetRepoTables", {})
+    with deadline(30):
+        ddn.graphql_request("GetNamespaceRepos", {})
+    assert timeouts == [ddn.GRAPHQL_TIMEOUT_SECONDS] * 2
+    assert hedged == [ddn.GRAPHQL_HEDGE_AFTER_SECONDS] * 2
@@ -0,0 +1,354 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+
+from langchain.docstore.document import Document
+import pytest
+
+from splitgraph_chatgpt_plugin import indexer
+from splitgraph_chatgpt_plugin.models import RepositoryInfo
+
+from .test_chunking import WordEncoding
+
+
+class FakeVectorStore:
+    def __init__(self, fail_after=None):
+        self.added = []
+        self.fail_after = fail_after
+
+    def add_documents(self, documents):
+        if self.fail_after is not None and len(self.added) >= self.fail_after:
+            raise RuntimeError("rate limited")
+        self.added.append(documents)
+
+
+class FakeConnection:
+    # Statements fail once a failed one has aborted the transaction, until
+    # it's rolled back.
+    def __init__(self):
+        self.aborted = False
+
+    def check(self):
+        if self.aborted:
+            raise RuntimeError("current transaction is aborted")
+
+    def rollback(self):
+        self.aborted = False
+
+
+@pytest.fixture
+def fake_indexer(monkeypatch):
+    state = {"completed": set(), "locked": False}
+    repositories = [
+        RepositoryInfo(namespace="ns", repository=f"repo{i}", readme="", tables=[])
+        for i in range(5)
+    ]
+    monkeypatch.setattr(
+        indexer, "pack_batches", partial(indexer.pack_batches, max_documents=4)
+    )
+    monkeypatch.setattr(indexer, "get_encoding", WordEncoding)
+    monkeypatch.setattr(indexer, "get_repo_list", lambda namespace: iter(repositories))
+    # three documents per repository, so repositories straddle embedding chunks
+    monkeypatch.setattr(
+        indexer,
+        "prepare_repository_info_documents",
+        lambda repo_info: [
+            Document(
+                page_content=f"{repo_info.repository} {i}",
+                metadata={"namespace": "ns", "repository": repo_info.repository},
+            )
+            for i in range(3)
+        ],
+    )
+    monkeypatch.setattr(indexer, "remove_old_embeddings", lambda *args: None)
+    monkeypatch.setattr(indexer, "save_repository_schema", lambda *args: None)
+    monkeypatch.setattr(indexer, "bump_collection_version", lambda *args: 1)
+    monkeypatch.setattr(
+        indexer,
+        "get_completed_repositories",
+        lambda connection, collection, namespace: set(state["completed"]),
+    )
+    monkeypatch.setattr(
+        indexer,
+        "mark_repository_completed",
+        lambda connection, collection, namespace, repository: state["completed"].add(
+            repository
+        ),
+    )
+    monkeypatch.setattr(
+        indexer,
+        "clear_progress",
+        lambda connection, collection, namespace: state["completed"].clear(),
+    )
+
+    def try_lock(connection, collection, namespace):
+        if state["locked"]:
+            return False
+        state["locked"] = True
+        return True
+
+    def unlock(connection, collection, namespace):
+        state["locked"] = False
+
+    monkeypatch.setattr(indexer, "try_lock_namespace", try_lock)
+    monkeypatch.setattr(indexer, "unlock_namespace", unlock)
+    return state
+
+
+def _index(vstore, resume=False):
+    with ThreadPoolExecutor(2) as executor:
+        indexer.index_namespace(None, vstore, executor, 2, "c", "ns", resume)
+
+
+def test_index_namespace_checkpoints_completed_repositories(fake_indexer):
+    vstore = FakeVectorStore(fail_after=2)
+    with pytest.raises(RuntimeError):
+        _index(vstore)
+    # 8 documents were embedded: repo0 and repo1 (documents 0-5) are complete,
+    # repo2 only had 2 of its 3 documents written.
+    assert fake_indexer["completed"] == {"repo0", "repo1"}
+    assert not fake_indexer["locked"]
+
+    vstore = FakeVectorStore()
+    _index(vstore, resume=True)
+    embedded = [d.metadata["repository"] for chunk in vstore.added for d in chunk]
+    assert sorted(set(embedded)) == ["repo2", "repo3", "repo4"]
+    assert len(embedded) == 9
+    assert fake_indexer["completed"] == {f"repo{i}" for i in range(5)}
+
+
+def test_index_namespace_without_resume_starts_over(fake_indexer):
+    fake_indexer["completed"].update({"repo0", "repo1"})
+    vstore = FakeVectorStore()
+    _index(vstore)
+    assert sum(len(chunk) for chunk in vstore.added) == 15
+
+
+def test_index_namespace_skips_locked_namespace(fake_indexer):
+    fake_indexer["locked"] = True
+    vstore = FakeVectorStore()
+    _index(vstore)
+    assert vstore.added == []
+
+
+def _prepared(repository, token_counts):
+    return indexer.PreparedRepository(
+        repository,
+        [],
+        [Document(page_content=repository) for _ in token_counts],
+        token_counts,
+    )
+
+
+def test_pack_batches_by_tokens():
+    batches = list(
+        indexer.pack_batches(
+            [
+                _prepared("a", [40, 40]),
+                _prepared("b", []),
+                _prepared("c", [30, 90]),
+                _prepared("d", [10]),
+            ],
+            max_tokens=100,
+            max_documents=10,
+        )
+    )
+    assert [b.tokens for b in batches] == [80, 30, 100]
+    assert [b.completed_repositories for b in batches] == [["a", "b"], [], ["c", "d"]]
+    assert all(b.tokens <= 100 for b in batches)
+
+
+def test_pack_batches_oversized_document():
+    batches = list(indexer.pack_batches([_prepared("a", [500, 10])], max_tokens=100))
+    assert [len(b.documents) for b in batches] == [1, 1]
+    assert batches[-1].completed_repositories == ["a"]
+
+
+def test_estimate_namespace(fake_indexer):
+    with ThreadPoolExecutor(2) as executor:
+        estimate = indexer.estimate_namespace(executor, 2, "ns")
+    # 5 repositories with 3 two-word documents each, packed 4 documents at a time
+    assert estimate == indexer.IndexingEstimate(
+        repositories=5, documents=15, tokens=30, api_calls=4
+    )
+
+
+class StandInGraphQLServer(ThreadingHTTPServer):
+    """
+    Serves GetNamespaceReposUpdatedSince for the "ns" namespace from a dict of
+    repository names to updatedAt timestamps.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StandInGraphQLHandler)
+        self.updated_at = {}
+        self.url = f"http://127.0.0.1:{self.server_address[1]}/graphql"
+
+    def get_page(self, variables):
+        since = datetime.fromisoformat(variables["since"])
+        updated = sorted(
+            (updated_at, repository)
+            for repository, updated_at in self.updated_at.items()
+            if datetime.fromisoformat(updated_at) >= since
+        )
+        start = int(variables["after"] or 0)
+        end = start + variables["first"]
+        return {
+            "namespace": "ns",
+            "repositoriesByNamespace": {
+                "pageInfo": {
+                    "hasNextPage": end < len(updated),
+                    "endCursor": str(end),
+                },
+                "nodes": [
+                    {
+                        "repository": repository,
+                        "namespace": "ns",
+                        "updatedAt": updated_at,
+                        "externalMetadata": None,
+                        "repoProfileByNamespaceAndRepository": {
+                            "readme": "",
+                            "metadata": {},
+                        },
+                        "latestTables": {"nodes": []},
+                    }
+                    for updated_at, repository in updated[start:end]
+                ],
+            },
+        }
+
+
+class StandInGraphQLHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        assert request["operationName"] == "GetNamespaceReposUpdatedSince"
+        page = self.server.get_page(request["variables"])
+        body = json.dumps({"data": {"namespace": page}})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body.encode("utf-8"))
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def graphql_server(monkeypatch):
+    server = StandInGraphQLServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv("GRAPHQL_API_URL", server.url)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fake_watch_state(fake_indexer, monkeypatch):
+    state = {"watermarks": {}, "versions": []}
+    monkeypatch.setattr(
+        indexer,
+        "get_watermark",
+        lambda connection, collection, namespace: state["watermarks"].get(namespace),
+    )
+    monkeypatch.setattr(
+        indexer,
+        "set_watermark",
+        lambda connection, collection, namespace, updated_at: state[
+            "watermarks"
+        ].update({namespace: updated_at}),
+    )
+
+    def bump_collection_version(connection, collection):
+        connection.check()
+        state["versions"].append(len(state["versions"]) + 1)
+
+    monkeypatch.setattr(indexer, "bump_collection_version", bump_collection_version)
+    return state
+
+
+def test_reindex_updated_repositories(fake_watch_state, graphql_server, monkeypatch):
+    watermarks = fake_watch_state["watermarks"]
+    versions = fake_watch_state["versions"]
+    graphql_server.updated_at = {
+        f"repo{i}": f"2023-07-0{i + 1}T00:00:00+00:00" for i in range(5)
+    }
+
+    # kept between polls, like watch_namespaces does
+    indexed = {}
+
+    def poll():
+        vstore = FakeVectorStore()
+        with ThreadPoolExecutor(2) as executor:
+            indexer.reindex_updated_repositories(
+                FakeConnection(), vstore, executor, 2, "c", "ns", indexed
+            )
+        return sorted({d.metadata["repository"] for c in vstore.added for d in c})
+
+    # the first poll indexes everything, 2 repositories per GraphQL page
+    monkeypatch.setattr(
+        indexer,
+        "get_updated_repo_list",
+        partial(indexer.get_updated_repo_list, page_size=2),
+    )
+    assert poll() == [f"repo{i}" for i in range(5)]
+    assert watermarks["ns"].isoformat() == "2023-07-05T00:00:00+00:00"
+    assert versions == [1]
+
+    # nothing changed: repo4 is in the overlap, but was already indexed at
+    # its current updatedAt, so nothing is embedded
+    assert poll() == []
+    assert versions == [1]
+
+    # an update committed late, with a timestamp before the watermark
+    graphql_server.updated_at["repo5"] = "2023-07-04T23:58:00+00:00"
+    assert poll() == ["repo5"]
+    assert watermarks["ns"].isoformat() == "2023-07-05T00:00:00+00:00"
+    assert versions == [1, 2]
+
+    graphql_server.updated_at["repo1"] = "2023-07-10T12:00:00+00:00"
+    assert poll() == ["repo1"]
+    assert watermarks["ns"].isoformat() == "2023-07-10T12:00:00+00:00"
+    assert versions == [1, 2, 3]
+    # repositories are forgotten once they're out of the overlap
+    assert list(indexed) == ["repo1"]
+
+
+def test_watch_namespaces_releases_lock_after_failure(
+    fake_indexer, fake_watch_state, graphql_server, monkeypatch
+):
+    graphql_server.updated_at = {"repo0": "2023-07-01T00:00:00+00:00"}
+    connection = FakeConnection()
+
+    class FailingVectorStore:
+        def add_documents(self, documents):
+            connection.aborted = True
+            raise RuntimeError("COPY failed")
+
+    unlock = indexer.unlock_namespace
+
+    def checked_unlock(connection, collection, namespace):
+        connection.check()
+        unlock(connection, collection, namespace)
+
+    monkeypatch.setattr(indexer, "unlock_namespace", checked_unlock)
+    monkeypatch.setattr(indexer, "unlock_all_namespaces", lambda connection: None)
+    with ThreadPoolExecutor(2) as executor:
+        indexer.watch_namespaces(
+            connection, FailingVectorStore(), executor, 2, "c", ["ns"], max_polls=1
+        )
+    # the repository's old embeddings may have been removed
+    assert fake_watch_state["versions"] == [1]
+    assert not fake_indexer["locked"]
+    assert fake_watch_state["watermarks"] == {}
+
+    vstore = FakeVectorStore()
+    with ThreadPoolExecutor(2) as executor:
+        indexer.watch_namespaces(
+            connection, vstore, executor, 2, "c", ["ns"], max_polls=1
+        )
+    assert sum(len(chunk) for chunk in vstore.added) == 3
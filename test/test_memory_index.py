@@ -0,0 +1,115 @@
+import numpy as np
+
+from splitgraph_chatgpt_plugin import memory_index
+from splitgraph_chatgpt_plugin.memory_index import (
+    MemoryMappedVectorStore,
+    load_snapshot,
+    search_snapshot,
+    snapshot_paths,
+    write_snapshot,
+)
+
+
+def _rows(count=20, dimensions=8):
+    rng = np.random.RandomState(0)
+    return [
+        (rng.standard_normal(dimensions), {"namespace": "ns", "repository": f"r{i}"})
+        for i in range(count)
+    ]
+
+
+def test_write_and_search_snapshot(tmp_path):
+    rows = _rows()
+    write_snapshot(rows, str(tmp_path), "c", 3)
+    snapshot = load_snapshot(str(tmp_path), "c", 3)
+    assert isinstance(snapshot.embeddings, np.memmap)
+    assert snapshot.embeddings.shape == (20, 8)
+    assert np.allclose(np.linalg.norm(snapshot.embeddings, axis=1), 1)
+
+    results = search_snapshot(snapshot, rows[5][0] * 2, 3)
+    assert len(results) == 3
+    assert results[0][0].metadata["repository"] == "r5"
+    assert abs(results[0][1]) < 1e-6
+    distances = [distance for _, distance in results]
+    assert distances == sorted(distances)
+
+
+def test_write_empty_snapshot(tmp_path):
+    write_snapshot([], str(tmp_path), "c", 1)
+    snapshot = load_snapshot(str(tmp_path), "c", 1)
+    assert search_snapshot(snapshot, [1.0, 0.0], 4) == []
+
+
+class FakeEmbeddings:
+    def __init__(self, embedding):
+        self.embedding = embedding
+
+    def embed_query(self, text):
+        return self.embedding
+
+
+class FakePGVector:
+    collection_name = "c"
+    _conn = None
+
+    def __init__(self, embedding):
+        self.embedding_function = FakeEmbeddings(embedding)
+        self.searches = 0
+
+    def similarity_search_with_score(self, query, k, filter):
+        self.searches += 1
+        return []
+
+
+class FakeConnection:
+    def close(self):
+        pass
+
+
+def test_memory_mapped_vector_store_refresh(tmp_path, monkeypatch):
+    rows = _rows()
+    version = {"c": 1}
+    monkeypatch.setattr(
+        memory_index,
+        "get_collection_version",
+        lambda connection, collection: version[collection],
+    )
+    monkeypatch.setattr(
+        memory_index, "iter_embeddings", lambda connection, collection: iter(rows)
+    )
+    fallback = FakePGVector(rows[7][0].tolist())
+    vstore = MemoryMappedVectorStore(fallback, FakeConnection, str(tmp_path))
+
+    # falls back to the database until a snapshot is loaded
+    assert vstore.similarity_search_with_score("q") == []
+    assert fallback.searches == 1
+
+    vstore.refresh()
+    [(document, _)] = vstore.similarity_search_with_score("q", k=1)
+    assert document.metadata["repository"] == "r7"
+    assert fallback.searches == 1
+
+    # schemas are only fetched for the repositories of the top matches
+    fetched = []
+    monkeypatch.setattr(
+        memory_index,
+        "get_repository_schemas",
+        lambda connection, collection, repositories: fetched.append(repositories) or {},
+    )
+    results, _ = vstore.similarity_search_with_schemas("q", k=5, schema_limit=1)
+    assert len(results) == 5
+    assert fetched == [[("ns", "r7")]]
+
+    # a new collection version replaces the previous snapshot
+    version["c"] = 2
+    rows = rows[:10]
+    vstore.refresh()
+    assert len(vstore.similarity_search("q", k=50)) == 10
+    assert not (tmp_path / "c-1.npy").exists()
+    assert all(
+        (tmp_path / p).exists()
+        for p in [
+            snapshot_paths("", "c", 2)[0],
+            snapshot_paths("", "c", 2)[1],
+        ]
+    )
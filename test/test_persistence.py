@@ -0,0 +1,65 @@
+import struct
+import uuid
+
+from langchain.docstore.document import Document
+
+from splitgraph_chatgpt_plugin.persistence import (
+    EMBEDDING_COLUMNS,
+    PGCOPY_HEADER,
+    PGCOPY_TRAILER,
+    encode_embeddings_copy_binary,
+    encode_vector_binary,
+    get_matching_repositories,
+)
+
+
+def test_encode_vector_binary():
+    encoded = encode_vector_binary([1.0, -2.5])
+    assert encoded == struct.pack("!hhff", 2, 0, 1.0, -2.5)
+
+
+def test_encode_embeddings_copy_binary():
+    collection_id = uuid.uuid4()
+    payload = encode_embeddings_copy_binary(
+        collection_id,
+        ["some text"],
+        [{"namespace": "ns", "repository": "repo"}],
+        [[0.5, 0.25, 0.125]],
+        ["id1"],
+    ).read()
+    assert payload.startswith(PGCOPY_HEADER)
+    assert payload.endswith(PGCOPY_TRAILER)
+    row = payload[len(PGCOPY_HEADER) : -len(PGCOPY_TRAILER)]
+    (field_count,) = struct.unpack("!h", row[:2])
+    assert field_count == len(EMBEDDING_COLUMNS)
+    fields = []
+    offset = 2
+    while offset < len(row):
+        (length,) = struct.unpack("!i", row[offset : offset + 4])
+        fields.append(row[offset + 4 : offset + 4 + length])
+        offset += 4 + length
+    assert len(fields) == field_count
+    assert fields[1] == collection_id.bytes
+    assert fields[2] == encode_vector_binary([0.5, 0.25, 0.125])
+    assert fields[3] == b"some text"
+    assert fields[4] == b'{"namespace": "ns", "repository": "repo"}'
+    assert fields[5] == b"id1"
+
+
+def test_get_matching_repositories():
+    def result(repository, distance):
+        return (
+            Document(
+                page_content="",
+                metadata={"namespace": "ns", "repository": repository},
+            ),
+            distance,
+        )
+
+    results = [result("b", 0.3), result("a", 0.1), result("c", 0.5), result("b", 0.2)]
+    # most relevant (lowest distance) first, each repository once
+    assert get_matching_repositories(results) == [
+        ("ns", "a"),
+        ("ns", "b"),
+        ("ns", "c"),
+    ]
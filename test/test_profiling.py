@@ -0,0 +1,85 @@
+import asyncio
+import threading
+
+from splitgraph_chatgpt_plugin import profiling
+from splitgraph_chatgpt_plugin.profiling import (
+    ProfilingMiddleware,
+    SamplingProfiler,
+    is_admin_token,
+    run_in_threadpool,
+)
+
+
+def spin(stop: threading.Event) -> None:
+    while not stop.is_set():
+        pass
+
+
+def test_sampling_profiler():
+    profiler = SamplingProfiler(interval=60)
+    session = profiler.start("/run_sql")
+    stop = threading.Event()
+
+    def work():
+        with session.thread():
+            spin(stop)
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    while not session.threads:
+        pass
+    for _ in range(3):
+        profiler.sample()
+    stop.set()
+    thread.join()
+    profiler.stop(session)
+
+    # only the session's threads are sampled
+    profiler.sample()
+    stacks = profiler.collapsed().splitlines()
+    assert stacks
+    assert all(line.startswith("/run_sql;") for line in stacks)
+    assert any("test.test_profiling:spin" in line for line in stacks)
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in stacks) >= 3
+    assert profiler.collapsed("/find_relevant_tables") == ""
+    assert profiler.requests() == {"/run_sql": 1}
+
+    profiler.reset()
+    assert profiler.collapsed() == ""
+
+
+def _call(middleware, headers=()):
+    scope = {"type": "http", "path": "/run_sql", "headers": list(headers)}
+    return asyncio.run(middleware(scope, None, None))
+
+
+def test_profiling_middleware():
+    seen = []
+
+    def in_thread():
+        session = profiling._session.get()
+        seen.append(session is not None and threading.get_ident() in session.threads)
+
+    async def app(scope, receive, send):
+        await run_in_threadpool(in_thread)
+
+    profiler = SamplingProfiler(interval=60)
+    middleware = ProfilingMiddleware(app, 0, "secret", profiler)
+    _call(middleware)
+    _call(middleware, [(b"x-profile-token", b"wrong")])
+    assert profiler.requests() == {}
+    _call(middleware, [(b"x-profile-token", b"secret")])
+    assert profiler.requests() == {"/run_sql": 1}
+    assert seen == [False, False, True]
+
+    middleware = ProfilingMiddleware(app, 1, None, profiler)
+    _call(middleware, [(b"x-profile-token", b"secret")])
+    assert profiler.requests() == {"/run_sql": 2}
+
+
+def test_is_admin_token():
+    assert is_admin_token("secret", "secret")
+    assert not is_admin_token("wrong", "secret")
+    assert not is_admin_token(None, "secret")
+    # the header can't be used unless an admin token is configured
+    assert not is_admin_token("", None)
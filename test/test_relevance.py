@@ -0,0 +1,69 @@
+from langchain.docstore.document import Document
+
+from splitgraph_chatgpt_plugin.models import TableColumn, TableInfo
+from splitgraph_chatgpt_plugin.relevance import (
+    fit_tables_to_budget,
+    get_table_distances,
+    rank_tables,
+)
+
+from .test_chunking import WordEncoding
+
+
+def _chunk(repository, distance, table=None):
+    metadata = {"namespace": "ns", "repository": repository}
+    if table is not None:
+        metadata["table"] = table
+    return (Document(page_content="", metadata=metadata), distance)
+
+
+def _table(name, column_count=2):
+    return TableInfo(
+        name=name,
+        columns=[
+            TableColumn(name=f"col{i}", postgresql_type="integer", is_primary_key=False)
+            for i in range(column_count)
+        ],
+    )
+
+
+def test_get_table_distances():
+    distances = get_table_distances(
+        [
+            _chunk("a", 0.1),
+            _chunk("a", 0.4, "t1"),
+            _chunk("a", 0.2, "t1"),
+            _chunk("b", 0.3, "t2"),
+        ]
+    )
+    assert distances == {'"ns/a"."t1"': 0.2, '"ns/b"."t2"': 0.3}
+
+
+def test_rank_tables():
+    tables = [_table('"ns/a"."t1"'), _table('"ns/a"."t2"'), _table('"ns/b"."t3"')]
+    ranked = rank_tables(tables, {'"ns/b"."t3"': 0.1, '"ns/a"."t2"': 0.2})
+    assert [t.name for t in ranked] == ['"ns/b"."t3"', '"ns/a"."t2"', '"ns/a"."t1"']
+
+
+def test_fit_tables_to_budget():
+    encoding = WordEncoding()
+    tables = [_table("t1"), _table("t2"), _table("t3", 50), _table("t4")]
+    table_tokens = len(tables[0].json().split())
+
+    response = fit_tables_to_budget(tables, 1000, encoding)
+    assert response.tables == tables
+    assert response.other_tables == []
+    assert not response.truncated
+
+    # t3 doesn't fit, so it and everything after it is listed by name only,
+    # even though t4 would fit
+    response = fit_tables_to_budget(tables, 2 * table_tokens + 5, encoding)
+    assert [t.name for t in response.tables] == ["t1", "t2"]
+    assert response.other_tables == ["t3", "t4"]
+    assert response.truncated
+
+    # names are only listed while they fit too
+    response = fit_tables_to_budget(tables, table_tokens + 1, encoding)
+    assert [t.name for t in response.tables] == ["t1"]
+    assert response.other_tables == ["t2"]
+    assert response.truncated
@@ -0,0 +1,160 @@
+from splitgraph_chatgpt_plugin import ddn
+from splitgraph_chatgpt_plugin.models import TableColumn, TableInfo
+from splitgraph_chatgpt_plugin.sql_validation import tokenize, validate_sql
+
+SCHEMAS = {
+    ("ns", "repo"): [
+        TableInfo(
+            name="orders",
+            columns=[
+                TableColumn(name=name, postgresql_type="text", is_primary_key=False)
+                for name in ("id", "customer_id", "Total")
+            ],
+        ),
+        TableInfo(
+            name="customers",
+            columns=[
+                TableColumn(name="id", postgresql_type="integer", is_primary_key=True),
+                TableColumn(name="name", postgresql_type="text", is_primary_key=False),
+            ],
+        ),
+    ]
+}
+
+
+def _lookup(repositories):
+    return {r: SCHEMAS[r] for r in repositories if r in SCHEMAS}
+
+
+def test_tokenize():
+    tokens = tokenize(
+        """SELECT "A""b", 'it''s', x -- comment\n/* block */ FROM "ns/repo".t"""
+    )
+    assert [(t.kind, t.value) for t in tokens] == [
+        ("word", "select"),
+        ("identifier", 'A"b'),
+        ("other", ","),
+        ("string", "'it''s'"),
+        ("other", ","),
+        ("word", "x"),
+        ("word", "from"),
+        ("identifier", "ns/repo"),
+        ("other", "."),
+        ("word", "t"),
+    ]
+
+
+def test_validate_sql_valid_queries():
+    for sql in [
+        'SELECT o.id, o."Total" FROM "ns/repo"."orders" o',
+        'SELECT * FROM "ns/repo".orders, "ns/repo".customers AS c WHERE c.id = 1',
+        'SELECT orders.id FROM "ns/repo".orders JOIN "ns/repo".customers c '
+        "ON orders.customer_id = c.id",
+        'SELECT "ns/repo"."orders".id FROM "ns/repo"."orders"',
+        # unknown repositories and unqualified columns aren't checked
+        'SELECT a.whatever, made_up FROM "other/repo"."t" a',
+        # c refers to a CTE, not to the customers table
+        'WITH c AS (SELECT 1 AS x) SELECT c.x FROM c, "ns/repo".customers',
+        'SELECT s.x FROM (SELECT 1 AS x) s, "ns/repo".customers AS s2',
+        "SELECT extract(year FROM now()), 'FROM nowhere/repo.t'",
+        # aliases reused for tables without a known schema
+        'SELECT t.id FROM "ns/repo".orders t '
+        'WHERE t.id IN (SELECT t.y FROM "other/repo".foo t)',
+        'WITH other_cte AS (SELECT 1 AS zzz) SELECT c.id FROM "ns/repo".customers c '
+        "WHERE EXISTS (SELECT 1 FROM other_cte c WHERE c.zzz = 1)",
+        'SELECT c.id FROM "ns/repo".customers c UNION SELECT c.zz FROM "other/r".t c',
+        # column aliases rename the table's columns
+        'SELECT o.a, o.c FROM "ns/repo".orders AS o(a, b, c)',
+        # system columns
+        'SELECT o.ctid, o.xmin FROM "ns/repo".orders o',
+    ]:
+        assert validate_sql(sql, _lookup) is None, sql
+
+
+def test_validate_sql_unknown_table():
+    assert (
+        validate_sql('SELECT * FROM "ns/repo"."order"', _lookup)
+        == 'relation "ns/repo".order does not exist. Did you mean "ns/repo".orders?'
+    )
+
+
+def test_validate_sql_unknown_columns():
+    error = validate_sql(
+        'SELECT o.total, o.customer, c.nam FROM "ns/repo".orders o '
+        'JOIN "ns/repo".customers c ON c.id = o.customer',
+        _lookup,
+    )
+    assert error == "\n".join(
+        [
+            'column o.total does not exist. Did you mean o."Total"?',
+            "column o.customer does not exist. Did you mean o.customer_id?",
+            "column c.nam does not exist. Did you mean c.name?",
+        ]
+    )
+
+
+def test_validate_sql_unquoted_table_names():
+    assert validate_sql("SELECT * FROM ns/repo.orders", _lookup) == (
+        "table names containing a slash must be quoted: ns/repo.orders isn't a "
+        'valid table name. Did you mean "ns/repo".orders?'
+    )
+    assert validate_sql('SELECT * FROM "ns/repo.orders"', _lookup) == (
+        'table names containing a slash must be quoted: "ns/repo.orders" isn\'t a '
+        'valid table name. Did you mean "ns/repo".orders?'
+    )
+
+
+def test_validate_sql_stale_snapshot():
+    live = {
+        ("ns", "repo"): SCHEMAS[("ns", "repo")]
+        + [
+            TableInfo(
+                name="refunds",
+                columns=[
+                    TableColumn(name="id", postgresql_type="int", is_primary_key=True)
+                ],
+            )
+        ]
+    }
+    looked_up = []
+
+    def lookup_live(repositories):
+        looked_up.append(repositories)
+        return {r: live[r] for r in repositories if r in live}
+
+    # tables added since the snapshot are found in the live schema
+    sql = 'SELECT r.id FROM "ns/repo".refunds r JOIN "ns/repo".orders o ON o.id = r.id'
+    assert validate_sql(sql, _lookup, lookup_live) is None
+    assert looked_up == [[("ns", "repo")]]
+    assert (
+        validate_sql('SELECT r.ids FROM "ns/repo".refunds r', _lookup, lookup_live)
+        == "column r.ids does not exist. Did you mean r.id?"
+    )
+    assert (
+        validate_sql('SELECT * FROM "ns/repo".refund', _lookup, lookup_live)
+        == 'relation "ns/repo".refund does not exist. Did you mean "ns/repo".refunds?'
+    )
+    # valid queries don't need a live lookup
+    looked_up.clear()
+    assert (
+        validate_sql('SELECT o.id FROM "ns/repo".orders o', _lookup, lookup_live)
+        is None
+    )
+    assert looked_up == []
+    # repositories whose live schema can't be fetched aren't checked
+    assert validate_sql(sql, _lookup, lambda repositories: {}) is None
+
+
+def test_run_sql_rejects_invalid_queries(monkeypatch):
+    def fake_ddn_query(sql):
+        raise AssertionError("invalid queries must not be sent to the DDN")
+
+    monkeypatch.setattr(ddn, "ddn_query", fake_ddn_query)
+    monkeypatch.setattr(
+        ddn,
+        "get_repo_tables",
+        lambda namespace, repository: SCHEMAS[(namespace, repository)],
+    )
+    response = ddn.run_sql('SELECT o.nope FROM "ns/repo".orders o', _lookup)
+    assert response.error == "column o.nope does not exist."
+    assert response.rows is None
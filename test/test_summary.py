@@ -0,0 +1,112 @@
+import json
+
+from splitgraph_chatgpt_plugin import ddn
+from splitgraph_chatgpt_plugin.models import DDNResponseField, DDNResponseSuccess
+from splitgraph_chatgpt_plugin.summary import summarize_result
+
+
+def _field(name, data_type_id, formatted_type):
+    return DDNResponseField(
+        name=name,
+        tableID=0,
+        columnID=0,
+        dataTypeID=data_type_id,
+        dataTypeSize=-1,
+        dataTypeModifier=-1,
+        format="text",
+        formattedType=formatted_type,
+    )
+
+
+FIELDS = [
+    _field("id", 23, "integer"),
+    _field("price", 1700, "numeric"),
+    _field("city", 25, "text"),
+    _field("day", 1082, "date"),
+    _field("tags", 3802, "jsonb"),
+]
+
+ROWS = [
+    {"id": 1, "price": "10.5", "city": "Paris", "day": "2023-01-03", "tags": [1]},
+    {"id": 2, "price": None, "city": "Oslo", "day": "2022-12-31", "tags": None},
+    {"id": 3, "price": "2", "city": "Paris", "day": None, "tags": {"a": 1}},
+    {"id": 4, "price": "100", "city": None, "day": "2023-02-01", "tags": []},
+]
+
+
+def test_summarize_result():
+    summary = summarize_result(ROWS, FIELDS, top_k=1, sample_size=2)
+    assert summary.row_count == 4
+    assert summary.sample_rows == ROWS[:2]
+    id_, price, city, day, tags = summary.columns
+
+    assert (id_.count, id_.nulls, id_.min, id_.max, id_.mean) == (4, 0, 1, 4, 2.5)
+    assert id_.top_values is None
+
+    # numeric values keep their original (string) representation
+    assert (price.count, price.nulls, price.min, price.max) == (3, 1, "2", "100")
+    assert price.mean == 112.5 / 3
+
+    assert (city.count, city.nulls, city.min, city.mean) == (3, 1, None, None)
+    assert [(v.value, v.count) for v in city.top_values] == [("Paris", 2)]
+
+    assert (day.min, day.max, day.nulls) == ("2022-12-31", "2023-02-01", 1)
+
+    assert (tags.count, tags.nulls, tags.min, tags.top_values) == (3, 1, None, None)
+    assert tags.type == "jsonb"
+
+
+def test_summarize_non_finite_numbers():
+    field = _field("x", 701, "double precision")
+    summary = summarize_result(
+        [{"x": v} for v in ("NaN", "Infinity", "-Infinity", "1.5", "3.5")], [field]
+    )
+    (column,) = summary.columns
+    assert (column.count, column.min, column.max, column.mean) == (5, "1.5", "3.5", 2.5)
+
+    (column,) = summarize_result([{"x": "NaN"}], [field]).columns
+    assert (column.min, column.max, column.mean) == (None, None, None)
+    # serializable without NaN, which JSON responses don't allow
+    json.dumps(column.dict(), allow_nan=False)
+
+
+def test_summarize_timestamps():
+    field = _field("t", 1184, "timestamp with time zone")
+    values = ["2023-07-01 10:00:00+02", "2023-07-01 09:00:00+00", "2023-06-30T23:00Z"]
+    (column,) = summarize_result([{"t": v} for v in values], [field]).columns
+    # 08:00 UTC is earlier than 09:00 UTC
+    assert (column.min, column.max) == (values[2], values[1])
+
+    # BC dates can't be compared reliably, so they're only counted
+    field = _field("d", 1082, "date")
+    (column,) = summarize_result(
+        [{"d": "2023-01-01"}, {"d": "0044-03-15 BC"}], [field]
+    ).columns
+    assert (column.count, column.min, column.max) == (2, None, None)
+
+
+def test_summarize_empty_result():
+    summary = summarize_result([], FIELDS)
+    assert summary.row_count == 0
+    assert [(c.count, c.nulls, c.min) for c in summary.columns] == [(0, 0, None)] * 5
+
+
+def test_run_sql_summarize(monkeypatch):
+    monkeypatch.setattr(
+        ddn,
+        "ddn_query",
+        lambda sql: DDNResponseSuccess(
+            success=True,
+            command="SELECT",
+            rowCount=len(ROWS),
+            rows=ROWS,
+            fields=FIELDS,
+            executionTime="1ms",
+            executionTimeHighRes="1ms",
+        ),
+    )
+    response = ddn.run_sql("SELECT 1", summarize=True)
+    assert response.rows is None
+    assert response.summary.row_count == 4
+    assert response.query_editor_url
+    assert ddn.run_sql("SELECT 1").rows == ROWS
@@ -0,0 +1,149 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from splitgraph_chatgpt_plugin import upstream
+from splitgraph_chatgpt_plugin.upstream import (
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceeded,
+    UpstreamError,
+    deadline,
+    get_timeout,
+    guarded_call,
+    hedged,
+)
+
+
+def test_deadline():
+    assert get_timeout(10) == 10
+    with deadline(5):
+        assert 4 < get_timeout(10) <= 5
+        assert get_timeout(1) == 1
+        # nested deadlines can't extend the outer one
+        with deadline(60):
+            assert get_timeout(10) <= 5
+    assert get_timeout(10) == 10
+    with deadline(0):
+        with pytest.raises(DeadlineExceeded):
+            get_timeout(10)
+
+
+def test_circuit_breaker(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(upstream.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_seconds=10)
+    breaker.before_call()
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # a single trial call is let through after reset_seconds
+    now[0] = 11
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    now[0] = 22
+    breaker.before_call()
+    breaker.record_success()
+    breaker.before_call()
+    breaker.before_call()
+
+
+def test_post_opens_circuit(monkeypatch):
+    calls = []
+
+    def fake_post(url, timeout, **kwargs):
+        calls.append(timeout)
+        raise requests.Timeout("timed out")
+
+    monkeypatch.setattr(upstream.requests, "post", fake_post)
+    monkeypatch.setattr(upstream, "_circuit_breakers", {})
+    for _ in range(upstream.CIRCUIT_BREAKER_FAILURE_THRESHOLD):
+        with pytest.raises(UpstreamError):
+            upstream.post("test", "http://example.com", 5)
+    with pytest.raises(CircuitOpenError):
+        upstream.post("test", "http://example.com", 5)
+    assert len(calls) == upstream.CIRCUIT_BREAKER_FAILURE_THRESHOLD
+    assert calls[0][1] == 5
+
+
+def test_hedged_slow_attempt():
+    release = threading.Event()
+    attempts = []
+
+    def call():
+        attempts.append(None)
+        if len(attempts) == 1:
+            release.wait(5)
+            return "slow"
+        return "fast"
+
+    try:
+        assert hedged(call, hedge_after=0.05) == "fast"
+    finally:
+        release.set()
+    assert len(attempts) == 2
+
+
+def test_hedged_failures():
+    attempts = []
+
+    def failing():
+        attempts.append(None)
+        if len(attempts) == 1:
+            raise UpstreamError("first attempt failed")
+        return "ok"
+
+    start = time.monotonic()
+    # a failed attempt is retried straight away, without waiting for hedge_after
+    assert hedged(failing, hedge_after=5) == "ok"
+    assert time.monotonic() - start < 1
+
+    def always_failing():
+        raise UpstreamError("failed")
+
+    with pytest.raises(UpstreamError):
+        hedged(always_failing, hedge_after=0.01, attempts=3)
+
+    def broken():
+        raise ValueError("not an upstream error")
+
+    with pytest.raises(ValueError):
+        hedged(broken, hedge_after=0.01)
+
+
+def test_guarded_call(monkeypatch):
+    monkeypatch.setattr(upstream, "_circuit_breakers", {})
+    release = threading.Event()
+    assert guarded_call("test", lambda: "ok", 5) == "ok"
+
+    def broken():
+        raise ValueError("bad response")
+
+    with pytest.raises(UpstreamError, match="bad response"):
+        guarded_call("test", broken, 5)
+
+    # slow calls are given up on by the deadline
+    start = time.monotonic()
+    try:
+        with deadline(0.05):
+            with pytest.raises(UpstreamError, match="timed out"):
+                guarded_call("test", lambda: release.wait(5), 5)
+    finally:
+        release.set()
+    assert time.monotonic() - start < 1
+
+    for _ in range(upstream.CIRCUIT_BREAKER_FAILURE_THRESHOLD - 2):
+        with pytest.raises(UpstreamError):
+            guarded_call("test", broken, 5)
+    with pytest.raises(CircuitOpenError):
+        guarded_call("test", lambda: "ok", 5)